@@ -1,3 +1,6 @@
+import atexit
+import sys
+import threading
 from flask import Flask, jsonify
 from flask_cors import CORS
 
@@ -9,18 +12,63 @@ from routes.ai_chatGPT import chatgpt_bp
 # 新しいa2a Blueprint
 from routes.a2a_chat import a2a_bp
 
+# メトリクス（Prometheus形式）
+from routes.metrics import metrics_bp
+
 # データベース初期化
-from database import init_database, database_exists
+from database import init_database, database_exists, close_all_connections
+
+# 保存期間（アーカイブ・物理削除）のバックグラウンド処理
+from services.retention import retention_worker
+
+# メッセージ書き込みの遅延バッチ（A2A_WRITE_BEHIND_DELAY_MS を設定したときだけ動く）
+from services.message_writer import message_writer
+
+# JSON出力の高速化と応答の圧縮
+from utils.json_provider import FastJSONProvider
+from utils.compression import compress_response
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)
+app.after_request(compress_response)
+
+_startup_lock = threading.Lock()
+_started = False
+
+
+def startup():
+    """起動処理（データベース初期化・リテンション処理と書き込みスレッドの開始）
+
+    インポート時には実行せず、サーバー起動時（__main__ / ASGI の lifespan）に呼ぶ。
+    2回目以降の呼び出しは何もしない。
+    """
+    global _started
+    if _started:
+        return
+    with _startup_lock:
+        if _started:
+            return
+        if not database_exists():
+            print("🚀 データベースを初期化しています...")
+            init_database()
+        else:
+            print("✅ データベースが既に存在します")
+        retention_worker.start()
+        message_writer.start()
+        # 終了時にリテンション処理を止め、待機中のメッセージを書き切ってから
+        # プール内の接続を閉じる（atexit は登録と逆順に呼ばれる）
+        atexit.register(close_all_connections)
+        atexit.register(message_writer.stop)
+        atexit.register(retention_worker.stop)
+        _started = True
+
+
+@app.before_request
+def ensure_startup():
+    # gunicorn など startup() を呼ばないWSGIサーバー向け（初回リクエストで実行）
+    startup()
 
-# データベース初期化（アプリケーション作成時に実行）
-if not database_exists():
-    print("🚀 データベースを初期化しています...")
-    init_database()
-else:
-    print("✅ データベースが既に存在します")
 
 # Blueprintを登録
 app.register_blueprint(gemini_bp)
@@ -30,6 +78,9 @@ app.register_blueprint(chatgpt_bp)
 # a2a機能を追加
 app.register_blueprint(a2a_bp, url_prefix="/a2a")
 
+# メトリクスを追加
+app.register_blueprint(metrics_bp)
+
 @app.route("/")
 def index():
     return jsonify({
@@ -47,13 +98,21 @@ def index():
                 "/a2a/groups",
                 "/a2a/groups/{id}/players", 
                 "/a2a/groups/{id}/messages",
+                "/a2a/groups/{id}/snapshot",
                 "/a2a/groups/{id}/ai-speak",
                 "/a2a/status"
-            ]
+            ],
+            "metrics": ["/metrics"]
         }
     })
 
 if __name__ == "__main__":
+    if "--profile-startup" in sys.argv:
+        # 起動時のインポート時間を表示して終了
+        from utils.startup_profile import main as profile_startup
+        sys.exit(profile_startup())
+
+    startup()
     print("🔥 AI NEXUS Backend Server Starting...")
     print("🌐 Frontend URL: http://localhost:5173")
     print("🔧 Backend URL: http://127.0.0.1:5000")
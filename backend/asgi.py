@@ -0,0 +1,405 @@
+"""
+ASGI エントリーポイント（非同期サーバー用）
+
+AIの発言（ai-speak / ai-speak/stream）と新着メッセージの配信（events）は asyncio 上で
+処理し、プロバイダーの応答や新着を待つ間OSスレッドを占有しない。それ以外のルートは
+既存の Flask アプリをスレッドプールで実行する（1リクエストは1スレッドで最後まで処理する）。
+終わらない応答をスレッドプールに載せると、開いているタブの数だけスレッドが埋まるため、
+長時間の接続は必ず asyncio 側で処理する。
+
+起動例: uvicorn asgi:app --host 127.0.0.1 --port 5000
+"""
+import asyncio
+import io
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from app import app as flask_app, startup
+from database import close_all_connections, get_messages_page
+from routes.a2a_chat import format_sse, EVENT_KEEPALIVE_SECONDS, MAX_MESSAGE_PAGE_SIZE
+from services.async_gateway import close_async_clients
+from services.event_bus import message_bus, OVERFLOW_EVENT
+from services.conversation import TurnError, prepare_turn, arun_turn, astream_turn
+from services.message_writer import message_writer
+from services.metrics import metrics, HTTP_LATENCY, HTTP_REQUESTS
+
+# Flask ルートを実行するスレッド数
+WSGI_MAX_WORKERS = 32
+
+# Flask の応答をイベントループへ渡す際に溜めておくチャンク数
+WSGI_QUEUE_SIZE = 16
+
+# asyncio で直接処理するルート
+AI_SPEAK_PATH = re.compile(r"^/a2a/groups/(\d+)/ai-speak(/stream)?$")
+EVENTS_PATH = re.compile(r"^/a2a/groups/(\d+)/events$")
+
+# Flask 側（flask_cors）と同じく、直接処理するルートにもCORSヘッダーを付ける
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_MAX_WORKERS, thread_name_prefix="wsgi")
+
+_END = object()
+
+
+async def read_body(receive) -> bytes:
+    """リクエスト本文をすべて読む"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+class RecordingSend:
+    """送信したステータスを記録する send のラッパー（メトリクス用）"""
+
+    def __init__(self, send):
+        self._send = send
+        self.status = 500
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        await self._send(message)
+
+
+async def send_json(send, body: dict, status: int = 200):
+    payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(payload)).encode("ascii"))] + CORS_HEADERS})
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def wait_disconnect(receive):
+    """クライアントが切断するまで待つ"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+# ===================================
+# asyncio で処理するルート
+# ===================================
+
+async def ai_speak(group_id: int, data: dict, send):
+    """POST /a2a/groups/<id>/ai-speak"""
+    try:
+        turn = await asyncio.to_thread(prepare_turn, group_id, data.get("player_id"), data.get("api_key"),
+                                       data.get("additional_prompt", ""))
+        result = await arun_turn(turn)
+        await send_json(send, {"success": True, **result})
+    except TurnError as e:
+        await send_json(send, {"success": False, "error": str(e)}, e.status_code)
+    except Exception as e:
+        await send_json(send, {"success": False, "error": str(e)}, 500)
+
+
+async def ai_speak_stream(group_id: int, data: dict, receive, send):
+    """POST /a2a/groups/<id>/ai-speak/stream"""
+    try:
+        turn = await asyncio.to_thread(prepare_turn, group_id, data.get("player_id"), data.get("api_key"),
+                                       data.get("additional_prompt", ""))
+    except TurnError as e:
+        return await send_json(send, {"success": False, "error": str(e)}, e.status_code)
+    except Exception as e:
+        return await send_json(send, {"success": False, "error": str(e)}, 500)
+
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                            (b"cache-control", b"no-cache"),
+                            (b"x-accel-buffering", b"no")] + CORS_HEADERS})
+
+    async def relay():
+        events = astream_turn(turn)
+        try:
+            async for item in events:
+                await send({"type": "http.response.body",
+                            "body": format_sse(item["event"], item["data"]).encode("utf-8"),
+                            "more_body": True})
+        finally:
+            await events.aclose()
+
+    # クライアントが切断したら生成を打ち切る（保存は行われない）
+    relay_task = asyncio.ensure_future(relay())
+    disconnect_task = asyncio.ensure_future(wait_disconnect(receive))
+    done, _ = await asyncio.wait([relay_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+    if relay_task not in done:
+        relay_task.cancel()
+        print(f"ストリーミングがキャンセルされました: group={group_id} player={turn['player']['id']}")
+        return
+    disconnect_task.cancel()
+    relay_task.result()
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def parse_after_id(scope: dict):
+    """再接続時の Last-Event-ID（またはクエリの after_id）を取得"""
+    headers = dict(scope.get("headers", []))
+    params = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    for value in (headers.get(b"last-event-id", b"").decode("latin-1"), (params.get("after_id") or [""])[0]):
+        try:
+            return int(value)
+        except ValueError:
+            continue
+    return None
+
+
+async def group_events(group_id: int, scope: dict, receive, send):
+    """GET /a2a/groups/<id>/events（routes.a2a_chat.group_events の asyncio 版）"""
+    after_id = parse_after_id(scope)
+
+    # 差分取得と購読開始の間に追加された分を取りこぼさないよう、先に購読する
+    subscription = message_bus.subscribe_async(group_id)
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")] + CORS_HEADERS})
+
+        async def emit(message: dict):
+            await send({"type": "http.response.body", "more_body": True,
+                        "body": format_sse("message", message, event_id=message["id"]).encode("utf-8")})
+
+        async def relay():
+            last_id = after_id or 0
+            # 再接続時の差分をページ単位で送る
+            cursor_id = after_id
+            while cursor_id is not None:
+                page = await asyncio.to_thread(get_messages_page, group_id, MAX_MESSAGE_PAGE_SIZE,
+                                               after_id=cursor_id)
+                for message in page["messages"]:
+                    last_id = message["id"]
+                    await emit(message)
+                cursor_id = page["next_cursor"]
+
+            while True:
+                try:
+                    event = await subscription.get(EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # 接続維持用のコメント行
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                    continue
+
+                if event is OVERFLOW_EVENT:
+                    # 取りこぼしが出たので一度切断し、クライアントに再接続させる
+                    return
+
+                message = event["message"]
+                if message["id"] <= last_id:
+                    continue
+                last_id = message["id"]
+                await emit(message)
+
+        relay_task = asyncio.ensure_future(relay())
+        disconnect_task = asyncio.ensure_future(wait_disconnect(receive))
+        done, _ = await asyncio.wait([relay_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+        if relay_task not in done:
+            relay_task.cancel()
+            return
+        disconnect_task.cancel()
+        relay_task.result()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        message_bus.unsubscribe(group_id, subscription)
+
+
+# ===================================
+# Flask アプリへの委譲
+# ===================================
+
+def build_environ(scope: dict, body: bytes) -> dict:
+    """ASGI の scope から WSGI の environ を作成"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if key == "CONTENT_LENGTH":
+            continue
+        key = f"HTTP_{key}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def call_flask(scope: dict, receive, send):
+    """Flask アプリを1本のスレッドで実行し、応答をチャンク単位で中継する
+
+    接続プールなどスレッドローカルな状態を使うため、応答の生成（ストリーミングを含む）は
+    最後まで同じスレッドで行う。
+    """
+    loop = asyncio.get_running_loop()
+    environ = build_environ(scope, await read_body(receive))
+    chunks: asyncio.Queue = asyncio.Queue(WSGI_QUEUE_SIZE)
+    disconnected = threading.Event()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+    def run():
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+            return lambda data: put(data)
+
+        try:
+            result = flask_app(environ, start_response)
+            try:
+                put(started)
+                for chunk in result:
+                    if disconnected.is_set():
+                        break
+                    if chunk:
+                        put(chunk)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except BaseException as e:
+            put(e)
+        finally:
+            put(_END)
+
+    future = loop.run_in_executor(_wsgi_executor, run)
+    disconnect_task = asyncio.ensure_future(wait_disconnect(receive))
+
+    async def next_chunk():
+        """次のチャンクを待つ（先にクライアントが切断したら _END を返し、生成を止めさせる）"""
+        get_task = asyncio.ensure_future(chunks.get())
+        done, _ = await asyncio.wait([get_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+        if get_task in done:
+            return get_task.result()
+        get_task.cancel()
+        disconnected.set()
+        return _END
+
+    try:
+        head = await next_chunk()
+        if head is _END:
+            return
+        if isinstance(head, BaseException):
+            raise head
+        await send({"type": "http.response.start", "status": head["status"],
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in head["headers"]]})
+        while True:
+            chunk = await next_chunk()
+            if chunk is _END:
+                if disconnected.is_set():
+                    return
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        # 途中で切断された場合はスレッド側の生成を止め、残りのチャンクを読み捨てる
+        disconnected.set()
+        disconnect_task.cancel()
+        while not future.done():
+            try:
+                await asyncio.wait_for(chunks.get(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+
+# ===================================
+# ASGI アプリ本体
+# ===================================
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.to_thread(startup)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_clients()
+            # 待機中のメッセージを書き切ってから接続を閉じる
+            await asyncio.to_thread(message_writer.stop)
+            close_all_connections()
+            _wsgi_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    match = AI_SPEAK_PATH.match(scope["path"])
+    headers = dict(scope.get("headers", []))
+    # Idempotency-Key 付きのリクエストは重複排除のある Flask 側で処理する
+    if match and scope["method"] == "POST" and b"idempotency-key" not in headers:
+        try:
+            data = json.loads(await read_body(receive) or b"null")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            return await send_json(send, {"success": False, "error": "リクエスト本文が不正です"}, 400)
+
+        # Flask 側と同じルート名で処理時間を記録する
+        route = "/a2a/groups/<int:group_id>/ai-speak" + (match.group(2) or "")
+        started_at = time.perf_counter()
+        recording_send = RecordingSend(send)
+        try:
+            group_id = int(match.group(1))
+            if match.group(2):
+                return await ai_speak_stream(group_id, data, receive, recording_send)
+            return await ai_speak(group_id, data, recording_send)
+        finally:
+            metrics.observe(HTTP_LATENCY, time.perf_counter() - started_at, route=route, method="POST")
+            metrics.inc(HTTP_REQUESTS, route=route, method="POST", status=str(recording_send.status))
+
+    match = EVENTS_PATH.match(scope["path"])
+    if match and scope["method"] == "GET":
+        route = "/a2a/groups/<int:group_id>/events"
+        started_at = time.perf_counter()
+        recording_send = RecordingSend(send)
+        try:
+            return await group_events(int(match.group(1)), scope, receive, recording_send)
+        finally:
+            metrics.observe(HTTP_LATENCY, time.perf_counter() - started_at, route=route, method="GET")
+            metrics.inc(HTTP_REQUESTS, route=route, method="GET", status=str(recording_send.status))
+
+    await call_flask(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("🔥 AI NEXUS Backend Server Starting (ASGI)...")
+    uvicorn.run(app, host="127.0.0.1", port=5000)
@@ -0,0 +1,295 @@
+"""
+負荷試験（ロードベンチマーク）
+
+指定した規模のDBを作成し、アプリをローカルのHTTPサーバーとして起動して、
+実際のエンドポイントへ並行にリクエストを送る。AIの発言はスタブプロバイダー
+（遅延・ゆらぎ・出力トークン数を指定可能）が返すため、ネットワークや
+APIキーは不要。エンドポイントごとの p50/p95/p99 とスループットをJSONで出力する。
+
+使い方（backend ディレクトリで実行）:
+    python benchmarks/load_bench.py --groups 10000 --messages 5000000 --db /tmp/bench.db \\
+        --concurrency 32 --duration 30 --latency-ms 800 --jitter-ms 200 --tokens 120
+
+--db に既存のファイルを指定すると投入を省略して再利用する。
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+from benchmarks.stub_provider import install_stub
+
+# 投入時に1回のexecutemanyで書き込む行数
+SEED_BATCH_SIZE = 50_000
+
+# グループあたりのプレイヤー（AI 2人・人間 1人）
+SEED_PLAYERS = (("AI-A", "ai"), ("AI-B", "ai"), ("ユーザー", "human"))
+
+# 投入するメッセージ本文の候補
+SEED_CONTENTS = [f"ベンチマーク用のメッセージです。話題{i}について意見を述べます。" * (1 + i % 4) for i in range(64)]
+
+# 計測できるエンドポイント
+ENDPOINTS = ("groups", "messages", "info", "ai_speak")
+
+# エンドポイントの既定の比率
+DEFAULT_MIX = "groups=1,messages=6,info=3,ai_speak=2"
+
+# 一括投入中は外しておくトリガー（投入後に作り直す）
+SEED_DISABLED_TRIGGERS = ("trg_messages_stats_insert", "trg_messages_fts_insert", "trg_messages_version_insert")
+
+
+def seed_database(groups: int, messages: int):
+    """グループ・プレイヤー・メッセージを一括投入
+
+    行ごとのトリガーを外して executemany で書き込み、最後に集計テーブル・
+    全文検索インデックス・更新バージョンをトリガーが動いた場合と同じ状態にする。
+    """
+    started = time.time()
+    with database.get_connection() as conn:
+        for trigger in SEED_DISABLED_TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+        conn.executemany("INSERT INTO chat_groups (id, name, description) VALUES (?, ?, ?)",
+                         ((g, f"bench-{g}", "load benchmark") for g in range(1, groups + 1)))
+        conn.executemany('''
+            INSERT INTO conversation_settings (group_id, max_messages, auto_save, context_length, turn_timeout_seconds)
+            VALUES (?, ?, ?, ?, ?)
+        ''', ((g, 100, 1, 10, 30) for g in range(1, groups + 1)))
+        conn.executemany('''
+            INSERT INTO players (id, group_id, name, type, ai_provider, ai_model, persona, display_order)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((g_index * len(SEED_PLAYERS) + p_index + 1, g_index + 1, name, player_type,
+               "stub" if player_type == "ai" else None, "stub-model" if player_type == "ai" else None,
+               "議論好きな参加者" if player_type == "ai" else None, p_index)
+              for g_index in range(groups) for p_index, (name, player_type) in enumerate(SEED_PLAYERS)))
+
+    # メッセージはグループに均等に、発言者を順に割り当てる
+    inserted = 0
+    while inserted < messages:
+        batch = []
+        for message_id in range(inserted + 1, min(messages, inserted + SEED_BATCH_SIZE) + 1):
+            g_index = message_id % groups
+            player_id = g_index * len(SEED_PLAYERS) + message_id % len(SEED_PLAYERS) + 1
+            batch.append((message_id, g_index + 1, player_id, SEED_CONTENTS[message_id % len(SEED_CONTENTS)]))
+        with database.get_connection() as conn:
+            conn.executemany("INSERT INTO messages (id, group_id, player_id, content) VALUES (?, ?, ?, ?)", batch)
+        inserted += len(batch)
+        print(f"📥 メッセージ投入: {inserted}/{messages}", file=sys.stderr)
+
+    database.rebuild_group_stats()
+    with database.get_connection() as conn:
+        cursor = conn.cursor()
+        database.create_triggers(cursor)
+        # 外部コンテンツのFTSは未登録の行があると更新・削除で壊れるため、必ず作り直す
+        if database.create_search_index(cursor):
+            cursor.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+        # メッセージのバージョントリガーを外していたぶんを加算する
+        cursor.execute('''
+            INSERT INTO group_versions (group_id, version)
+            SELECT * FROM (
+                SELECT group_id, COUNT(*) FROM messages GROUP BY group_id
+                UNION ALL
+                SELECT ?, COUNT(*) FROM messages
+            ) WHERE true
+            ON CONFLICT(group_id) DO UPDATE SET version = version + excluded.version
+        ''', (database.GROUPS_VERSION_KEY,))
+
+    print(f"✅ 投入完了: {time.time() - started:.1f}秒", file=sys.stderr)
+
+
+def load_targets() -> Dict[int, int]:
+    """グループID → 発言させるAIプレイヤーID"""
+    with database.get_connection() as conn:
+        rows = conn.execute('''
+            SELECT group_id, MIN(id) as player_id FROM players
+            WHERE type = 'ai' AND is_active = 1
+            GROUP BY group_id
+        ''').fetchall()
+    return {row["group_id"]: row["player_id"] for row in rows}
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """"groups=1,messages=6" 形式の比率を辞書にする"""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"不明なエンドポイントです: {name}（{', '.join(ENDPOINTS)}）")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: List[float], ratio: float) -> float:
+    """ソート済みの値から最近傍法でパーセンタイルを求める"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(ratio * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class LoadRunner:
+    """ワーカースレッドからエンドポイントへリクエストを送り、所要時間を記録する"""
+
+    def __init__(self, base_url: str, targets: Dict[int, int], weights: Dict[str, float], page_size: int):
+        self.base_url = base_url
+        self.targets = targets
+        self.group_ids = list(targets.keys())
+        self.endpoints = list(weights.keys())
+        self.weights = list(weights.values())
+        self.page_size = page_size
+        self.samples: Dict[str, List[float]] = {name: [] for name in self.endpoints}
+        self.errors: Dict[str, int] = {name: 0 for name in self.endpoints}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _request(self, endpoint: str) -> requests.Response:
+        session = self._session()
+        group_id = random.choice(self.group_ids)
+        if endpoint == "groups":
+            return session.get(f"{self.base_url}/a2a/groups")
+        if endpoint == "messages":
+            return session.get(f"{self.base_url}/a2a/groups/{group_id}/messages", params={"limit": self.page_size})
+        if endpoint == "info":
+            return session.get(f"{self.base_url}/a2a/groups/{group_id}/info")
+        if endpoint == "ai_speak":
+            return session.post(f"{self.base_url}/a2a/groups/{group_id}/ai-speak",
+                                json={"player_id": self.targets[group_id], "api_key": "bench"})
+        raise ValueError(f"不明なエンドポイントです: {endpoint}")
+
+    def _worker(self, deadline: float, remaining: List[int]):
+        while time.time() < deadline:
+            with self._lock:
+                if remaining[0] == 0:
+                    return
+                if remaining[0] > 0:
+                    remaining[0] -= 1
+            endpoint = random.choices(self.endpoints, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = self._request(endpoint).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.samples[endpoint].append(elapsed_ms)
+                if not ok:
+                    self.errors[endpoint] += 1
+
+    def run(self, concurrency: int, duration: float, max_requests: int) -> Dict:
+        remaining = [max_requests if max_requests else -1]
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(self._worker, started + duration, remaining)
+        elapsed = time.time() - started
+
+        endpoints = {}
+        for name, values in self.samples.items():
+            values = sorted(values)
+            endpoints[name] = {
+                "requests": len(values),
+                "errors": self.errors[name],
+                "throughput_rps": round(len(values) / elapsed, 2),
+                "mean_ms": round(sum(values) / len(values), 2) if values else 0.0,
+                "p50_ms": round(percentile(values, 0.50), 2),
+                "p95_ms": round(percentile(values, 0.95), 2),
+                "p99_ms": round(percentile(values, 0.99), 2),
+                "max_ms": round(values[-1], 2) if values else 0.0,
+            }
+        total = sum(len(values) for values in self.samples.values())
+        return {"elapsed_seconds": round(elapsed, 2), "total_requests": total,
+                "throughput_rps": round(total / elapsed, 2), "endpoints": endpoints}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="エンドポイントの負荷試験")
+    parser.add_argument("--db", help="使用するDBファイル（既存なら投入を省略。省略時は一時ファイル）")
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="計測時間（秒）")
+    parser.add_argument("--requests", type=int, default=0, help="総リクエスト数の上限（0 なら時間のみ）")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="エンドポイントの比率")
+    parser.add_argument("--page-size", type=int, default=50, help="メッセージ取得の件数")
+    parser.add_argument("--latency-ms", type=float, default=500, help="スタブの最初のトークンまでの遅延")
+    parser.add_argument("--jitter-ms", type=float, default=100, help="遅延のゆらぎ（±）")
+    parser.add_argument("--tokens", type=int, default=60, help="スタブの出力トークン数")
+    parser.add_argument("--token-interval-ms", type=float, default=0, help="トークンの生成間隔")
+    parser.add_argument("--output", help="レポートの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), "bench.db")
+    reuse = os.path.exists(db_path)
+    database.DB_PATH = db_path
+    # 標準出力はレポート専用にする
+    with contextlib.redirect_stdout(sys.stderr):
+        database.init_database()
+        if not reuse:
+            seed_database(args.groups, args.messages)
+
+    install_stub(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, tokens=args.tokens,
+                 token_interval_ms=args.token_interval_ms, record=False)
+
+    # DB_PATH を設定してから起動処理を行う（起動時の初期化が同じDBを使うように）
+    from werkzeug.serving import make_server
+    with contextlib.redirect_stdout(sys.stderr):
+        from app import app, startup
+        startup()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    runner = LoadRunner(base_url, load_targets(), weights, args.page_size)
+    try:
+        result = runner.run(args.concurrency, args.duration, args.requests)
+    finally:
+        server.shutdown()
+
+    with database.get_connection() as conn:
+        counts = conn.execute("SELECT (SELECT COUNT(*) FROM chat_groups), (SELECT COUNT(*) FROM messages)").fetchone()
+
+    report = {
+        "config": {
+            "db": db_path,
+            "groups": counts[0],
+            "messages": counts[1],
+            "concurrency": args.concurrency,
+            "mix": weights,
+            "page_size": args.page_size,
+            "fake_provider": {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms,
+                              "tokens": args.tokens, "token_interval_ms": args.token_interval_ms},
+        },
+        **result,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+プロンプト接頭部キャッシュのベンチマーク
+
+スタブプロバイダーに対して会話を回し、接頭部キャッシュのヒット率と、
+ターンごとにプロバイダー側でキャッシュ可能な（前回と同一の）先頭バイト数を出力する。
+
+使い方（backend ディレクトリで実行）:
+    python benchmarks/prefix_cache_bench.py --players 3 --turns 60
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database
+from benchmarks.stub_provider import install_stub
+
+
+def common_prefix_length(a: bytes, b: bytes) -> int:
+    """2つのバイト列の共通接頭部の長さ"""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def main():
+    parser = argparse.ArgumentParser(description="プロンプト接頭部キャッシュのベンチマーク")
+    parser.add_argument("--players", type=int, default=3)
+    parser.add_argument("--turns", type=int, default=60)
+    args = parser.parse_args()
+
+    # 使い捨てのDBで実行
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database.init_database()
+
+    from services.conversation import prepare_turn, run_turn
+    from services.prompt_cache import prefix_cache
+
+    stub = install_stub("なるほど、その観点は面白いですね。")
+
+    group_id = database.create_chat_group("bench", "prefix cache benchmark")
+    with database.get_connection() as conn:
+        conn.execute("UPDATE chat_groups SET rules = ? WHERE id = ?",
+                     ("・敬語で話すこと\n・1回の発言は200文字以内\n・他の参加者の意見に必ず触れること\n" * 5, group_id))
+    player_ids = [database.add_player(group_id, f"AI{i}", "ai", "stub", "stub-model",
+                                      f"あなたは議論好きな参加者{i}です。" * 10)
+                  for i in range(args.players)]
+
+    last_request = {}
+    cacheable_bytes = 0
+    total_bytes = 0
+    for turn_index in range(args.turns):
+        player_id = player_ids[turn_index % len(player_ids)]
+        run_turn(prepare_turn(group_id, player_id, "dummy-key"))
+
+        body = stub.requests[-1]
+        total_bytes += len(body)
+        if player_id in last_request:
+            cacheable_bytes += common_prefix_length(last_request[player_id], body)
+        last_request[player_id] = body
+
+    turns = args.turns
+    report = {
+        "turns": turns,
+        "players": args.players,
+        "prefix_cache": prefix_cache.stats(),
+        "avg_request_bytes": round(total_bytes / turns, 1),
+        "avg_cacheable_prefix_bytes": round(cacheable_bytes / turns, 1),
+        "cacheable_ratio": round(cacheable_bytes / total_bytes, 4) if total_bytes else 0.0,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
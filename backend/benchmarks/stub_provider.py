@@ -0,0 +1,95 @@
+"""
+ベンチマーク用のローカルスタブプロバイダー
+
+ネットワークに出ず、受け取ったリクエストを記録して固定の応答を返す。
+応答までの遅延・ゆらぎ・出力トークン数を指定すると、実プロバイダーに近い
+待ち時間を再現する（負荷試験用）。
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# backend をインポートパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.ai_gateway import ADAPTERS, ProviderAdapter, to_chat_prompt
+from services.rate_limiter import PROVIDER_LIMITS
+
+# 出力トークン数を指定した場合に応答を組み立てる断片
+FAKE_TOKENS = ("なるほど", "、", "その", "観点", "は", "面白い", "です", "ね", "。", "私", "も", "そう", "思い", "ます")
+
+
+class StubAdapter(ProviderAdapter):
+    """リクエストを記録するだけのアダプター
+
+    latency_ms:        最初のトークンまでの遅延
+    jitter_ms:         遅延に加える一様乱数の幅（±）
+    tokens:            出力トークン数（None なら reply をそのまま返す）
+    token_interval_ms: 2トークン目以降の生成間隔
+    """
+    name = "stub"
+
+    def __init__(self, reply: str = "了解しました。", latency_ms: float = 0, jitter_ms: float = 0,
+                 tokens: int = None, token_interval_ms: float = 0, record: bool = True):
+        super().__init__()
+        self.reply = reply
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens = tokens
+        self.token_interval_ms = token_interval_ms
+        self.record = record
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def create_client(self, api_key: str):
+        return None
+
+    def _record(self, model: str, prompt) -> None:
+        if not self.record:
+            return
+        chat = to_chat_prompt(prompt)
+        # OpenAI 形式で送った場合のリクエスト本文（system → messages の順）
+        body = json.dumps({"model": model,
+                           "messages": [{"role": "system", "content": chat["system"]}] + chat["messages"]},
+                          ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self.requests.append(body)
+
+    def _pieces(self):
+        if self.tokens is None:
+            return list(self.reply)
+        return [FAKE_TOKENS[i % len(FAKE_TOKENS)] for i in range(self.tokens)]
+
+    def _first_token_delay(self) -> float:
+        jitter = random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        return max(0.0, self.latency_ms + jitter) / 1000
+
+    def generate(self, api_key: str, model: str, prompt, timeout=None) -> str:
+        self._record(model, prompt)
+        pieces = self._pieces()
+        delay = self._first_token_delay() + max(0, len(pieces) - 1) * self.token_interval_ms / 1000
+        if delay:
+            time.sleep(delay)
+        return "".join(pieces)
+
+    def stream(self, api_key: str, model: str, prompt, timeout=None):
+        self._record(model, prompt)
+        delay = self._first_token_delay()
+        if delay:
+            time.sleep(delay)
+        for i, piece in enumerate(self._pieces()):
+            if i and self.token_interval_ms:
+                time.sleep(self.token_interval_ms / 1000)
+            yield piece
+
+
+def install_stub(reply: str = "了解しました。", **options) -> StubAdapter:
+    """スタブを "stub" プロバイダーとして登録（options は StubAdapter の引数）"""
+    adapter = StubAdapter(reply, **options)
+    ADAPTERS["stub"] = adapter
+    # 計測の邪魔にならないよう流量制御は実質無効にする
+    PROVIDER_LIMITS["stub"] = {"rate": 1e6, "burst": 1_000_000, "key_rate": 1e6, "key_burst": 1_000_000,
+                               "max_concurrent": 1024}
+    return adapter
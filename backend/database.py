@@ -1,16 +1,320 @@
 import sqlite3
 import os
+import json
+import threading
+import zlib
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import partial
+from typing import List, Dict, Iterable, Iterator, Optional
+
+from services.event_bus import message_bus
+from services.metrics import metrics, DB_QUERY_LATENCY
 
 # データベースファイルのパス
 DB_PATH = "a2a_chat.db"
 
-def get_connection():
-    """データベース接続を取得"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row  # 辞書形式で結果を取得
-    return conn
+# conversation_settings のデフォルト値（テーブル定義と合わせる）
+DEFAULT_CONVERSATION_SETTINGS = {
+    "max_messages": 100,
+    "auto_save": 1,
+    "context_length": 10,
+    "turn_timeout_seconds": 30,
+    # 0 はアーカイブしない。アーカイブしたメッセージは全文検索の対象外になるため、
+    # グループごとに明示的に設定したときだけ有効にする
+    "hot_message_limit": 0,
+}
+
+# 接続プールの設定
+POOL_MAX_IDLE = 16           # プールに保持する待機中接続の上限
+BUSY_TIMEOUT_MS = 5000       # ロック待ちの最大時間
+CACHED_STATEMENTS = 256      # 接続ごとにキャッシュするプリペアドステートメント数
+
+# シャーディング（グループごとにDBファイルを分け、書き込みロックをグループ間で共有しない）
+#   0 なら無効（DB_PATH の1ファイルにすべて保存）。
+#   1以上なら group_id % SHARD_COUNT 番のシャードにグループのデータを保存し、
+#   DB_PATH はグループIDを採番するカタログになる。運用開始後に変更しないこと。
+SHARD_COUNT = int(os.environ.get("A2A_SHARD_COUNT", "0"))
+SHARD_MAX_OPEN = 64          # 同時に開いておくシャードのプール数（超えたら使われていないものから閉じる）
+SHARD_POOL_MAX_IDLE = 4      # シャードごとに保持する待機中接続の上限
+# シャード内で採番するID（プレイヤー・メッセージなど）は シャード番号 << SHARD_ID_BITS から始め、
+# IDだけで所属シャードが分かるようにする（JavaScript で安全に扱える 2^53 未満に収まる）
+SHARD_ID_BITS = 40
+SHARDED_ID_TABLES = ("players", "messages", "conversation_settings", "messages_archive")
+
+class PooledConnection:
+    """プールから借りた接続のラッパー
+
+    close() では実接続を閉じずにプールへ返却する。with 文で使うと
+    正常終了時にコミット、例外時にロールバックしてから返却する。
+    入れ子の内側ではコミットせず、最も外側の with がまとめて確定する。
+    """
+
+    def __init__(self, pool: "ConnectionPool", conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def depth(self) -> int:
+        """この接続を借りている入れ子の深さ（1 なら最も外側）"""
+        return self._pool.depth()
+
+    def after_commit(self, callback):
+        """最も外側の with が正常に終わりコミットした後に callback を呼ぶ（ロールバック時は呼ばない）"""
+        self._pool.after_commit(callback)
+
+    def close(self):
+        """接続をプールへ返却（二重に呼んでも安全）"""
+        if not self._released:
+            self._released = True
+            self._pool.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 入れ子で借りている場合は最も外側の利用者がトランザクションを確定する
+        callbacks = []
+        if self._pool.depth() == 1:
+            if self._conn.in_transaction:
+                if exc_type is None:
+                    self._conn.commit()
+                else:
+                    self._conn.rollback()
+            callbacks = self._pool.take_after_commit()
+        self.close()
+        if exc_type is None:
+            for callback in callbacks:
+                callback()
+        return False
+
+class ConnectionPool:
+    """SQLite接続のプール
+
+    同じスレッド内での入れ子の取得には同じ接続を返すため、
+    ai_speak のように複数の関数をまたいでも接続は1本で済む。
+    """
+
+    def __init__(self, db_path: str, max_idle: int = POOL_MAX_IDLE):
+        self.db_path = db_path
+        self._max_idle = max_idle
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.created = 0
+        self.in_use = 0       # 接続を借りているスレッド数
+        self.closed = False   # LRU から外された（返却された接続は閉じる）
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS,
+                               timeout=BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row  # 辞書形式で結果を取得
+        # 読み取りが書き込みをブロックしないようWALを使う
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        self.created += 1
+        return conn
+
+    def depth(self) -> int:
+        """現在のスレッドで借りている入れ子の深さ"""
+        return getattr(self._local, "depth", 0)
+
+    def after_commit(self, callback):
+        """現在のスレッドのトランザクションが確定した後に呼ぶ処理を登録"""
+        self._local.after_commit.append(callback)
+
+    def take_after_commit(self) -> List:
+        """登録された処理を取り出す"""
+        callbacks, self._local.after_commit = self._local.after_commit, []
+        return callbacks
+
+    def acquire(self) -> PooledConnection:
+        """接続を借りる"""
+        if self.depth() > 0:
+            self._local.depth += 1
+            return PooledConnection(self, self._local.conn)
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self.in_use += 1
+        if conn is None:
+            conn = self._connect()
+
+        self._local.conn = conn
+        self._local.depth = 1
+        self._local.after_commit = []
+        return PooledConnection(self, conn)
+
+    def release(self):
+        """接続を返す（最も外側の返却でプールへ戻す）"""
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+
+        conn = self._local.conn
+        self._local.conn = None
+        self._local.after_commit = []
+        if conn.in_transaction:
+            # コミットされなかった変更は破棄する
+            conn.rollback()
+
+        with self._lock:
+            self.in_use -= 1
+            if not self.closed and len(self._idle) < self._max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def evict(self) -> bool:
+        """使われていなければ閉じて True を返す（シャードの LRU 用）"""
+        with self._lock:
+            if self.in_use:
+                return False
+            self.closed = True
+        self.close_all()
+        return True
+
+    def close_all(self):
+        """待機中の接続をすべて閉じる"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> Dict:
+        """プールの状態を取得"""
+        with self._lock:
+            return {"idle": len(self._idle), "max_idle": self._max_idle, "created": self.created}
+
+# DBファイルごとの接続プール（カタログ / 非シャード時の DB_PATH）
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+# シャードの接続プール（最近使った順。SHARD_MAX_OPEN を超えたら古いものから閉じる）
+_shard_pools: "OrderedDict[str, ConnectionPool]" = OrderedDict()
+
+def get_pool() -> ConnectionPool:
+    """現在の DB_PATH（シャード時はカタログ）に対応する接続プールを取得"""
+    pool = _pools.get(DB_PATH)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(DB_PATH, ConnectionPool(DB_PATH))
+    return pool
+
+def sharding_enabled() -> bool:
+    return SHARD_COUNT > 0
+
+def shard_path(index: int) -> str:
+    """シャード番号のDBファイルのパス（DB_PATH と同じディレクトリ）"""
+    base, ext = os.path.splitext(DB_PATH)
+    return f"{base}.shard{index:03d}{ext or '.db'}"
+
+def get_shard_pool(index: int) -> ConnectionPool:
+    """シャードの接続プールを取得（初回は開いてスキーマを作成）"""
+    if not 0 <= index < SHARD_COUNT:
+        # 範囲外の番号でシャードのファイルを作らない
+        raise ValueError(f"シャード番号が範囲外です: {index}")
+    path = shard_path(index)
+    with _pools_lock:
+        pool = _shard_pools.get(path)
+        if pool is not None:
+            _shard_pools.move_to_end(path)
+            return pool
+    
+    new_pool = ConnectionPool(path, SHARD_POOL_MAX_IDLE)
+    init_shard(new_pool, index)
+    with _pools_lock:
+        # 同時に開いた場合は先に登録されたほうを使う
+        pool = _shard_pools.setdefault(path, new_pool)
+        _shard_pools.move_to_end(path)
+        for old_path in list(_shard_pools)[:-1]:
+            if len(_shard_pools) <= SHARD_MAX_OPEN:
+                break
+            if _shard_pools[old_path].evict():
+                del _shard_pools[old_path]
+    if pool is not new_pool:
+        new_pool.close_all()
+    return pool
+
+def shard_index(group_id: int) -> int:
+    """グループのデータがあるシャードの番号（非シャード時は 0）"""
+    return group_id % SHARD_COUNT if sharding_enabled() else 0
+
+def get_group_pool(group_id: int) -> ConnectionPool:
+    """グループのデータ（プレイヤー・メッセージなど）があるDBのプール"""
+    if not sharding_enabled():
+        return get_pool()
+    return get_shard_pool(shard_index(group_id))
+
+def acquire_shard(index: int) -> PooledConnection:
+    """シャードの接続を借りる（借りる直前に LRU から外された場合は開き直す）"""
+    while True:
+        pool = get_shard_pool(index)
+        conn = pool.acquire()
+        if not pool.closed or conn.depth() > 1:
+            return conn
+        conn.close()
+
+def iter_data_pools() -> Iterator[ConnectionPool]:
+    """グループのデータがあるすべてのDBのプール（横断する集計・メンテナンス用）"""
+    if not sharding_enabled():
+        yield get_pool()
+        return
+    for index in range(SHARD_COUNT):
+        yield get_shard_pool(index)
+
+def get_connection(group_id: int = None) -> PooledConnection:
+    """データベース接続を取得
+
+    group_id を渡すとそのグループのデータがあるDB（シャード時はシャード）、
+    省略時は DB_PATH（シャード時はカタログ）の接続を返す。
+    with get_connection() as conn: の形で使うと、例外時も含めて必ず返却される。
+    """
+    if group_id is None or not sharding_enabled():
+        return get_pool().acquire()
+    return acquire_shard(shard_index(group_id))
+
+def row_shard_index(row_id: int) -> Optional[int]:
+    """プレイヤー・メッセージのIDからシャード番号を求める（どのシャードの範囲でもなければ None）"""
+    index = row_id >> SHARD_ID_BITS
+    return index if 0 <= index < SHARD_COUNT else None
+
+def get_connection_for_row(row_id: int) -> PooledConnection:
+    """プレイヤー・メッセージのIDから、その行があるDBの接続を取得
+
+    シャード時、どのシャードの範囲でもないID（クライアントが送った不正なIDなど）は
+    LookupError を送出する（存在しないシャードを作らない）。
+    """
+    if not sharding_enabled():
+        return get_pool().acquire()
+    index = row_shard_index(row_id)
+    if index is None:
+        raise LookupError(f"IDに対応するシャードがありません: {row_id}")
+    return acquire_shard(index)
+
+def close_all_connections():
+    """全プールの待機中接続を閉じる（終了時用）"""
+    with _pools_lock:
+        pools = list(_pools.values()) + list(_shard_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+def shard_stats() -> Dict:
+    """シャードの設定と開いているプールの状態"""
+    with _pools_lock:
+        pools = list(_shard_pools.values())
+    return {"shard_count": SHARD_COUNT, "open": len(pools), "max_open": SHARD_MAX_OPEN,
+            "in_use": sum(pool.in_use for pool in pools)}
+
+def timed_query(fn):
+    """関数の実行時間をメトリクス（関数名ごと）に記録するデコレーター"""
+    return metrics.timed(DB_QUERY_LATENCY, function=fn.__name__)(fn)
 
 def init_database():
     """データベースを初期化（テーブル作成のみ）"""
@@ -18,10 +322,21 @@ def init_database():
     cursor = conn.cursor()
     
     try:
+        # 新規作成時のみ、削除で空いたページを少しずつ返せるようにする
+        # （auto_vacuum はテーブル作成前にしか変更できない）
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+        
         # テーブル作成
         create_tables(cursor)
         # インデックス作成
         create_indexes(cursor)
+        # トリガー作成
+        create_triggers(cursor)
+        # 全文検索インデックス作成
+        create_search_index(cursor)
         
         conn.commit()
         print("✅ データベースが正常に初期化されました！")
@@ -31,6 +346,29 @@ def init_database():
     finally:
         conn.close()
 
+def init_shard(pool: ConnectionPool, index: int):
+    """シャードのDBを初期化（新規ファイルのときのみ。IDの採番をシャード番号の範囲から始める）"""
+    conn = pool.acquire()
+    try:
+        if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+            return
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        # 他のプロセスと同時に初期化しないよう書き込みロックを取ってから確認し直す
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            cursor = conn.cursor()
+            create_tables(cursor)
+            create_indexes(cursor)
+            create_triggers(cursor)
+            create_search_index(cursor)
+            cursor.executemany("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                               [(table, index << SHARD_ID_BITS) for table in SHARDED_ID_TABLES])
+        conn.commit()
+        print(f"✅ シャード {index} を初期化しました: {pool.db_path}")
+    finally:
+        conn.close()
+
 def create_tables(cursor):
     """全テーブルを作成"""
     
@@ -91,6 +429,7 @@ def create_tables(cursor):
             auto_save BOOLEAN DEFAULT 1,
             context_length INTEGER DEFAULT 10,
             turn_timeout_seconds INTEGER DEFAULT 30,
+            hot_message_limit INTEGER DEFAULT 0,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (group_id) REFERENCES chat_groups(id) ON DELETE CASCADE
         )
@@ -108,6 +447,43 @@ def create_tables(cursor):
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    
+    # 6. グループ集計テーブル（メッセージ数・最終発言をトリガーで維持）
+    #    message_count は messages の件数、archived_count はアーカイブ済みの件数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_stats (
+            group_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER,
+            last_activity DATETIME,
+            archived_count INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (group_id) REFERENCES chat_groups(id) ON DELETE CASCADE
+        )
+    ''')
+    
+    # 7. 更新バージョンテーブル（グループごとの変更回数をトリガーで加算。ETag に使う）
+    #    group_id = GROUPS_VERSION_KEY の行はグループ一覧全体のバージョン
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_versions (
+            group_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
+    # 8. メッセージアーカイブテーブル（古いメッセージを連続したIDの塊ごとに圧縮して保存）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            player_ids TEXT NOT NULL,
+            payload BLOB NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES chat_groups(id) ON DELETE CASCADE
+        )
+    ''')
 
 def create_indexes(cursor):
     """パフォーマンス向上用インデックスを作成"""
@@ -116,149 +492,1028 @@ def create_indexes(cursor):
         "CREATE INDEX IF NOT EXISTS idx_players_group ON players(group_id, display_order)",
         "CREATE INDEX IF NOT EXISTS idx_players_type ON players(type, ai_provider)",
         "CREATE INDEX IF NOT EXISTS idx_messages_group_time ON messages(group_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_group_id ON messages(group_id, id)",
         "CREATE INDEX IF NOT EXISTS idx_messages_player ON messages(player_id, timestamp)",
         "CREATE INDEX IF NOT EXISTS idx_messages_type ON messages(message_type)",
-        "CREATE INDEX IF NOT EXISTS idx_conversation_settings_group ON conversation_settings(group_id)"
+        "CREATE INDEX IF NOT EXISTS idx_conversation_settings_group ON conversation_settings(group_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_archive_group ON messages_archive(group_id, last_id)"
     ]
     
     for index_sql in indexes:
         cursor.execute(index_sql)
 
+def version_trigger(name: str, event: str, table: str, group_id_expr: str) -> str:
+    """変更時にグループとグループ一覧のバージョンを加算するトリガーのSQL"""
+    return f'''
+        CREATE TRIGGER IF NOT EXISTS {name}
+        AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO group_versions (group_id, version) VALUES ({group_id_expr}, 1), ({GROUPS_VERSION_KEY}, 1)
+            ON CONFLICT(group_id) DO UPDATE SET version = version + 1;
+        END
+    '''
+
+def create_triggers(cursor):
+    """集計テーブル・更新バージョンを同期するトリガーを作成"""
+    triggers = [
+        version_trigger("trg_messages_version_insert", "INSERT", "messages", "NEW.group_id"),
+        version_trigger("trg_messages_version_update", "UPDATE", "messages", "NEW.group_id"),
+        version_trigger("trg_messages_version_delete", "DELETE", "messages", "OLD.group_id"),
+        version_trigger("trg_players_version_insert", "INSERT", "players", "NEW.group_id"),
+        version_trigger("trg_players_version_update", "UPDATE", "players", "NEW.group_id"),
+        version_trigger("trg_players_version_delete", "DELETE", "players", "OLD.group_id"),
+        version_trigger("trg_chat_groups_version_insert", "INSERT", "chat_groups", "NEW.id"),
+        version_trigger("trg_chat_groups_version_update", "UPDATE", "chat_groups", "NEW.id"),
+        version_trigger("trg_chat_groups_version_delete", "DELETE", "chat_groups", "OLD.id"),
+        # メッセージ追加時: 件数を加算し、最終発言を更新
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_stats_insert
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO group_stats (group_id, message_count, last_message_id, last_activity)
+            VALUES (NEW.group_id, 1, NEW.id, NEW.timestamp)
+            ON CONFLICT(group_id) DO UPDATE SET
+                message_count = message_count + 1,
+                last_message_id = MAX(COALESCE(last_message_id, 0), NEW.id),
+                last_activity = CASE WHEN NEW.id >= COALESCE(last_message_id, 0)
+                                     THEN NEW.timestamp ELSE last_activity END;
+        END
+        ''',
+        # メッセージ削除時: 件数を減算し、最終発言を (group_id, id) インデックスで引き直す
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_stats_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE group_stats SET
+                message_count = message_count - 1,
+                last_message_id = (SELECT MAX(id) FROM messages WHERE group_id = OLD.group_id),
+                last_activity = (SELECT timestamp FROM messages WHERE group_id = OLD.group_id
+                                 ORDER BY id DESC LIMIT 1)
+            WHERE group_id = OLD.group_id;
+        END
+        ''',
+    ]
+    
+    for trigger_sql in triggers:
+        cursor.execute(trigger_sql)
+
+def create_search_index(cursor) -> bool:
+    """メッセージ全文検索用のFTS5インデックスと同期トリガーを作成
+
+    日本語を扱えるよう trigram トークナイザーを使う。FTS5 が使えない
+    SQLite では作成せず False を返す。
+    """
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content,
+                content='messages',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ 全文検索インデックスを作成できません: {e}")
+        return False
+    
+    triggers = [
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert
+        AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+        AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update
+        AFTER UPDATE OF content ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+        ''',
+    ]
+    
+    for trigger_sql in triggers:
+        cursor.execute(trigger_sql)
+    return True
+
+def backfill_search_index(batch_size: int = 10_000, up_to_id: int = None) -> int:
+    """既存メッセージを全文検索インデックスへバッチで登録
+
+    トリガー作成前のメッセージ（ID が up_to_id 以下）が対象。戻り値は登録件数。
+    """
+    with get_connection() as conn:
+        if up_to_id is None:
+            up_to_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    
+    total = 0
+    last_id = 0
+    while True:
+        # 1バッチごとにコミットし、書き込みロックを長く握らない
+        with get_connection() as conn:
+            rows = conn.execute('''
+                SELECT id, content FROM messages
+                WHERE id > ? AND id <= ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, up_to_id, batch_size)).fetchall()
+            if not rows:
+                break
+            conn.executemany("INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+                             [(row["id"], row["content"]) for row in rows])
+        last_id = rows[-1]["id"]
+        total += len(rows)
+        print(f"🔎 全文検索インデックス: {total}件 登録済み")
+    return total
+
+def search_index_exists() -> bool:
+    """全文検索インデックスがあるかチェック（シャード時はすべてのシャードにあるか）"""
+    for pool in iter_data_pools():
+        with pool.acquire() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+            ).fetchone()
+        if row is None:
+            return False
+    return True
+
+def rebuild_group_stats():
+    """集計テーブルをメッセージテーブルから作り直す（シャード時はシャードごと）"""
+    for pool in iter_data_pools():
+        _rebuild_group_stats(pool)
+
+def _rebuild_group_stats(pool: ConnectionPool):
+    with pool.acquire() as conn:
+        conn.execute("DELETE FROM group_stats")
+        conn.execute('''
+            INSERT INTO group_stats (group_id, message_count, last_message_id, last_activity)
+            SELECT agg.group_id, agg.message_count, agg.last_message_id, last.timestamp
+            FROM (
+                SELECT group_id, COUNT(*) as message_count, MAX(id) as last_message_id
+                FROM messages
+                GROUP BY group_id
+            ) agg
+            JOIN messages last ON last.id = agg.last_message_id
+        ''')
+        conn.execute('''
+            INSERT INTO group_stats (group_id, archived_count)
+            SELECT group_id, SUM(message_count) FROM messages_archive GROUP BY group_id
+            ON CONFLICT(group_id) DO UPDATE SET archived_count = excluded.archived_count
+        ''')
+
 # ===================================
 # CRUD操作関数
 # ===================================
 
+# group_versions でグループ一覧全体のバージョンを持つ行（グループIDは1から振られる）
+GROUPS_VERSION_KEY = 0
+
+def get_group_version(group_id: int = GROUPS_VERSION_KEY) -> int:
+    """グループ（省略時はグループ一覧）の更新バージョンを取得
+
+    メッセージ・プレイヤー・グループ情報が変わるたびに増える。主キー1件の参照のみ
+    （シャード時のグループ一覧は各シャードの値の合計）。
+    """
+    if group_id != GROUPS_VERSION_KEY:
+        pools = [get_group_pool(group_id)]
+    else:
+        pools = iter_data_pools()
+    version = 0
+    for pool in pools:
+        with pool.acquire() as conn:
+            row = conn.execute("SELECT version FROM group_versions WHERE group_id = ?", (group_id,)).fetchone()
+        version += row[0] if row else 0
+    return version
+
+# メッセージ取得用の共通SELECT（発言者情報を結合）
+MESSAGE_SELECT = '''
+    SELECT 
+        m.id,
+        m.group_id,
+        m.player_id,
+        m.content,
+        m.timestamp,
+        m.message_type,
+        p.name as speaker_name,
+        p.type as speaker_type,
+        p.ai_provider
+    FROM messages m
+    JOIN players p ON m.player_id = p.id
+'''
+
+@timed_query
 def get_chat_groups() -> List[Dict]:
-    """全チャットグループを取得"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, name, description, created_at, 
-               (SELECT COUNT(*) FROM messages WHERE group_id = cg.id) as message_count,
-               (SELECT MAX(timestamp) FROM messages WHERE group_id = cg.id) as last_activity
-        FROM chat_groups cg 
-        WHERE is_active = 1 
-        ORDER BY last_activity DESC NULLS LAST
-    ''')
+    """全チャットグループを取得（シャード時は各シャードの結果を最終発言順に併合）"""
+    groups = []
+    for pool in iter_data_pools():
+        with pool.acquire() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT cg.id, cg.name, cg.description, cg.created_at, 
+                       COALESCE(gs.message_count + gs.archived_count, 0) as message_count,
+                       gs.last_activity
+                FROM chat_groups cg 
+                LEFT JOIN group_stats gs ON gs.group_id = cg.id
+                WHERE cg.is_active = 1 
+                ORDER BY gs.last_activity DESC NULLS LAST
+            ''')
+            
+            groups.extend(dict(row) for row in cursor.fetchall())
     
-    groups = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    if sharding_enabled():
+        # 発言のないグループ（last_activity が NULL）は末尾
+        groups.sort(key=lambda group: group["last_activity"] or "", reverse=True)
     return groups
 
+def register_chat_group(name: str, description: str = "", rules: str = None) -> int:
+    """グループIDを採番して chat_groups に登録
+
+    シャード時はカタログに登録したうえで、シャードにも同じIDの行を作る
+    （シャード内の外部キー・結合はシャードの行を使う）。
+    """
+    with get_connection() as conn:
+        group_id = conn.execute('''
+            INSERT INTO chat_groups (name, description, rules) VALUES (?, ?, ?)
+        ''', (name, description, rules)).lastrowid
+    
+    if sharding_enabled():
+        with get_connection(group_id) as conn:
+            conn.execute('''
+                INSERT INTO chat_groups (id, name, description, rules) VALUES (?, ?, ?, ?)
+            ''', (group_id, name, description, rules))
+    return group_id
+
+@timed_query
 def create_chat_group(name: str, description: str = "") -> int:
     """新しいチャットグループを作成"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO chat_groups (name, description) VALUES (?, ?)
-    ''', (name, description))
-    
-    group_id = cursor.lastrowid
-    
-    # デフォルト設定を作成
-    cursor.execute('''
-        INSERT INTO conversation_settings (group_id) VALUES (?)
-    ''', (group_id,))
-    
-    conn.commit()
-    conn.close()
+    # 非シャード時はカタログとグループのデータが同じDBなので、1トランザクションにまとめる
+    with get_connection():
+        group_id = register_chat_group(name, description)
+        
+        # デフォルト設定を作成
+        with get_connection(group_id) as group_conn:
+            group_conn.execute('''
+                INSERT INTO conversation_settings (group_id, hot_message_limit) VALUES (?, ?)
+            ''', (group_id, DEFAULT_CONVERSATION_SETTINGS["hot_message_limit"]))
+        
     return group_id
 
+@timed_query
+def get_conversation_settings(group_id: int) -> Dict:
+    """グループの会話設定を取得（未設定の場合はデフォルト値）"""
+    with get_connection(group_id) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT max_messages, auto_save, context_length, turn_timeout_seconds, hot_message_limit
+            FROM conversation_settings
+            WHERE group_id = ?
+            ORDER BY id DESC
+            LIMIT 1
+        ''', (group_id,))
+        
+        row = cursor.fetchone()
+    
+    if row:
+        return dict(row)
+    return dict(DEFAULT_CONVERSATION_SETTINGS)
+
+@timed_query
 def get_players(group_id: int) -> List[Dict]:
     """指定グループのプレイヤー一覧を取得"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, name, type, ai_provider, ai_model, persona, display_order
-        FROM players 
-        WHERE group_id = ? AND is_active = 1
-        ORDER BY display_order, id
-    ''', (group_id,))
+    with get_connection(group_id) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, name, type, ai_provider, ai_model, persona, display_order
+            FROM players 
+            WHERE group_id = ? AND is_active = 1
+            ORDER BY display_order, id
+        ''', (group_id,))
+        
+        return [dict(row) for row in cursor.fetchall()]
+
+@timed_query
+def get_group_details(group_id: int) -> Optional[Dict]:
+    """グループの基本情報とプレイヤー数・メッセージ数・最新メッセージを取得（なければ None）"""
+    with get_connection(group_id) as conn:
+        cursor = conn.cursor()
+        
+        # グループ基本情報
+        cursor.execute('''
+            SELECT id, name, description, rules, created_at 
+            FROM chat_groups 
+            WHERE id = ? AND is_active = 1
+        ''', (group_id,))
+        
+        group = cursor.fetchone()
+        if not group:
+            return None
+        
+        # プレイヤー数とメッセージ数を取得
+        cursor.execute("SELECT COUNT(*) FROM players WHERE group_id = ? AND is_active = 1", (group_id,))
+        player_count = cursor.fetchone()[0]
+        
+        # メッセージ数と最新メッセージは集計テーブルから引く
+        cursor.execute('''
+            SELECT gs.message_count + gs.archived_count as message_count,
+                   m.content, m.timestamp, p.name as speaker_name
+            FROM group_stats gs
+            JOIN messages m ON m.id = gs.last_message_id
+            JOIN players p ON m.player_id = p.id
+            WHERE gs.group_id = ?
+        ''', (group_id,))
+        
+        stats = cursor.fetchone()
+        message_count = stats["message_count"] if stats else 0
+        last_message = {key: stats[key] for key in ("content", "timestamp", "speaker_name")} if stats else None
     
-    players = [dict(row) for row in cursor.fetchall()]
-    conn.close()
-    return players
+    group_info = dict(group)
+    group_info.update({
+        "player_count": player_count,
+        "message_count": message_count,
+        "last_message": last_message
+    })
+    return group_info
+
+@timed_query
+def get_group_snapshot(group_id: int, limit: int = 50) -> Optional[Dict]:
+    """グループ情報・プレイヤー・最新のメッセージページをまとめて取得（なければ None）
+
+    1本の接続の1つの読み取りトランザクションで読むため、すべて同じ時点の内容になる。
+    """
+    with get_connection(group_id) as conn:
+        # 入れ子の get_connection() も同じ接続・同じスナップショットを使う
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        
+        group = get_group_details(group_id)
+        if group is None:
+            return None
+        
+        return {
+            "group": group,
+            "players": get_players(group_id),
+            "messages": get_messages_page(group_id, limit),
+        }
 
+@timed_query
 def add_player(group_id: int, name: str, player_type: str, 
                ai_provider: str = None, ai_model: str = None, 
                persona: str = None) -> int:
     """プレイヤーを追加"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    with get_connection(group_id) as conn:
+        cursor = conn.cursor()
+        
+        # 表示順序を決定（最後に追加）
+        cursor.execute('''
+            SELECT COALESCE(MAX(display_order), 0) + 1 
+            FROM players WHERE group_id = ?
+        ''', (group_id,))
+        display_order = cursor.fetchone()[0]
+        
+        cursor.execute('''
+            INSERT INTO players (group_id, name, type, ai_provider, ai_model, persona, display_order)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (group_id, name, player_type, ai_provider, ai_model, persona, display_order))
+        
+    return cursor.lastrowid
+
+@timed_query
+def get_messages_page(group_id: int, limit: int = 50, before_id: int = None,
+                      after_id: int = None) -> Dict:
+    """グループの会話履歴をIDカーソルでページ取得
+
+    before_id 指定時はそれより古いページ、after_id 指定時はそれより新しい分を返す。
+    どちらもなければ最新のページを返す。messages は常に時系列（ID昇順）。
+    next_cursor は同じ方向に続きがある場合に次回渡すID（なければ None）。
+    messages に残っていない古いメッセージはアーカイブから読む（アーカイブ側の
+    IDは常に messages 側より小さい）。
+    """
+    params = [group_id]
+    where = "WHERE m.group_id = ?"
+    if before_id is not None:
+        where += " AND m.id < ?"
+        params.append(before_id)
+    if after_id is not None:
+        where += " AND m.id > ?"
+        params.append(after_id)
     
-    # 表示順序を決定（最後に追加）
-    cursor.execute('''
-        SELECT COALESCE(MAX(display_order), 0) + 1 
-        FROM players WHERE group_id = ?
-    ''', (group_id,))
-    display_order = cursor.fetchone()[0]
+    # after_id のときは古い順、それ以外は新しい順に辿る（1件多く取って続きの有無を判定）
+    order = "ASC" if after_id is not None and before_id is None else "DESC"
     
-    cursor.execute('''
-        INSERT INTO players (group_id, name, type, ai_provider, ai_model, persona, display_order)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (group_id, name, player_type, ai_provider, ai_model, persona, display_order))
+    with get_connection(group_id) as conn:
+        # アーカイブ処理と食い違わないよう、両方を同じスナップショットから読む
+        if conn.depth() == 1 and not conn.in_transaction:
+            conn.execute("BEGIN")
+        
+        messages = []
+        if order == "ASC":
+            messages = read_archived_messages(conn, group_id, after_id, before_id, limit + 1)
+        
+        if len(messages) <= limit:
+            params.append(limit + 1 - len(messages))
+            cursor = conn.cursor()
+            cursor.execute(MESSAGE_SELECT + f'''
+                {where}
+                ORDER BY m.id {order}
+                LIMIT ?
+            ''', params)
+            messages.extend(dict(row) for row in cursor.fetchall())
+        
+        if order == "DESC" and len(messages) <= limit:
+            upper_id = messages[-1]["id"] if messages else before_id
+            messages.extend(read_archived_messages(conn, group_id, after_id, upper_id,
+                                                   limit + 1 - len(messages), descending=True))
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = messages[-1]["id"] if has_more else None
+    
+    if order == "DESC":
+        messages.reverse()  # 時系列順に並び替え
     
-    player_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return player_id
+    return {"messages": messages, "next_cursor": next_cursor}
 
-def get_messages(group_id: int, limit: int = 50) -> List[Dict]:
-    """グループの会話履歴を取得"""
-    conn = get_connection()
-    cursor = conn.cursor()
+def read_archived_messages(conn, group_id: int, lower_id: int = None, upper_id: int = None,
+                           limit: int = 50, descending: bool = False) -> List[Dict]:
+    """アーカイブ済みのメッセージのうち lower_id < id < upper_id のものを最大 limit 件取得
+
+    戻り値の形式は MESSAGE_SELECT と同じ。必要な塊だけを順に展開する。
+    """
+    sql = "SELECT payload FROM messages_archive WHERE group_id = ?"
+    params = [group_id]
+    if lower_id is not None:
+        sql += " AND last_id > ?"
+        params.append(lower_id)
+    if upper_id is not None:
+        sql += " AND first_id < ?"
+        params.append(upper_id)
+    sql += f" ORDER BY last_id {'DESC' if descending else 'ASC'}"
     
-    cursor.execute('''
-        SELECT 
-            m.id,
-            m.content,
-            m.timestamp,
-            m.message_type,
-            p.name as speaker_name,
-            p.type as speaker_type,
-            p.ai_provider
-        FROM messages m
-        JOIN players p ON m.player_id = p.id
-        WHERE m.group_id = ?
-        ORDER BY m.timestamp DESC
-        LIMIT ?
-    ''', (group_id, limit))
-    
-    messages = [dict(row) for row in cursor.fetchall()]
-    messages.reverse()  # 時系列順に並び替え
-    conn.close()
+    messages = []
+    for (payload,) in conn.execute(sql, params):
+        rows = decode_archive_payload(payload)
+        if descending:
+            rows.reverse()
+        for row in rows:
+            if (lower_id is not None and row["id"] <= lower_id) or (upper_id is not None and row["id"] >= upper_id):
+                continue
+            messages.append({"id": row["id"], "group_id": group_id,
+                             **{key: row[key] for key in ARCHIVE_MESSAGE_FIELDS}})
+            if len(messages) >= limit:
+                return messages
     return messages
 
+def get_messages(group_id: int, limit: int = 50, before_id: int = None,
+                 after_id: int = None) -> List[Dict]:
+    """グループの会話履歴を取得"""
+    return get_messages_page(group_id, limit, before_id, after_id)["messages"]
+
+def publish_messages(messages: List[Dict]):
+    """追加したメッセージを購読中のクライアントへ配信"""
+    for message in messages:
+        message_bus.publish(message["group_id"], {"type": "message", "message": message})
+
+@timed_query
 def add_message(group_id: int, player_id: int, content: str, 
                 response_time_ms: int = None, tokens_used: int = None) -> int:
     """新しいメッセージを追加"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO messages (group_id, player_id, content, response_time_ms, tokens_used)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (group_id, player_id, content, response_time_ms, tokens_used))
+    with get_connection(group_id) as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO messages (group_id, player_id, content, response_time_ms, tokens_used)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (group_id, player_id, content, response_time_ms, tokens_used))
+        
+        message_id = cursor.lastrowid
+        
+        # 購読中のクライアントへ新しいメッセージを配信（呼び出し元のトランザクションが確定した後）
+        cursor.execute(MESSAGE_SELECT + " WHERE m.id = ?", (message_id,))
+        row = cursor.fetchone()
+        if row:
+            conn.after_commit(partial(publish_messages, [dict(row)]))
     
-    message_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
     return message_id
 
-def delete_chat_group(group_id: int):
-    """チャットグループを削除（論理削除）"""
-    conn = get_connection()
-    cursor = conn.cursor()
+@timed_query
+def add_messages(group_id: int, rows: List[Dict]) -> List[int]:
+    """複数のメッセージを1トランザクションで追加
+
+    rows の各要素は player_id, content と任意の response_time_ms, tokens_used を持つ。
+    戻り値は rows と同じ順序のメッセージID。
+    """
+    with get_connection(group_id) as conn:
+        cursor = conn.cursor()
+        
+        message_ids = []
+        for row in rows:
+            cursor.execute('''
+                INSERT INTO messages (group_id, player_id, content, response_time_ms, tokens_used)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (group_id, row["player_id"], row["content"],
+                  row.get("response_time_ms"), row.get("tokens_used")))
+            message_ids.append(cursor.lastrowid)
+        
+        # 購読中のクライアントへ新しいメッセージを配信（呼び出し元のトランザクションが確定した後）
+        published = []
+        for message_id in message_ids:
+            cursor.execute(MESSAGE_SELECT + " WHERE m.id = ?", (message_id,))
+            row = cursor.fetchone()
+            if row:
+                published.append(dict(row))
+        conn.after_commit(partial(publish_messages, published))
     
-    cursor.execute('''
-        UPDATE chat_groups SET is_active = 0 WHERE id = ?
+    return message_ids
+
+@timed_query
+def add_messages_bulk(rows: List[Dict]) -> List[int]:
+    """複数グループのメッセージを1トランザクションで追加（書き込みの遅延バッチ用）
+
+    rows の各要素は group_id と add_messages の行と同じキーを持つ。すべて同じDB
+    （シャード時は同じシャード）のグループであること。戻り値は rows と同じ順序のメッセージID。
+    """
+    with get_connection(rows[0]["group_id"]) as conn:
+        cursor = conn.cursor()
+        
+        message_ids = []
+        for row in rows:
+            cursor.execute('''
+                INSERT INTO messages (group_id, player_id, content, response_time_ms, tokens_used)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (row["group_id"], row["player_id"], row["content"],
+                  row.get("response_time_ms"), row.get("tokens_used")))
+            message_ids.append(cursor.lastrowid)
+        
+        # 購読中のクライアントへ新しいメッセージを配信（呼び出し元のトランザクションが確定した後）
+        cursor.execute(MESSAGE_SELECT + f" WHERE m.id IN ({', '.join('?' * len(message_ids))}) ORDER BY m.id",
+                       message_ids)
+        conn.after_commit(partial(publish_messages, [dict(row) for row in cursor.fetchall()]))
+    
+    return message_ids
+
+@timed_query
+def search_messages(query: str, group_id: int = None, player_id: int = None,
+                    limit: int = 20, cursor: Dict = None) -> Dict:
+    """メッセージを全文検索（関連度順）
+
+    cursor は前ページの next_cursor（{"rank", "id"}）。3文字未満の語は trigram で
+    引けないため、その場合は LIKE による検索になる。アーカイブ済みのメッセージは対象外。
+    シャード時の関連度はシャードごとに計算されるため、シャードをまたぐ順位は近似になる。
+    """
+    terms = query.split()
+    use_fts = all(len(term) >= 3 for term in terms)
+    
+    params = []
+    if use_fts:
+        # 各語をフレーズとして扱い AND で結合（FTS5 の演算子として解釈させない）
+        match = " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        sql = '''
+            SELECT m.id, m.group_id, m.player_id, m.content, m.timestamp,
+                   p.name as speaker_name, p.type as speaker_type, p.ai_provider,
+                   highlight(messages_fts, 0, '<mark>', '</mark>') as highlight,
+                   messages_fts.rank as rank
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN players p ON m.player_id = p.id
+            JOIN chat_groups cg ON cg.id = m.group_id
+            WHERE messages_fts MATCH ? AND cg.is_active = 1
+        '''
+        params.append(match)
+    else:
+        sql = '''
+            SELECT m.id, m.group_id, m.player_id, m.content, m.timestamp,
+                   p.name as speaker_name, p.type as speaker_type, p.ai_provider,
+                   NULL as highlight, 0.0 as rank
+            FROM messages m
+            JOIN players p ON m.player_id = p.id
+            JOIN chat_groups cg ON cg.id = m.group_id
+            WHERE cg.is_active = 1
+        '''
+        for term in terms:
+            sql += " AND m.content LIKE ? ESCAPE '\\'"
+            escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+    
+    if group_id is not None:
+        sql += " AND m.group_id = ?"
+        params.append(group_id)
+    if player_id is not None:
+        sql += " AND m.player_id = ?"
+        params.append(player_id)
+    if cursor:
+        rank_expr = "messages_fts.rank" if use_fts else "0.0"
+        sql += f" AND ({rank_expr} > ? OR ({rank_expr} = ? AND m.id < ?))"
+        params.extend([cursor["rank"], cursor["rank"], cursor["id"]])
+    
+    sql += " ORDER BY rank, m.id DESC LIMIT ?"
+    params.append(limit + 1)
+    
+    # グループ・プレイヤー指定時はそのDBだけ、それ以外はすべてのDBを検索して併合する
+    if group_id is not None:
+        pools = [get_group_pool(group_id)]
+    elif player_id is not None and sharding_enabled():
+        # どのシャードの範囲でもないプレイヤーIDなら該当なし
+        index = row_shard_index(player_id)
+        pools = [get_shard_pool(index)] if index is not None else []
+    else:
+        pools = iter_data_pools()
+    rows = []
+    for pool in pools:
+        with pool.acquire() as conn:
+            rows.extend(dict(row) for row in conn.execute(sql, params).fetchall())
+    if sharding_enabled():
+        rows.sort(key=lambda row: (row["rank"], -row["id"]))
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = {"rank": rows[-1]["rank"], "id": rows[-1]["id"]} if has_more else None
+    
+    if not use_fts:
+        # LIKE 検索ではハイライトを作らない
+        for row in rows:
+            row["highlight"] = None
+    
+    return {"results": rows, "next_cursor": next_cursor, "mode": "fts" if use_fts else "like"}
+
+# エクスポート形式のバージョン
+EXPORT_FORMAT_VERSION = 1
+
+# エクスポート・インポートで1回に読み書きする行数
+EXPORT_BATCH_SIZE = 5_000
+
+# エクスポートに含めるメッセージの列
+EXPORT_MESSAGE_COLUMNS = ("id", "player_id", "content", "message_type", "timestamp",
+                          "response_time_ms", "tokens_used", "is_edited", "parent_message_id")
+
+def iter_group_export(group_id: int) -> Iterator[Dict]:
+    """グループ・プレイヤー・全メッセージを1件ずつ返す（NDJSON エクスポート用）
+
+    1つの読み取りトランザクション内でカーソルを少しずつ読み進めるため、
+    メッセージ数に関係なくメモリ使用量は一定。グループがなければ何も返さない。
+    """
+    with get_connection(group_id) as conn:
+        # 全行を同じ時点のスナップショットから読む
+        conn.execute("BEGIN")
+        
+        group = conn.execute('''
+            SELECT id, name, description, rules, created_at, updated_at
+            FROM chat_groups WHERE id = ? AND is_active = 1
+        ''', (group_id,)).fetchone()
+        if not group:
+            return
+        
+        record = {"record": "group", "format_version": EXPORT_FORMAT_VERSION, **dict(group)}
+        settings = conn.execute('''
+            SELECT max_messages, auto_save, context_length, turn_timeout_seconds, hot_message_limit
+            FROM conversation_settings WHERE group_id = ? ORDER BY id DESC LIMIT 1
+        ''', (group_id,)).fetchone()
+        record["settings"] = dict(settings) if settings else None
+        yield record
+        
+        # 論理削除済みのプレイヤーも、過去の発言者として含める
+        for row in conn.execute('''
+            SELECT id, name, type, ai_provider, ai_model, persona, display_order, is_active, created_at
+            FROM players WHERE group_id = ? ORDER BY id
+        ''', (group_id,)):
+            yield {"record": "player", **dict(row)}
+        
+        # アーカイブ済みのメッセージ（messages 側より古い）から順に出力する
+        for (payload,) in conn.execute('''
+            SELECT payload FROM messages_archive WHERE group_id = ? ORDER BY last_id
+        ''', (group_id,)):
+            for row in decode_archive_payload(payload):
+                yield {"record": "message", **{key: row[key] for key in EXPORT_MESSAGE_COLUMNS}}
+        
+        cursor = conn.execute(f'''
+            SELECT {", ".join(EXPORT_MESSAGE_COLUMNS)}
+            FROM messages WHERE group_id = ? ORDER BY id
+        ''', (group_id,))
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield {"record": "message", **dict(row)}
+
+@timed_query
+def import_group(records: Iterable[Dict]) -> Dict:
+    """iter_group_export 形式のレコードから新しいグループを作成
+
+    すべて1トランザクションで取り込み、グループ・プレイヤー・メッセージのIDは
+    振り直す。メッセージIDの対応表は一時テーブルに置き、メモリに溜めない。
+    シャード時はカタログとシャードのトランザクションを両方とも最後まで開いておき、
+    途中で失敗したらどちらも取り消す。
+    """
+    records = iter(records)
+    record = next(records, None)
+    if record is None:
+        raise ValueError("groupレコードがありません")
+    if record.get("record") != "group":
+        raise ValueError(f"groupレコードより前に{record.get('record')}レコードがあります")
+    if record.get("format_version") != EXPORT_FORMAT_VERSION:
+        raise ValueError("未対応のエクスポート形式です")
+    
+    with get_connection() as catalog:
+        # 書き込みロックを先に取り、採番した連番のIDが他と衝突しないようにする
+        catalog.execute("BEGIN IMMEDIATE")
+        group_id = catalog.execute('''
+            INSERT INTO chat_groups (name, description, rules) VALUES (?, ?, ?)
+        ''', (record["name"], record.get("description"), record.get("rules"))).lastrowid
+        
+        with get_connection(group_id) as conn:
+            if sharding_enabled():
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute('''
+                    INSERT INTO chat_groups (id, name, description, rules) VALUES (?, ?, ?, ?)
+                ''', (group_id, record["name"], record.get("description"), record.get("rules")))
+            result = _import_group_rows(conn, group_id, record.get("settings"), records)
+    
+    return result
+
+def _import_group_rows(conn, group_id: int, settings: Optional[Dict], records: Iterator[Dict]) -> Dict:
+    """import_group の本体（設定・プレイヤー・メッセージを取り込む）"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_message_ids (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+    conn.execute("DELETE FROM import_message_ids")
+    
+    settings = settings or DEFAULT_CONVERSATION_SETTINGS
+    conn.execute('''
+        INSERT INTO conversation_settings (group_id, max_messages, auto_save, context_length,
+                                           turn_timeout_seconds, hot_message_limit)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (group_id, settings["max_messages"], settings["auto_save"],
+          settings["context_length"], settings["turn_timeout_seconds"],
+          settings.get("hot_message_limit", DEFAULT_CONVERSATION_SETTINGS["hot_message_limit"])))
+    
+    player_ids = {}
+    # シャード時は AUTOINCREMENT の採番位置（シャードのIDの範囲）より後ろから振る
+    next_message_id = conn.execute('''
+        SELECT MAX(COALESCE(MAX(id), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0)) + 1
+        FROM messages
+    ''').fetchone()[0]
+    message_count = 0
+    batch = []
+    
+    def flush():
+        conn.executemany('''
+            INSERT INTO messages (id, group_id, player_id, content, message_type, timestamp,
+                                  response_time_ms, tokens_used, is_edited, parent_message_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [row[1:] for row in batch])
+        conn.executemany("INSERT INTO import_message_ids (old_id, new_id) VALUES (?, ?)",
+                         [(row[0], row[1]) for row in batch])
+        batch.clear()
+    
+    for record in records:
+        record_type = record.get("record")
+        
+        if record_type == "group":
+            raise ValueError("groupレコードが複数あります")
+        
+        elif record_type == "player":
+            cursor = conn.execute('''
+                INSERT INTO players (group_id, name, type, ai_provider, ai_model, persona, display_order, is_active)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (group_id, record["name"], record["type"], record.get("ai_provider"),
+                  record.get("ai_model"), record.get("persona"), record.get("display_order", 0),
+                  record.get("is_active", 1)))
+            player_ids[record["id"]] = cursor.lastrowid
+        
+        elif record_type == "message":
+            if record.get("player_id") not in player_ids:
+                raise ValueError(f"メッセージ {record.get('id')} の発言者が見つかりません")
+            batch.append((record["id"], next_message_id, group_id, player_ids[record["player_id"]],
+                          record["content"], record.get("message_type", "normal"), record.get("timestamp"),
+                          record.get("response_time_ms"), record.get("tokens_used"),
+                          record.get("is_edited", 0), record.get("parent_message_id")))
+            next_message_id += 1
+            message_count += 1
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                flush()
+        
+        else:
+            raise ValueError(f"不明なレコード種別です: {record_type}")
+    
+    if batch:
+        flush()
+    
+    # 返信先のIDを新しいIDに付け替える
+    conn.execute('''
+        UPDATE messages
+        SET parent_message_id = (SELECT new_id FROM import_message_ids WHERE old_id = messages.parent_message_id)
+        WHERE group_id = ? AND parent_message_id IS NOT NULL
     ''', (group_id,))
+    conn.execute("DELETE FROM import_message_ids")
+    
+    return {"group_id": group_id, "players": len(player_ids), "messages": message_count}
+
+@timed_query
+def set_group_rules(group_id: int, rules: str) -> bool:
+    """グループのルールを更新（グループがなければ False）"""
+    with get_connection() as conn:
+        updated = conn.execute('''
+            UPDATE chat_groups 
+            SET rules = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND is_active = 1
+        ''', (rules, group_id)).rowcount
+    
+    if updated and sharding_enabled():
+        with get_connection(group_id) as conn:
+            conn.execute('''
+                UPDATE chat_groups SET rules = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (rules, group_id))
+    return updated > 0
+
+@timed_query
+def delete_chat_group(group_id: int):
+    """チャットグループを削除（論理削除）
+
+    行は purge_deleted_groups() がバックグラウンドで物理削除する。
+    """
+    with get_connection() as conn:
+        conn.execute('''
+            UPDATE chat_groups SET is_active = 0 WHERE id = ?
+        ''', (group_id,))
+    
+    # シャード側の行も合わせる（一覧はシャードの行から作る）
+    if sharding_enabled():
+        with get_connection(group_id) as conn:
+            conn.execute('''
+                UPDATE chat_groups SET is_active = 0 WHERE id = ?
+            ''', (group_id,))
+
+# ===================================
+# 保存期間（リテンション）
+# ===================================
+
+# アーカイブの1塊に入れるメッセージ数（messages に残す件数がこれ以上超えたら塊単位で移す）
+ARCHIVE_CHUNK_SIZE = 500
+
+# 1トランザクションでアーカイブする塊の数（書き込みロックを長く握らない）
+ARCHIVE_CHUNKS_PER_TRANSACTION = 20
+
+# zlib の圧縮レベル
+ARCHIVE_COMPRESSION_LEVEL = 6
+
+# アーカイブに保存する列（EXPORT_MESSAGE_COLUMNS と発言者の情報）
+ARCHIVE_COLUMNS = EXPORT_MESSAGE_COLUMNS + ("speaker_name", "speaker_type", "ai_provider")
+
+# アーカイブから読んだメッセージに含める列（MESSAGE_SELECT と同じ並び。id・group_id 以外）
+ARCHIVE_MESSAGE_FIELDS = ("player_id", "content", "timestamp", "message_type",
+                          "speaker_name", "speaker_type", "ai_provider")
+
+# 論理削除済みグループのメッセージを1回に物理削除する件数
+PURGE_BATCH_SIZE = 5_000
+
+def encode_archive_payload(rows: List[sqlite3.Row]) -> bytes:
+    """メッセージの行を列ごとの配列にして圧縮"""
+    data = [[row[column] for column in ARCHIVE_COLUMNS] for row in rows]
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                         ARCHIVE_COMPRESSION_LEVEL)
+
+def decode_archive_payload(payload: bytes) -> List[Dict]:
+    """encode_archive_payload の逆変換（ID昇順の辞書のリスト）"""
+    return [dict(zip(ARCHIVE_COLUMNS, values)) for values in json.loads(zlib.decompress(payload))]
+
+@timed_query
+def archive_group_messages(group_id: int, hot_limit: int) -> int:
+    """messages に hot_limit 件を超えて残っている古いメッセージをアーカイブへ移す
+
+    ARCHIVE_CHUNK_SIZE 件単位で移すため、messages には hot_limit 件以上
+    hot_limit + ARCHIVE_CHUNK_SIZE 件未満が残る。戻り値は移した件数。
+    """
+    archived = 0
+    while True:
+        with get_connection(group_id) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT message_count FROM group_stats WHERE group_id = ?", (group_id,)).fetchone()
+            chunks = min((row[0] - hot_limit) // ARCHIVE_CHUNK_SIZE if row else 0, ARCHIVE_CHUNKS_PER_TRANSACTION)
+            if chunks <= 0:
+                return archived
+            
+            rows = conn.execute(f'''
+                SELECT {", ".join("m." + column for column in EXPORT_MESSAGE_COLUMNS)},
+                       p.name as speaker_name, p.type as speaker_type, p.ai_provider
+                FROM messages m
+                LEFT JOIN players p ON m.player_id = p.id
+                WHERE m.group_id = ?
+                ORDER BY m.id
+                LIMIT ?
+            ''', (group_id, chunks * ARCHIVE_CHUNK_SIZE)).fetchall()
+            
+            conn.executemany('''
+                INSERT INTO messages_archive (group_id, first_id, last_id, message_count, player_ids, payload)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(group_id, chunk[0]["id"], chunk[-1]["id"], len(chunk),
+                   json.dumps(sorted({r["player_id"] for r in chunk})), encode_archive_payload(chunk))
+                  for chunk in (rows[i:i + ARCHIVE_CHUNK_SIZE] for i in range(0, len(rows), ARCHIVE_CHUNK_SIZE))])
+            conn.execute("DELETE FROM messages WHERE group_id = ? AND id <= ?", (group_id, rows[-1]["id"]))
+            conn.execute("UPDATE group_stats SET archived_count = archived_count + ? WHERE group_id = ?",
+                         (len(rows), group_id))
+        archived += len(rows)
+
+def enforce_retention() -> Dict:
+    """hot_message_limit を超えたグループの古いメッセージをアーカイブ
+
+    hot_message_limit が 0 以下のグループ（既定）はアーカイブしない。アーカイブした
+    メッセージは全文検索（messages_fts）から外れるため、検索より容量を優先するグループだけ設定する。
+    """
+    rows = []
+    for pool in iter_data_pools():
+        with pool.acquire() as conn:
+            rows += conn.execute('''
+                SELECT gs.group_id, gs.message_count,
+                       COALESCE((SELECT cs.hot_message_limit FROM conversation_settings cs
+                                 WHERE cs.group_id = gs.group_id ORDER BY cs.id DESC LIMIT 1), ?) as hot_limit
+                FROM group_stats gs
+                JOIN chat_groups cg ON cg.id = gs.group_id AND cg.is_active = 1
+                WHERE gs.message_count >= ?
+            ''', (DEFAULT_CONVERSATION_SETTINGS["hot_message_limit"], ARCHIVE_CHUNK_SIZE)).fetchall()
     
-    conn.commit()
-    conn.close()
+    groups = 0
+    archived = 0
+    for row in rows:
+        if row["hot_limit"] <= 0 or row["message_count"] - row["hot_limit"] < ARCHIVE_CHUNK_SIZE:
+            continue
+        archived += archive_group_messages(row["group_id"], row["hot_limit"])
+        groups += 1
+    return {"groups": groups, "messages": archived}
+
+@timed_query
+def purge_deleted_groups(batch_size: int = PURGE_BATCH_SIZE) -> Dict:
+    """論理削除済みのグループを物理削除
+
+    メッセージは batch_size 件ずつ別のトランザクションで消し、最後にグループ行を消す
+    （プレイヤー・設定・集計・アーカイブは外部キーの CASCADE で消える）。
+    シャード時はシャードの行を消してからカタログの行を消す。
+    """
+    with get_connection() as conn:
+        group_ids = [row[0] for row in conn.execute("SELECT id FROM chat_groups WHERE is_active = 0")]
+    
+    messages = 0
+    for group_id in group_ids:
+        while True:
+            with get_connection(group_id) as conn:
+                deleted = conn.execute('''
+                    DELETE FROM messages WHERE id IN (
+                        SELECT id FROM messages WHERE group_id = ? ORDER BY id LIMIT ?
+                    )
+                ''', (group_id, batch_size)).rowcount
+            messages += deleted
+            if deleted < batch_size:
+                break
+        if sharding_enabled():
+            with get_connection(group_id) as conn:
+                conn.execute("DELETE FROM chat_groups WHERE id = ?", (group_id,))
+        with get_connection() as conn:
+            conn.execute("DELETE FROM chat_groups WHERE id = ? AND is_active = 0", (group_id,))
+    return {"groups": len(group_ids), "messages": messages}
+
+@timed_query
+def purge_deleted_players() -> int:
+    """論理削除済みで、発言が残っていない（アーカイブにもない）プレイヤーを物理削除"""
+    purged = 0
+    for pool in iter_data_pools():
+        with pool.acquire() as conn:
+            purged += conn.execute('''
+                DELETE FROM players
+                WHERE is_active = 0
+                  AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.player_id = players.id)
+                  AND NOT EXISTS (SELECT 1 FROM messages_archive a, json_each(a.player_ids) j
+                                  WHERE a.group_id = players.group_id AND j.value = players.id)
+            ''').rowcount
+    return purged
+
+def incremental_vacuum(max_pages: int) -> int:
+    """空きページを最大 max_pages ページ分ファイルから返す（戻り値は返したページ数）
+
+    auto_vacuum = INCREMENTAL でないDB（マイグレーション前）では何もしない。
+    シャード時はカタログと各シャードでそれぞれ最大 max_pages ページ返す。
+    """
+    pools = [get_pool()]
+    if sharding_enabled():
+        pools += iter_data_pools()
+    
+    vacuumed = 0
+    for pool in pools:
+        with pool.acquire() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                continue
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute(f"PRAGMA incremental_vacuum({int(max_pages)})").fetchall()
+            vacuumed += before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return vacuumed
 
 # ===================================
 # ユーティリティ関数
@@ -268,35 +1523,62 @@ def database_exists() -> bool:
     """データベースファイルが存在するかチェック"""
     return os.path.exists(DB_PATH)
 
+@timed_query
 def get_database_info() -> Dict:
     """データベースの基本情報を取得"""
     if not database_exists():
         return {"exists": False}
     
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # 各テーブルの件数を取得
-    cursor.execute("SELECT COUNT(*) FROM chat_groups WHERE is_active = 1")
-    groups_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM players WHERE is_active = 1")
-    players_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM messages")
-    messages_count = cursor.fetchone()[0]
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        # 各テーブルの件数を取得
+        cursor.execute("SELECT COUNT(*) FROM chat_groups WHERE is_active = 1")
+        groups_count = cursor.fetchone()[0]
     
-    conn.close()
+    # プレイヤー・メッセージはシャード時は各シャードの合計
+    players_count = messages_count = archived_count = 0
+    for pool in iter_data_pools():
+        with pool.acquire() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("SELECT COUNT(*) FROM players WHERE is_active = 1")
+            players_count += cursor.fetchone()[0]
+            
+            cursor.execute("SELECT COALESCE(SUM(message_count), 0), COALESCE(SUM(archived_count), 0) FROM group_stats")
+            messages, archived = cursor.fetchone()
+            messages_count += messages
+            archived_count += archived
     
     return {
         "exists": True,
         "groups_count": groups_count,
         "players_count": players_count,
-        "messages_count": messages_count,
-        "db_path": DB_PATH
+        "messages_count": messages_count + archived_count,
+        "archived_messages_count": archived_count,
+        "db_path": DB_PATH,
+        "connection_pool": get_pool().stats(),
+        "shards": shard_stats()
     }
 
 if __name__ == "__main__":
+    import sys
+    
+    if "--rebuild-stats" in sys.argv:
+        # 集計テーブルの再構築
+        print("🔄 グループ集計を再構築しています...")
+        rebuild_group_stats()
+        print("✅ グループ集計を再構築しました")
+        sys.exit(0)
+    
+    if "--retention" in sys.argv:
+        # アーカイブ・物理削除・空き領域の返却を1回実行
+        print(f"🗄️ アーカイブ: {enforce_retention()}")
+        print(f"🧹 削除済みグループ: {purge_deleted_groups()}")
+        print(f"🧹 削除済みプレイヤー: {purge_deleted_players()}人")
+        print(f"📉 返却したページ: {incremental_vacuum(1_000_000)}")
+        sys.exit(0)
+    
     # 直接実行時はデータベースを初期化
     print("🚀 a2a データベースを初期化しています...")
     init_database()
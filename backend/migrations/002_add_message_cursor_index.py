@@ -0,0 +1,25 @@
+import sqlite3
+import os
+
+def migrate_database():
+    """メッセージのカーソルページング用インデックスを追加"""
+    db_path = "a2a_chat.db"
+    
+    if not os.path.exists(db_path):
+        print("❌ データベースファイルが見つかりません")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    # (group_id, id) で新旧どちらの方向にも定数時間でページングできるようにする
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_group_id ON messages(group_id, id)")
+    print("✅ idx_messages_group_id を作成しました")
+    
+    conn.commit()
+    conn.close()
+    
+    print("🎉 データベースマイグレーション完了！")
+
+if __name__ == "__main__":
+    migrate_database()
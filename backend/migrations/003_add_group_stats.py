@@ -0,0 +1,34 @@
+import sqlite3
+import os
+import sys
+
+# database.pyをインポートするためのパス追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import create_tables, create_triggers, rebuild_group_stats
+
+def migrate_database():
+    """グループ集計テーブルとトリガーを追加し、既存メッセージから集計する"""
+    db_path = "a2a_chat.db"
+    
+    if not os.path.exists(db_path):
+        print("❌ データベースファイルが見つかりません")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    # group_stats テーブル（IF NOT EXISTS なので既存テーブルはそのまま）
+    create_tables(cursor)
+    create_triggers(cursor)
+    print("✅ group_stats テーブルとトリガーを作成しました")
+    
+    conn.commit()
+    conn.close()
+    
+    rebuild_group_stats()
+    print("✅ 既存メッセージから集計を作成しました")
+    
+    print("🎉 データベースマイグレーション完了！")
+
+if __name__ == "__main__":
+    migrate_database()
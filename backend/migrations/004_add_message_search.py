@@ -0,0 +1,43 @@
+import sqlite3
+import os
+import sys
+
+# database.pyをインポートするためのパス追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import create_search_index, backfill_search_index
+
+def migrate_database():
+    """メッセージ全文検索（FTS5 trigram）を追加し、既存メッセージを登録する"""
+    db_path = "a2a_chat.db"
+    
+    if not os.path.exists(db_path):
+        print("❌ データベースファイルが見つかりません")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    if cursor.fetchone():
+        print("✅ 全文検索インデックスは既に存在します")
+        conn.close()
+        return
+    
+    # トリガー作成時点の最大IDまでをバックフィルの対象にする（以降はトリガーが登録）
+    cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+    up_to_id = cursor.fetchone()[0]
+    
+    if not create_search_index(cursor):
+        conn.close()
+        return
+    conn.commit()
+    conn.close()
+    print("✅ messages_fts テーブルとトリガーを作成しました")
+    
+    count = backfill_search_index(up_to_id=up_to_id)
+    print(f"✅ 既存メッセージ {count}件 を登録しました")
+    
+    print("🎉 データベースマイグレーション完了！")
+
+if __name__ == "__main__":
+    migrate_database()
@@ -0,0 +1,52 @@
+import sqlite3
+import os
+import sys
+
+# database.pyをインポートするためのパス追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import create_tables, create_indexes
+
+def add_column(cursor, table: str, column_sql: str):
+    """カラムを追加（既にあれば何もしない）"""
+    try:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column_sql}")
+        print(f"✅ {table} に {column_sql.split()[0]} を追加しました")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" not in str(e):
+            raise
+        print(f"✅ {table}.{column_sql.split()[0]} は既に存在します")
+
+def migrate_database():
+    """メッセージのアーカイブと incremental vacuum を使えるようにする"""
+    db_path = "a2a_chat.db"
+
+    if not os.path.exists(db_path):
+        print("❌ データベースファイルが見つかりません")
+        return
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    add_column(cursor, "conversation_settings", "hot_message_limit INTEGER DEFAULT 0")
+    add_column(cursor, "group_stats", "archived_count INTEGER NOT NULL DEFAULT 0")
+
+    # messages_archive テーブルとインデックス（IF NOT EXISTS なので既存のものはそのまま）
+    create_tables(cursor)
+    create_indexes(cursor)
+    conn.commit()
+    print("✅ messages_archive テーブルを作成しました")
+
+    # auto_vacuum の変更は VACUUM で全体を作り直したときに反映される
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] != 2:
+        print("🔄 auto_vacuum = INCREMENTAL に変更しています（DBの大きさに応じて時間がかかります）...")
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+        print("✅ auto_vacuum を変更しました")
+
+    conn.close()
+
+    print("🎉 データベースマイグレーション完了！")
+
+if __name__ == "__main__":
+    migrate_database()
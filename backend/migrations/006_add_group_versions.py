@@ -0,0 +1,32 @@
+import sqlite3
+import os
+import sys
+
+# database.pyをインポートするためのパス追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from database import create_tables, create_triggers
+
+def migrate_database():
+    """ETag 用の更新バージョンテーブルとトリガーを追加"""
+    db_path = "a2a_chat.db"
+    
+    if not os.path.exists(db_path):
+        print("❌ データベースファイルが見つかりません")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    # group_versions テーブル（IF NOT EXISTS なので既存テーブルはそのまま）
+    # 既存のグループはバージョン 0 から始まる
+    create_tables(cursor)
+    create_triggers(cursor)
+    print("✅ group_versions テーブルとトリガーを作成しました")
+    
+    conn.commit()
+    conn.close()
+    
+    print("🎉 データベースマイグレーション完了！")
+
+if __name__ == "__main__":
+    migrate_database()
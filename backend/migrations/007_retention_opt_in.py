@@ -0,0 +1,39 @@
+import sqlite3
+import os
+import sys
+
+# database.pyをインポートするためのパス追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 005 で設定していた hot_message_limit の既定値
+OLD_DEFAULT_HOT_MESSAGE_LIMIT = 1000
+
+def migrate_database():
+    """メッセージのアーカイブを既定で無効にする（グループごとに設定したときだけ有効）
+
+    005 では既定値 1000 で全グループのアーカイブが有効になり、古いメッセージが
+    全文検索から外れていた。hot_message_limit を変更するAPIはないため、1000 の行は
+    既定値のままとみなして 0 に戻す。アーカイブ済みのメッセージはそのまま残る
+    （メッセージ一覧・エクスポートからは引き続き読める）。
+    """
+    db_path = "a2a_chat.db"
+    
+    if not os.path.exists(db_path):
+        print("❌ データベースファイルが見つかりません")
+        return
+    
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        UPDATE conversation_settings SET hot_message_limit = 0 WHERE hot_message_limit = ?
+    ''', (OLD_DEFAULT_HOT_MESSAGE_LIMIT,))
+    print(f"✅ {cursor.rowcount}グループのアーカイブを無効にしました")
+    
+    conn.commit()
+    conn.close()
+    
+    print("🎉 データベースマイグレーション完了！")
+
+if __name__ == "__main__":
+    migrate_database()
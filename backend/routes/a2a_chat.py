@@ -1,14 +1,98 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, make_response, Response, stream_with_context
 import sys
 import os
+import json
+import base64
+import io
+import queue
+import time
 
 # database.pyをインポートするためのパス追加
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from database import *
+from services.ai_gateway import get_pool_stats, get_limiter_stats
+from services.event_bus import message_bus, OVERFLOW_EVENT
+from services.conversation import TurnError, prepare_turn, run_turn, run_round, stream_turn
+from services.conversation_runner import conversation_runner
+from services.context_builder import context_builder
+from services.prompt_cache import prefix_cache
+from services.idempotency import idempotency_store, IdempotencyConflict
+from services.response_cache import response_cache
+from services.retention import retention_worker
+from services.message_writer import message_writer
 
 # Blueprint作成
 a2a_bp = Blueprint("a2a", __name__)
 
+# メッセージ取得1ページあたりの最大件数
+MAX_MESSAGE_PAGE_SIZE = 1000
+
+# fields= で指定できる列
+MESSAGE_FIELDS = ("id", "group_id", "player_id", "content", "timestamp", "message_type",
+                  "speaker_name", "speaker_type", "ai_provider")
+GROUP_FIELDS = ("id", "name", "description", "created_at", "message_count", "last_activity")
+
+# 検索結果1ページあたりの最大件数
+MAX_SEARCH_PAGE_SIZE = 100
+
+# イベント配信で接続維持コメントを送る間隔（秒）
+EVENT_KEEPALIVE_SECONDS = 15
+
+# インポート時に本文を読み込むバッファサイズ（バイト）
+IMPORT_READ_BUFFER_BYTES = 1 << 16
+
+def encode_cursor(cursor: dict) -> str:
+    """ページングカーソルをURLに載せられる文字列にする"""
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode("ascii")
+
+def decode_cursor(token: str) -> dict:
+    """encode_cursor の逆変換"""
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return {"rank": float(cursor["rank"]), "id": int(cursor["id"])}
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def format_sse(event: str, data, event_id=None) -> str:
+    """Server-Sent Events 形式の1イベントを作成"""
+    payload = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    if event_id is not None:
+        payload = f"id: {event_id}\n" + payload
+    return payload
+
+def parse_fields(allowed: tuple):
+    """?fields=id,content を検証して列名のタプルにする（指定がなければ None）"""
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+    unknown = [name for name in fields if name not in allowed]
+    if not fields or unknown:
+        raise ValueError(f"fieldsには {', '.join(allowed)} を指定してください")
+    return fields
+
+def select_fields(rows: list, fields) -> list:
+    """各行を指定された列だけにする（fields が None ならそのまま）"""
+    if fields is None:
+        return rows
+    return [{name: row[name] for name in fields} for row in rows]
+
+def conditional_response(etag: str, build):
+    """If-None-Match が etag と一致すれば本文なしの 304、そうでなければ build() の応答を返す
+
+    etag は get_group_version() から作るため、一致した場合は本体のクエリを実行しない。
+    ブラウザが毎回再検証するよう Cache-Control: no-cache を付ける。
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 # ===================================
 # チャットグループ関連API
 # ===================================
@@ -17,8 +101,14 @@ a2a_bp = Blueprint("a2a", __name__)
 def get_groups():
     """全チャットグループ一覧を取得"""
     try:
-        groups = get_chat_groups()
-        return jsonify({"success": True, "groups": groups})
+        try:
+            fields = parse_fields(GROUP_FIELDS)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        
+        etag = f"groups-{get_group_version()}"
+        return conditional_response(
+            etag, lambda: jsonify({"success": True, "groups": select_fields(get_chat_groups(), fields)}))
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -43,6 +133,7 @@ def delete_group(group_id):
     """チャットグループを削除"""
     try:
         delete_chat_group(group_id)
+        prefix_cache.invalidate_group(group_id)
         return jsonify({"success": True, "message": "グループが削除されました"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -55,8 +146,8 @@ def delete_group(group_id):
 def get_group_players(group_id):
     """指定グループのプレイヤー一覧を取得"""
     try:
-        players = get_players(group_id)
-        return jsonify({"success": True, "players": players})
+        etag = f"players-{group_id}-{get_group_version(group_id)}"
+        return conditional_response(etag, lambda: jsonify({"success": True, "players": get_players(group_id)}))
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -105,22 +196,26 @@ def update_player(player_id):
         if player_type == "ai" and not ai_provider:
             return jsonify({"success": False, "error": "AIプレイヤーにはプロバイダーが必須です"}), 400
         
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE players 
-            SET name = ?, type = ?, ai_provider = ?, ai_model = ?, persona = ?
-            WHERE id = ? AND is_active = 1
-        ''', (name, player_type, ai_provider, ai_model, persona, player_id))
-        
-        if cursor.rowcount == 0:
-            return jsonify({"success": False, "error": "プレイヤーが見つかりません"}), 404
+        with get_connection_for_row(player_id) as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE players 
+                SET name = ?, type = ?, ai_provider = ?, ai_model = ?, persona = ?
+                WHERE id = ? AND is_active = 1
+            ''', (name, player_type, ai_provider, ai_model, persona, player_id))
+            
+            if cursor.rowcount == 0:
+                return jsonify({"success": False, "error": "プレイヤーが見つかりません"}), 404
         
-        conn.commit()
-        conn.close()
+        # 発言者名・ペルソナはキャッシュに埋め込まれているため破棄する
+        context_builder.invalidate()
+        prefix_cache.invalidate_player(player_id)
         
         return jsonify({"success": True, "message": "プレイヤーが更新されました"})
+    except LookupError:
+        # どのシャードの範囲でもないID
+        return jsonify({"success": False, "error": "プレイヤーが見つかりません"}), 404
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -128,14 +223,15 @@ def update_player(player_id):
 def delete_player(player_id):
     """プレイヤーを削除"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
+        with get_connection_for_row(player_id) as conn:
+            conn.execute("UPDATE players SET is_active = 0 WHERE id = ?", (player_id,))
         
-        cursor.execute("UPDATE players SET is_active = 0 WHERE id = ?", (player_id,))
-        conn.commit()
-        conn.close()
+        prefix_cache.invalidate_player(player_id)
         
         return jsonify({"success": True, "message": "プレイヤーが削除されました"})
+    except LookupError:
+        # どのシャードの範囲でもないID
+        return jsonify({"success": False, "error": "プレイヤーが見つかりません"}), 404
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -148,8 +244,24 @@ def get_group_messages(group_id):
     """指定グループの会話履歴を取得"""
     try:
         limit = request.args.get("limit", 50, type=int)
-        messages = get_messages(group_id, limit)
-        return jsonify({"success": True, "messages": messages})
+        before_id = request.args.get("before_id", type=int)
+        after_id = request.args.get("after_id", type=int)
+        
+        if limit < 1 or limit > MAX_MESSAGE_PAGE_SIZE:
+            return jsonify({"success": False, "error": f"limitは1〜{MAX_MESSAGE_PAGE_SIZE}で指定してください"}), 400
+        
+        try:
+            fields = parse_fields(MESSAGE_FIELDS)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        
+        def build():
+            page = get_messages_page(group_id, limit, before_id, after_id)
+            return jsonify({"success": True, "messages": select_fields(page["messages"], fields),
+                            "next_cursor": page["next_cursor"]})
+        
+        etag = f"messages-{group_id}-{get_group_version(group_id)}"
+        return conditional_response(etag, build)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -169,11 +281,140 @@ def add_group_message(group_id):
         if not content:
             return jsonify({"success": False, "error": "メッセージ内容は必須です"}), 400
         
-        message_id = add_message(group_id, player_id, content, response_time_ms, tokens_used)
+        message_id = message_writer.add_message(group_id, player_id, content, response_time_ms, tokens_used)
         return jsonify({"success": True, "message_id": message_id, "message": "メッセージが追加されました"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@a2a_bp.route("/groups/<int:group_id>/events", methods=["GET"])
+def group_events(group_id):
+    """グループの新着メッセージをServer-Sent Eventsで配信"""
+    # 再接続時は Last-Event-ID（またはafter_id）以降の差分から送る
+    after_id = request.headers.get("Last-Event-ID", type=int)
+    if after_id is None:
+        after_id = request.args.get("after_id", type=int)
+    
+    # 差分取得と購読開始の間に追加された分を取りこぼさないよう、先に購読する
+    subscription = message_bus.subscribe(group_id)
+    
+    def generate():
+        last_id = after_id or 0
+        try:
+            # 再接続時の差分をページ単位で送る
+            cursor_id = after_id
+            while cursor_id is not None:
+                page = get_messages_page(group_id, MAX_MESSAGE_PAGE_SIZE, after_id=cursor_id)
+                for message in page["messages"]:
+                    last_id = message["id"]
+                    yield format_sse("message", message, event_id=message["id"])
+                cursor_id = page["next_cursor"]
+            
+            while True:
+                try:
+                    event = subscription.get(timeout=EVENT_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # 接続維持用のコメント行
+                    yield ": keepalive\n\n"
+                    continue
+                
+                if event is OVERFLOW_EVENT:
+                    # 取りこぼしが出たので一度切断し、クライアントに再接続させる
+                    return
+                
+                message = event["message"]
+                if message["id"] <= last_id:
+                    continue
+                last_id = message["id"]
+                yield format_sse("message", message, event_id=message["id"])
+        finally:
+            message_bus.unsubscribe(group_id, subscription)
+    
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ===================================
+# 検索API
+# ===================================
+
+@a2a_bp.route("/search", methods=["GET"])
+def search():
+    """メッセージを全文検索"""
+    try:
+        query = request.args.get("q", "").strip()
+        group_id = request.args.get("group_id", type=int)
+        player_id = request.args.get("player_id", type=int)
+        limit = request.args.get("limit", 20, type=int)
+        cursor_token = request.args.get("cursor")
+        
+        if not query:
+            return jsonify({"success": False, "error": "検索語は必須です"}), 400
+        
+        if limit < 1 or limit > MAX_SEARCH_PAGE_SIZE:
+            return jsonify({"success": False, "error": f"limitは1〜{MAX_SEARCH_PAGE_SIZE}で指定してください"}), 400
+        
+        if not search_index_exists():
+            return jsonify({"success": False, "error": "全文検索インデックスがありません"}), 501
+        
+        try:
+            cursor = decode_cursor(cursor_token) if cursor_token else None
+        except ValueError:
+            return jsonify({"success": False, "error": "無効なカーソルです"}), 400
+        
+        page = search_messages(query, group_id, player_id, limit, cursor)
+        return jsonify({
+            "success": True,
+            "results": page["results"],
+            "mode": page["mode"],
+            "next_cursor": encode_cursor(page["next_cursor"]) if page["next_cursor"] else None
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# ===================================
+# エクスポート・インポート
+# ===================================
+
+@a2a_bp.route("/groups/<int:group_id>/export", methods=["GET"])
+def export_group(group_id):
+    """グループ・プレイヤー・全メッセージをNDJSON（1行1レコード）で配信"""
+    try:
+        records = iter_group_export(group_id)
+        first = next(records, None)
+        if first is None:
+            return jsonify({"success": False, "error": "グループが見つかりません"}), 404
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    
+    def generate():
+        yield json.dumps(first, ensure_ascii=False) + "\n"
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"Content-Disposition": f'attachment; filename="group-{group_id}.ndjson"'})
+
+@a2a_bp.route("/import", methods=["POST"])
+def import_group_ndjson():
+    """エクスポートしたNDJSONから新しいグループを作成"""
+    def read_records():
+        # 本文は1行ずつ読み、全体をメモリに載せない
+        for line_number, line in enumerate(io.BufferedReader(request.stream, IMPORT_READ_BUFFER_BYTES), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                raise ValueError(f"{line_number}行目がJSONとして不正です")
+    
+    try:
+        result = import_group(read_records())
+        return jsonify({"success": True, **result}), 201
+    except (ValueError, KeyError) as e:
+        return jsonify({"success": False, "error": f"インポートできません: {e}"}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
 # ===================================
 # AI会話機能
 # ===================================
@@ -183,116 +424,123 @@ def ai_speak(group_id):
     """指定のAIプレイヤーに発言させる"""
     try:
         data = request.get_json()
-        player_id = data.get("player_id")
-        additional_prompt = data.get("additional_prompt", "")
-        
-        if not player_id:
-            return jsonify({"success": False, "error": "プレイヤーIDは必須です"}), 400
-        
-        # プレイヤー情報を取得
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT name, type, ai_provider, ai_model, persona 
-            FROM players WHERE id = ? AND is_active = 1
-        ''', (player_id,))
-        
-        player = cursor.fetchone()
-        if not player:
-            return jsonify({"success": False, "error": "プレイヤーが見つかりません"}), 404
-        
-        if player["type"] != "ai":
-            return jsonify({"success": False, "error": "このプレイヤーはAIではありません"}), 400
-        
-        # 会話履歴を取得（コンテキスト用）
-        recent_messages = get_messages(group_id, 10)
-        
-        # コンテキストを構築
-        context = "これまでの会話:\n"
-        for msg in recent_messages:
-            context += f"{msg['speaker_name']}: {msg['content']}\n"
-        
-        # グループルールを取得
-        cursor.execute('SELECT rules FROM chat_groups WHERE id = ?', (group_id,))
-        group_rules_row = cursor.fetchone()
-        group_rules = group_rules_row['rules'] if group_rules_row and group_rules_row['rules'] else ""
         
-        # ペルソナとコンテキストを組み合わせたプロンプトを作成
-        full_prompt = ""
-        
-        # グループルールを最優先で追加
-        if group_rules:
-            full_prompt += f"【重要】このグループの絶対ルール:\n{group_rules}\n\n"
-        
-        if player["persona"]:
-            full_prompt += f"あなたの役割: {player['persona']}\n\n"
-        
-        full_prompt += context
-        
-        if additional_prompt:
-            full_prompt += f"\n指示: {additional_prompt}"
-        
-        full_prompt += f"\n\n{player['name']}として返答してください:"
-        
-        # AI APIを呼び出し（既存のAPIを活用）
-        import requests
-        import time
+        def speak():
+            try:
+                turn = prepare_turn(group_id, data.get("player_id"), data.get("api_key"),
+                                    data.get("additional_prompt", ""))
+                
+                # AI APIを呼び出し（プロバイダーゲートウェイを直接利用）
+                result = run_turn(turn)
+                return {"success": True, **result}, 200
+            except TurnError as e:
+                return {"success": False, "error": str(e)}, e.status_code
+        
+        # Idempotency-Key があれば、再送時に二重に発言させない
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key:
+            body, status = speak()
+            return jsonify(body), status
+        
+        fingerprint = json.dumps([data.get("player_id"), data.get("additional_prompt", "")], ensure_ascii=False)
+        body, status, replayed = idempotency_store.run(f"ai-speak:{group_id}:{idempotency_key}", fingerprint, speak)
+        response = jsonify(body)
+        response.status_code = status
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return response
+    except IdempotencyConflict as e:
+        return jsonify({"success": False, "error": str(e)}), 422
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@a2a_bp.route("/groups/<int:group_id>/round", methods=["POST"])
+def ai_round(group_id):
+    """グループの全AIプレイヤーを順番に（または並列に）発言させる"""
+    try:
+        data = request.get_json() or {}
+        mode = data.get("mode", "sequential")
+        api_keys = data.get("api_keys") or {}
         
         start_time = time.time()
+        results = run_round(group_id, api_keys, mode, data.get("additional_prompt", ""))
+        elapsed_ms = int((time.time() - start_time) * 1000)
         
-        # プロバイダーに応じてAPI呼び出し
-        api_url = "http://127.0.0.1:5000"
-        
-        if player["ai_provider"] == "gemini":
-            # APIキーを取得（実際の実装では暗号化されたキーを取得）
-            # ここでは簡単のため、フロントエンドから渡されると仮定
-            api_key = data.get("api_key")
-            if not api_key:
-                return jsonify({"success": False, "error": "APIキーが必要です"}), 400
-            
-            response = requests.post(f"{api_url}/gemini", json={
-                "gemini_api_key": api_key,
-                "prompt": full_prompt,
-                "gemini_model": player["ai_model"]
-            })
-        
-        elif player["ai_provider"] == "chatGPT":
-            api_key = data.get("api_key")
-            if not api_key:
-                return jsonify({"success": False, "error": "APIキーが必要です"}), 400
-            
-            response = requests.post(f"{api_url}/chatgpt", json={
-                "chatgpt_api_key": api_key,
-                "prompt": full_prompt,
-                "chatgpt_model": player["ai_model"]
-            })
-        
-        else:
-            return jsonify({"success": False, "error": "未対応のAIプロバイダーです"}), 400
-        
-        end_time = time.time()
-        response_time_ms = int((end_time - start_time) * 1000)
-        
-        if response.status_code == 200:
-            ai_response = response.json()["result"]
-            
-            # メッセージをデータベースに保存
-            message_id = add_message(group_id, player_id, ai_response, response_time_ms)
-            
-            conn.close()
-            
-            return jsonify({
-                "success": True, 
-                "message_id": message_id,
-                "content": ai_response,
-                "response_time_ms": response_time_ms,
-                "speaker_name": player["name"]
-            })
-        else:
-            conn.close()
-            return jsonify({"success": False, "error": "AI API呼び出しエラー"}), 500
-            
+        return jsonify({"success": True, "mode": mode, "results": results, "elapsed_ms": elapsed_ms})
+    except TurnError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@a2a_bp.route("/groups/<int:group_id>/ai-speak/stream", methods=["POST"])
+def ai_speak_stream(group_id):
+    """指定のAIプレイヤーに発言させる（Server-Sent Eventsでトークンを逐次送信）"""
+    try:
+        data = request.get_json()
+        turn = prepare_turn(group_id, data.get("player_id"), data.get("api_key"),
+                            data.get("additional_prompt", ""))
+    except TurnError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    
+    def generate():
+        for item in stream_turn(turn):
+            yield format_sse(item["event"], item["data"])
+    
+    # クライアントが切断するとジェネレーターが閉じられ、保存は行われない
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ===================================
+# バックグラウンド会話API
+# ===================================
+
+@a2a_bp.route("/groups/<int:group_id>/conversation/start", methods=["POST"])
+def start_conversation(group_id):
+    """AI同士の会話をサーバー側で開始"""
+    try:
+        data = request.get_json() or {}
+        turns = data.get("turns")
+        if turns is not None and not isinstance(turns, int):
+            return jsonify({"success": False, "error": "ターン数は整数で指定してください"}), 400
+        
+        job = conversation_runner.start(group_id, turns, data.get("api_keys") or {},
+                                        data.get("additional_prompt", ""))
+        return jsonify({"success": True, "job_id": job.id, "job": job.to_dict()}), 202
+    except TurnError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@a2a_bp.route("/conversation/jobs/<job_id>/stop", methods=["POST"])
+def stop_conversation(job_id):
+    """実行中の会話ジョブを停止"""
+    try:
+        job = conversation_runner.stop(job_id)
+        if job is None:
+            return jsonify({"success": False, "error": "ジョブが見つかりません"}), 404
+        return jsonify({"success": True, "job_id": job.id, "job": job.to_dict()}), 202
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@a2a_bp.route("/conversation/jobs/<job_id>", methods=["GET"])
+def get_conversation_job(job_id):
+    """会話ジョブの進捗を取得"""
+    try:
+        job = conversation_runner.get(job_id)
+        if job is None:
+            return jsonify({"success": False, "error": "ジョブが見つかりません"}), 404
+        return jsonify({"success": True, "job": job.to_dict()})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@a2a_bp.route("/groups/<int:group_id>/conversation", methods=["GET"])
+def get_group_conversation(group_id):
+    """グループで実行中の会話ジョブを取得"""
+    try:
+        job = conversation_runner.get_active_job(group_id)
+        return jsonify({"success": True, "job": job.to_dict() if job else None})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -305,7 +553,19 @@ def get_system_status():
     """システムの状態を取得"""
     try:
         db_info = get_database_info()
-        return jsonify({"success": True, "database": db_info})
+        return jsonify({
+            "success": True,
+            "database": db_info,
+            "provider_clients": get_pool_stats(),
+            "provider_limits": get_limiter_stats(),
+            "conversation_runner": conversation_runner.stats(),
+            "context_builder": context_builder.stats,
+            "prompt_prefix_cache": prefix_cache.stats(),
+            "idempotency": idempotency_store.stats(),
+            "response_cache": response_cache.stats(),
+            "retention": retention_worker.stats(),
+            "message_writer": message_writer.stats()
+        })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -316,20 +576,10 @@ def update_group_rules(group_id):
         data = request.get_json()
         rules = data.get("rules", "").strip()
         
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE chat_groups 
-            SET rules = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE id = ? AND is_active = 1
-        ''', (rules, group_id))
-        
-        if cursor.rowcount == 0:
+        if not set_group_rules(group_id, rules):
             return jsonify({"success": False, "error": "グループが見つかりません"}), 404
         
-        conn.commit()
-        conn.close()
+        prefix_cache.invalidate_group(group_id)
         
         return jsonify({"success": True, "message": "グループルールが更新されました"})
     except Exception as e:
@@ -339,48 +589,38 @@ def update_group_rules(group_id):
 def get_group_info(group_id):
     """グループの詳細情報を取得"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # グループ基本情報
-        cursor.execute('''
-            SELECT id, name, description, rules, created_at 
-            FROM chat_groups 
-            WHERE id = ? AND is_active = 1
-        ''', (group_id,))
-        
-        group = cursor.fetchone()
-        if not group:
-            return jsonify({"success": False, "error": "グループが見つかりません"}), 404
-        
-        # プレイヤー数とメッセージ数を取得
-        cursor.execute("SELECT COUNT(*) FROM players WHERE group_id = ? AND is_active = 1", (group_id,))
-        player_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM messages WHERE group_id = ?", (group_id,))
-        message_count = cursor.fetchone()[0]
-        
-        # 最新メッセージ
-        cursor.execute('''
-            SELECT m.content, m.timestamp, p.name as speaker_name
-            FROM messages m
-            JOIN players p ON m.player_id = p.id
-            WHERE m.group_id = ?
-            ORDER BY m.timestamp DESC
-            LIMIT 1
-        ''', (group_id,))
-        
-        last_message = cursor.fetchone()
-        
-        conn.close()
+        def build():
+            group_info = get_group_details(group_id)
+            if group_info is None:
+                return jsonify({"success": False, "error": "グループが見つかりません"}), 404
+            return jsonify({"success": True, "group": group_info})
+        
+        etag = f"info-{group_id}-{get_group_version(group_id)}"
+        return conditional_response(etag, build)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@a2a_bp.route("/groups/<int:group_id>/snapshot", methods=["GET"])
+def group_snapshot(group_id):
+    """グループ情報・ルール・プレイヤー・最新のメッセージページを1回で取得（グループを開くとき用）"""
+    try:
+        limit = request.args.get("limit", 50, type=int)
+        if limit < 1 or limit > MAX_MESSAGE_PAGE_SIZE:
+            return jsonify({"success": False, "error": f"limitは1〜{MAX_MESSAGE_PAGE_SIZE}で指定してください"}), 400
         
-        group_info = dict(group)
-        group_info.update({
-            "player_count": player_count,
-            "message_count": message_count,
-            "last_message": dict(last_message) if last_message else None
-        })
+        def build():
+            snapshot = get_group_snapshot(group_id, limit)
+            if snapshot is None:
+                return jsonify({"success": False, "error": "グループが見つかりません"}), 404
+            return jsonify({
+                "success": True,
+                "group": snapshot["group"],
+                "players": snapshot["players"],
+                "messages": snapshot["messages"]["messages"],
+                "next_cursor": snapshot["messages"]["next_cursor"]
+            })
         
-        return jsonify({"success": True, "group": group_info})
+        etag = f"snapshot-{group_id}-{get_group_version(group_id)}"
+        return conditional_response(etag, build)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"success": False, "error": str(e)}), 500
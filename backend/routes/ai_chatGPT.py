@@ -1,8 +1,8 @@
 import os
-import html
-import openai
 from flask import Blueprint, request, jsonify
-from openai import OpenAI  # v1系ではこのクラスを使う
+
+# プロバイダーゲートウェイ
+from services.ai_gateway import generate_text
 
 chatgpt_bp = Blueprint("chatgpt", __name__)
 
@@ -17,13 +17,8 @@ def chatgpt():
     print("使用モデル:", chatgpt_model)
 
     try:
-        client = OpenAI(api_key=chatgpt_api_key)
-        response = client.chat.completions.create(
-            model=chatgpt_model,
-            messages=[{"role": "user", "content": prompt}]
-        )
-        result = response.choices[0].message.content
-        return jsonify({"result": html.unescape(result)})
+        result = generate_text("chatGPT", chatgpt_api_key, chatgpt_model, prompt)
+        return jsonify({"result": result})
     except Exception as e:
         print("OpenAI APIエラー:", e)
         return jsonify({"result": f"ChatGPT APIエラー: {str(e)}"}), 500
@@ -1,8 +1,9 @@
 import os
-import html
-import requests
 from flask import Blueprint, request, jsonify
 
+# プロバイダーゲートウェイ
+from services.ai_gateway import generate_text, ProviderError
+
 claude_bp = Blueprint("claude", __name__)
 
 @claude_bp.route("/claude", methods=["POST"])
@@ -16,37 +17,12 @@ def claude():
     print("使用モデル:", claude_model)
 
     try:
-        # Claude APIのエンドポイント
-        url = "https://api.anthropic.com/v1/messages"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "x-api-key": claude_api_key,
-            "anthropic-version": "2023-06-01"
-        }
-        
-        payload = {
-            "model": claude_model,
-            "max_tokens": 4000,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        }
-        
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            result_data = response.json()
-            result = result_data["content"][0]["text"]
-            return jsonify({"result": html.unescape(result)})
-        else:
-            error_msg = f"Claude API エラー: {response.status_code} - {response.text}"
-            print(error_msg)
-            return jsonify({"result": error_msg}), 500
-            
+        result = generate_text("claude", claude_api_key, claude_model, prompt)
+        return jsonify({"result": result})
+    except ProviderError as e:
+        error_msg = str(e)
+        print(error_msg)
+        return jsonify({"result": error_msg}), 500
     except Exception as e:
         print("Claude APIエラー:", e)
-        return jsonify({"result": f"Claude APIエラー: {str(e)}"}), 500
\ No newline at end of file
+        return jsonify({"result": f"Claude APIエラー: {str(e)}"}), 500
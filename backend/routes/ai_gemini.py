@@ -1,9 +1,8 @@
 import os
-import html
 from flask import Blueprint, request, jsonify
 
-# gemini ライブラリのインポート
-import google.generativeai as genai
+# プロバイダーゲートウェイ
+from services.ai_gateway import generate_text
 
 
 gemini_bp = Blueprint("gemini", __name__)
@@ -16,20 +15,16 @@ def gemini():
 
     # api key　取得
     gemini_api_key = data.get('gemini_api_key')
-    # api keyを設定
-    genai.configure(api_key=gemini_api_key)
 
     # model　取得
     gemini_model = data.get('gemini_model')
-    # モデルを設定
-    model = genai.GenerativeModel(gemini_model)
 
 
     # プロンプト(ユーザーが投げかける文章)
     prompt = data.get("prompt", "")
-    # geminiにpromptを送信し結果をresponseに返す
-    response = model.generate_content(prompt)
+    # geminiにpromptを送信し結果を受け取る
+    result = generate_text("gemini", gemini_api_key, gemini_model, prompt)
     
 
     # frontendに結果を返す
-    return jsonify({"result": html.unescape(response.text)})
+    return jsonify({"result": result})
@@ -0,0 +1,25 @@
+import time
+from flask import Blueprint, Response, request, g
+
+from services.metrics import metrics, HTTP_LATENCY, HTTP_REQUESTS
+
+metrics_bp = Blueprint("metrics", __name__)
+
+@metrics_bp.before_app_request
+def start_timer():
+    g.request_started_at = time.perf_counter()
+
+@metrics_bp.after_app_request
+def record_request(response):
+    """ルート（URLルール）ごとの処理時間とステータスを記録"""
+    started_at = g.pop("request_started_at", None)
+    if started_at is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe(HTTP_LATENCY, time.perf_counter() - started_at, route=route, method=request.method)
+        metrics.inc(HTTP_REQUESTS, route=route, method=request.method, status=str(response.status_code))
+    return response
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus 形式でメトリクスを出力"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,398 @@
+"""
+AIプロバイダーゲートウェイ
+
+各プロバイダー（Gemini / OpenAI / Claude）の呼び出しをアダプターとして集約し、
+ルートから直接呼び出せるようにする。ai_speak が自サーバーへHTTPで
+ループバックする必要をなくすためのモジュール。
+
+プロバイダーのSDK（google.ai.generativelanguage・openai など）は読み込みが重いため、
+起動時には読み込まず、アダプターを初めて使うときに AdapterRegistry が読み込む。
+"""
+import html
+import importlib
+import json
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+from services.client_pool import ClientPool
+from services.metrics import metrics, PROVIDER_ERRORS, PROVIDER_LATENCY
+from services.rate_limiter import rate_limiters
+from services.response_cache import response_cache, prompt_hash
+
+
+class ProviderError(Exception):
+    """プロバイダー呼び出し時のエラー（HTTPステータスと Retry-After 秒が分かれば保持）"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# 接続できなかった・応答が時間内に来なかったことを示す例外（再試行の対象）
+#   モジュール名 → 例外クラス名（読み込み済みのモジュールのものだけを対象にする）
+NETWORK_ERROR_TYPES = {
+    "requests": ("Timeout", "ConnectionError"),
+    "openai": ("APIConnectionError",),
+    "httpx": ("TransportError",),
+}
+
+
+def network_errors() -> tuple:
+    """接続・タイムアウト系の例外クラス（未読み込みのSDKの例外は発生しないので含めない）"""
+    errors = [TimeoutError, ConnectionError]
+    for module_name, class_names in NETWORK_ERROR_TYPES.items():
+        module = sys.modules.get(module_name)
+        if module is not None:
+            errors.extend(getattr(module, name) for name in class_names)
+    return tuple(errors)
+
+# 再試行の対象とするHTTPステータス（429 以外はプロバイダー障害として数える）
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504, 529)
+
+
+def parse_retry_after(headers: Mapping) -> Optional[float]:
+    """Retry-After（秒）/ retry-after-ms ヘッダーを秒数にする（日付形式は扱わない）"""
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def classify_error(error: Exception) -> Tuple[bool, bool, Optional[float]]:
+    """例外を (再試行してよいか, 障害として数えるか, Retry-After 秒) に分類"""
+    if isinstance(error, network_errors()):
+        return True, True, None
+
+    # OpenAI・ProviderError は status_code、Google API の例外は code に持つ
+    status = getattr(error, "status_code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "code", None)
+    if not isinstance(status, int) or status not in RETRYABLE_STATUS_CODES:
+        return False, False, None
+
+    retry_after = getattr(error, "retry_after", None)
+    response = getattr(error, "response", None)
+    if retry_after is None and response is not None and getattr(response, "headers", None) is not None:
+        retry_after = parse_retry_after(response.headers)
+    return True, status != 429, retry_after
+
+
+# プロンプトは文字列、または役割付きメッセージの辞書で渡す
+#   {"system": "グループルール・ペルソナ（ターン間で変わらない接頭部）",
+#    "messages": [{"role": "user" | "assistant", "content": "..."}, ...]}
+Prompt = Union[str, Dict]
+
+
+def to_chat_prompt(prompt: Prompt) -> Dict:
+    """文字列のプロンプトを役割付きの形式にそろえる"""
+    if isinstance(prompt, str):
+        return {"system": "", "messages": [{"role": "user", "content": prompt}]}
+    return prompt
+
+
+class ProviderAdapter:
+    """プロバイダーアダプターの共通インターフェース"""
+    name = ""
+    # 属性名 → 読み込むSDKのモジュール（生成時に読み込む）
+    sdk_modules: Dict[str, str] = {}
+
+    def __init__(self):
+        for attr, module_name in self.sdk_modules.items():
+            setattr(self, attr, importlib.import_module(module_name))
+        # APIキーごとのクライアントを使い回す
+        self.pool = ClientPool(self.create_client)
+
+    def create_client(self, api_key: str):
+        """APIキーに対応するクライアントを生成"""
+        raise NotImplementedError
+
+    def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        """プロンプトを送信して生成結果のテキストを返す"""
+        raise NotImplementedError
+
+    def stream(self, api_key: str, model: str, prompt: Prompt,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        """生成結果をトークン（テキスト断片）ごとに返す"""
+        raise NotImplementedError
+
+
+class GeminiAdapter(ProviderAdapter):
+    """Google Gemini アダプター"""
+    name = "gemini"
+    sdk_modules = {"glm": "google.ai.generativelanguage"}
+
+    def create_client(self, api_key: str):
+        # genai.configure() はプロセス全体の設定を書き換えるため使わず、
+        # キーごとに専用のクライアント（GenerativeServiceClient）を持ち、公開APIで直接呼び出す
+        return self.glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+    def _request(self, model: str, chat: Dict):
+        # Gemini ではアシスタントの役割名は "model"
+        request = {"model": f"models/{model}",
+                   "contents": [{"role": "model" if m["role"] == "assistant" else "user",
+                                 "parts": [{"text": m["content"]}]} for m in chat["messages"]]}
+        if chat["system"]:
+            request["system_instruction"] = {"parts": [{"text": chat["system"]}]}
+        return self.glm.GenerateContentRequest(request)
+
+    @staticmethod
+    def _call_options(timeout: Optional[float]) -> Dict:
+        return {"timeout": timeout} if timeout else {}
+
+    @staticmethod
+    def _text(response) -> str:
+        if not response.candidates:
+            return ""
+        return "".join(part.text for part in response.candidates[0].content.parts)
+
+    def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        response = self.pool.get(api_key).generate_content(
+            request=self._request(model, to_chat_prompt(prompt)), **self._call_options(timeout))
+        return html.unescape(self._text(response))
+
+    def stream(self, api_key: str, model: str, prompt: Prompt,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        for chunk in self.pool.get(api_key).stream_generate_content(
+                request=self._request(model, to_chat_prompt(prompt)), **self._call_options(timeout)):
+            text = self._text(chunk)
+            if text:
+                yield html.unescape(text)
+
+
+class OpenAIAdapter(ProviderAdapter):
+    """OpenAI (ChatGPT) アダプター"""
+    name = "chatGPT"
+    sdk_modules = {"openai": "openai"}
+
+    def create_client(self, api_key: str):
+        # OpenAIクライアントはスレッドセーフで、内部でコネクションを保持する
+        # 再試行は rate_limiter で行うため、SDK 側の再試行は無効にする
+        return self.openai.OpenAI(api_key=api_key, max_retries=0)
+
+    @staticmethod
+    def _messages(chat: Dict) -> List[Dict]:
+        # system を先頭に固定すると、OpenAI 側の接頭部キャッシュが自動で効く
+        messages = [{"role": "system", "content": chat["system"]}] if chat["system"] else []
+        return messages + chat["messages"]
+
+    def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        client = self.pool.get(api_key)
+        response = client.chat.completions.create(
+            model=model,
+            messages=self._messages(to_chat_prompt(prompt)),
+            timeout=timeout
+        )
+        return html.unescape(response.choices[0].message.content)
+
+    def stream(self, api_key: str, model: str, prompt: Prompt,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        client = self.pool.get(api_key)
+        response = client.chat.completions.create(
+            model=model,
+            messages=self._messages(to_chat_prompt(prompt)),
+            stream=True,
+            timeout=timeout
+        )
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield html.unescape(chunk.choices[0].delta.content)
+        finally:
+            # 途中でキャンセルされた場合も接続を返却する
+            response.close()
+
+
+class ClaudeAdapter(ProviderAdapter):
+    """Anthropic Claude アダプター"""
+    name = "claude"
+    url = "https://api.anthropic.com/v1/messages"
+    sdk_modules = {"requests": "requests"}
+
+    def create_client(self, api_key: str):
+        # キープアライブ用のSession（ヘッダーはリクエストごとに渡す）
+        session = self.requests.Session()
+        session.mount("https://", self.requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16))
+        return session
+
+    @staticmethod
+    def build_payload(model: str, chat: Dict) -> Dict:
+        """プロンプトキャッシュのブレークポイント付きでリクエスト本文を作成
+
+        ブレークポイントは system（ルール・ペルソナ）と、最後の指示の直前の
+        メッセージ（それまでの会話）に置く。
+        """
+        messages = [{"role": m["role"], "content": [{"type": "text", "text": m["content"]}]}
+                    for m in chat["messages"]]
+        if len(messages) >= 2:
+            messages[-2]["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
+        payload = {
+            "model": model,
+            "max_tokens": 4000,
+            "messages": messages
+        }
+        if chat["system"]:
+            payload["system"] = [{"type": "text", "text": chat["system"],
+                                  "cache_control": {"type": "ephemeral"}}]
+        return payload
+
+    def _request(self, api_key: str, model: str, prompt: Prompt, stream: bool = False,
+                 timeout: Optional[float] = None):
+        headers = {
+            "Content-Type": "application/json",
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01"
+        }
+        payload = self.build_payload(model, to_chat_prompt(prompt))
+        if stream:
+            payload["stream"] = True
+
+        response = self.pool.get(api_key).post(self.url, headers=headers, json=payload, stream=stream,
+                                               timeout=timeout)
+        if response.status_code != 200:
+            raise ProviderError(f"Claude API エラー: {response.status_code} - {response.text}",
+                                status_code=response.status_code,
+                                retry_after=parse_retry_after(response.headers))
+        return response
+
+    def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        response = self._request(api_key, model, prompt, timeout=timeout)
+        return html.unescape(response.json()["content"][0]["text"])
+
+    def stream(self, api_key: str, model: str, prompt: Prompt,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        response = self._request(api_key, model, prompt, stream=True, timeout=timeout)
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):].strip())
+                if event.get("type") == "content_block_delta":
+                    text = event.get("delta", {}).get("text")
+                    if text:
+                        yield html.unescape(text)
+                elif event.get("type") == "error":
+                    # overloaded_error はストリーム中でも 529 と同じ扱い
+                    error = event.get("error") or {}
+                    status = 529 if error.get("type") == "overloaded_error" else None
+                    raise ProviderError(f"Claude API エラー: {error}", status_code=status)
+        finally:
+            response.close()
+
+
+class AdapterRegistry:
+    """プロバイダー名 → アダプター
+
+    アダプターは初めて使うときに生成し、その時点でSDKを読み込む。
+    読み込みにかかった時間は load_times に残す（/status で確認できる）。
+    """
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], ProviderAdapter]] = {}
+        self._adapters: Dict[str, ProviderAdapter] = {}
+        self._lock = threading.Lock()
+        self.load_times: Dict[str, float] = {}
+
+    def register(self, name: str, factory: Callable[[], ProviderAdapter]):
+        """アダプターの生成方法を登録（生成はしない）"""
+        self._factories[name] = factory
+
+    def __setitem__(self, name: str, adapter: ProviderAdapter):
+        """生成済みのアダプターを登録（ベンチマーク用スタブなど）"""
+        with self._lock:
+            self._adapters[name] = adapter
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._adapters or name in self._factories
+
+    def get(self, name: str) -> Optional[ProviderAdapter]:
+        adapter = self._adapters.get(name)
+        if adapter is not None or name not in self._factories:
+            return adapter
+        with self._lock:
+            adapter = self._adapters.get(name)
+            if adapter is None:
+                start = time.perf_counter()
+                adapter = self._adapters[name] = self._factories[name]()
+                self.load_times[name] = round((time.perf_counter() - start) * 1000, 1)
+                print(f"📦 {name} のSDKを読み込みました（{self.load_times[name]}ms）")
+        return adapter
+
+    def loaded(self) -> Dict[str, ProviderAdapter]:
+        """生成済みのアダプター"""
+        with self._lock:
+            return dict(self._adapters)
+
+
+# プロバイダー名 → アダプター（players.ai_provider の値と対応）
+ADAPTERS = AdapterRegistry()
+ADAPTERS.register("gemini", GeminiAdapter)
+ADAPTERS.register("chatGPT", OpenAIAdapter)
+ADAPTERS.register("claude", ClaudeAdapter)
+
+
+def get_adapter(provider: str) -> ProviderAdapter:
+    """プロバイダー名からアダプターを取得"""
+    adapter = ADAPTERS.get(provider)
+    if adapter is None:
+        raise ProviderError(f"未対応のAIプロバイダーです: {provider}")
+    return adapter
+
+
+def get_pool_stats() -> dict:
+    """読み込み済みの各プロバイダーのクライアントプールの状態を取得"""
+    return {name: {**adapter.pool.stats(), "sdk_load_ms": ADAPTERS.load_times.get(name)}
+            for name, adapter in ADAPTERS.loaded().items()}
+
+
+def get_limiter_stats() -> dict:
+    """各プロバイダーの流量制御の状態を取得"""
+    return rate_limiters.stats()
+
+
+def generate_text(provider: str, api_key: str, model: str, prompt: Prompt,
+                  timeout: Optional[float] = None) -> str:
+    """指定プロバイダーでテキストを生成（メモキャッシュが有効なら同じ入力は再利用）
+
+    呼び出しはプロバイダーごとの流量制御を通し、失敗時は timeout 秒の範囲で再試行する。
+    """
+    adapter = get_adapter(provider)
+    limiter = rate_limiters.get(provider)
+
+    def call() -> str:
+        start = time.perf_counter()
+        try:
+            return limiter.call(api_key, lambda remaining: adapter.generate(api_key, model, prompt, remaining),
+                                classify_error, timeout)
+        except Exception:
+            metrics.inc(PROVIDER_ERRORS, provider=provider, model=model)
+            raise
+        finally:
+            metrics.observe(PROVIDER_LATENCY, time.perf_counter() - start, provider=provider, model=model)
+
+    if not response_cache.enabled:
+        return call()
+
+    key = prompt_hash(provider, model, prompt)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = call()
+    response_cache.put(key, result)
+    return result
+
+
+def stream_text(provider: str, api_key: str, model: str, prompt: Prompt,
+                timeout: Optional[float] = None) -> Iterator[str]:
+    """指定プロバイダーでテキストをストリーミング生成（最初の断片までの失敗は再試行）"""
+    adapter = get_adapter(provider)
+    return rate_limiters.get(provider).stream(
+        api_key, lambda remaining: adapter.stream(api_key, model, prompt, remaining), classify_error, timeout)
@@ -0,0 +1,240 @@
+"""
+AIプロバイダーゲートウェイ（asyncio 版）
+
+ASGI モード（asgi.py）から使う。httpx.AsyncClient で各プロバイダーの REST API を
+直接呼び出すため、応答を待つ間スレッドを占有しない。プロンプトの形式・流量制御・
+メモキャッシュは同期版（ai_gateway）と共有する。
+"""
+import asyncio
+import html
+import json
+import time
+from typing import AsyncIterator, Dict, Optional
+
+from services.ai_gateway import (ClaudeAdapter, OpenAIAdapter, Prompt, ProviderError, classify_error,
+                                 generate_text, get_adapter, parse_retry_after, stream_text, to_chat_prompt)
+from services.metrics import metrics, PROVIDER_ERRORS, PROVIDER_LATENCY
+from services.rate_limiter import rate_limiters
+from services.response_cache import response_cache, prompt_hash
+
+# プロバイダーごとの同時接続数の上限（HTTP/1.1 のキープアライブ接続を使い回す）
+ASYNC_MAX_CONNECTIONS = 256
+ASYNC_MAX_KEEPALIVE = 64
+
+
+class AsyncProviderAdapter:
+    """非同期アダプターの共通処理（クライアントはイベントループ内で遅延生成）"""
+    name = ""
+
+    def __init__(self):
+        self._client: Optional["httpx.AsyncClient"] = None
+
+    def client(self) -> "httpx.AsyncClient":
+        if self._client is None:
+            # httpx は ASGI モードで初めて使うときに読み込む
+            import httpx
+            limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                                  max_keepalive_connections=ASYNC_MAX_KEEPALIVE)
+            self._client = httpx.AsyncClient(limits=limits)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, url: str, headers: Dict, payload: Dict, timeout: Optional[float]) -> Dict:
+        response = await self.client().post(url, headers=headers, json=payload, timeout=timeout)
+        if response.status_code != 200:
+            raise ProviderError(f"{self.name} API エラー: {response.status_code} - {response.text}",
+                                status_code=response.status_code,
+                                retry_after=parse_retry_after(response.headers))
+        return response.json()
+
+    async def _events(self, url: str, headers: Dict, payload: Dict,
+                      timeout: Optional[float]) -> AsyncIterator[Dict]:
+        """SSE 形式の応答から data 行の JSON を順に返す"""
+        async with self.client().stream("POST", url, headers=headers, json=payload, timeout=timeout) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", "replace")
+                raise ProviderError(f"{self.name} API エラー: {response.status_code} - {body}",
+                                    status_code=response.status_code,
+                                    retry_after=parse_retry_after(response.headers))
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+
+    async def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        raise NotImplementedError
+
+    def stream(self, api_key: str, model: str, prompt: Prompt,
+               timeout: Optional[float] = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+
+class AsyncGeminiAdapter(AsyncProviderAdapter):
+    """Google Gemini（REST API）"""
+    name = "gemini"
+    url = "https://generativelanguage.googleapis.com/v1beta/models/{model}:{method}"
+
+    @staticmethod
+    def build_payload(chat: Dict) -> Dict:
+        payload = {"contents": [{"role": "model" if m["role"] == "assistant" else "user",
+                                 "parts": [{"text": m["content"]}]} for m in chat["messages"]]}
+        if chat["system"]:
+            payload["systemInstruction"] = {"parts": [{"text": chat["system"]}]}
+        return payload
+
+    @staticmethod
+    def _text(response: Dict) -> str:
+        candidates = response.get("candidates") or [{}]
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+
+    async def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        response = await self._post(self.url.format(model=model, method="generateContent"),
+                                    {"x-goog-api-key": api_key},
+                                    self.build_payload(to_chat_prompt(prompt)), timeout)
+        return html.unescape(self._text(response))
+
+    async def stream(self, api_key: str, model: str, prompt: Prompt,
+                     timeout: Optional[float] = None) -> AsyncIterator[str]:
+        url = self.url.format(model=model, method="streamGenerateContent") + "?alt=sse"
+        async for event in self._events(url, {"x-goog-api-key": api_key},
+                                        self.build_payload(to_chat_prompt(prompt)), timeout):
+            text = self._text(event)
+            if text:
+                yield html.unescape(text)
+
+
+class AsyncOpenAIAdapter(AsyncProviderAdapter):
+    """OpenAI (ChatGPT)（REST API）"""
+    name = "chatGPT"
+    url = "https://api.openai.com/v1/chat/completions"
+
+    @staticmethod
+    def _headers(api_key: str) -> Dict:
+        return {"Authorization": f"Bearer {api_key}"}
+
+    async def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        payload = {"model": model, "messages": OpenAIAdapter._messages(to_chat_prompt(prompt))}
+        response = await self._post(self.url, self._headers(api_key), payload, timeout)
+        return html.unescape(response["choices"][0]["message"]["content"])
+
+    async def stream(self, api_key: str, model: str, prompt: Prompt,
+                     timeout: Optional[float] = None) -> AsyncIterator[str]:
+        payload = {"model": model, "messages": OpenAIAdapter._messages(to_chat_prompt(prompt)), "stream": True}
+        async for event in self._events(self.url, self._headers(api_key), payload, timeout):
+            choices = event.get("choices") or []
+            if choices and choices[0].get("delta", {}).get("content"):
+                yield html.unescape(choices[0]["delta"]["content"])
+
+
+class AsyncClaudeAdapter(AsyncProviderAdapter):
+    """Anthropic Claude（REST API）"""
+    name = "claude"
+    url = ClaudeAdapter.url
+
+    @staticmethod
+    def _headers(api_key: str) -> Dict:
+        return {"x-api-key": api_key, "anthropic-version": "2023-06-01"}
+
+    async def generate(self, api_key: str, model: str, prompt: Prompt, timeout: Optional[float] = None) -> str:
+        payload = ClaudeAdapter.build_payload(model, to_chat_prompt(prompt))
+        response = await self._post(self.url, self._headers(api_key), payload, timeout)
+        return html.unescape(response["content"][0]["text"])
+
+    async def stream(self, api_key: str, model: str, prompt: Prompt,
+                     timeout: Optional[float] = None) -> AsyncIterator[str]:
+        payload = ClaudeAdapter.build_payload(model, to_chat_prompt(prompt))
+        payload["stream"] = True
+        async for event in self._events(self.url, self._headers(api_key), payload, timeout):
+            if event.get("type") == "content_block_delta":
+                text = event.get("delta", {}).get("text")
+                if text:
+                    yield html.unescape(text)
+            elif event.get("type") == "error":
+                error = event.get("error") or {}
+                status = 529 if error.get("type") == "overloaded_error" else None
+                raise ProviderError(f"Claude API エラー: {error}", status_code=status)
+
+
+# プロバイダー名 → 非同期アダプター（ai_gateway.ADAPTERS と同じ名前）
+ASYNC_ADAPTERS = {
+    "gemini": AsyncGeminiAdapter(),
+    "chatGPT": AsyncOpenAIAdapter(),
+    "claude": AsyncClaudeAdapter(),
+}
+
+
+async def close_async_clients():
+    """全アダプターの接続を閉じる（ASGI の shutdown 時）"""
+    for adapter in ASYNC_ADAPTERS.values():
+        await adapter.aclose()
+
+
+async def agenerate_text(provider: str, api_key: str, model: str, prompt: Prompt,
+                         timeout: Optional[float] = None) -> str:
+    """generate_text の非同期版"""
+    adapter = ASYNC_ADAPTERS.get(provider)
+    if adapter is None:
+        # 非同期版のないプロバイダー（ベンチマーク用スタブなど）はスレッドで実行
+        get_adapter(provider)
+        return await asyncio.to_thread(generate_text, provider, api_key, model, prompt, timeout)
+
+    limiter = rate_limiters.get(provider)
+
+    async def call() -> str:
+        start = time.perf_counter()
+        try:
+            return await limiter.acall(api_key, lambda remaining: adapter.generate(api_key, model, prompt, remaining),
+                                       classify_error, timeout)
+        except Exception:
+            metrics.inc(PROVIDER_ERRORS, provider=provider, model=model)
+            raise
+        finally:
+            metrics.observe(PROVIDER_LATENCY, time.perf_counter() - start, provider=provider, model=model)
+
+    if not response_cache.enabled:
+        return await call()
+
+    key = prompt_hash(provider, model, prompt)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = await call()
+    response_cache.put(key, result)
+    return result
+
+
+async def astream_text(provider: str, api_key: str, model: str, prompt: Prompt,
+                       timeout: Optional[float] = None) -> AsyncIterator[str]:
+    """stream_text の非同期版"""
+    adapter = ASYNC_ADAPTERS.get(provider)
+    if adapter is not None:
+        async for text in rate_limiters.get(provider).astream(
+                api_key, lambda remaining: adapter.stream(api_key, model, prompt, remaining),
+                classify_error, timeout):
+            yield text
+        return
+
+    # 非同期版がなければ同期版のジェネレーターをスレッドで1断片ずつ進める
+    iterator = stream_text(provider, api_key, model, prompt, timeout)
+    done = object()
+    try:
+        while True:
+            text = await asyncio.to_thread(next, iterator, done)
+            if text is done:
+                return
+            yield text
+    finally:
+        try:
+            iterator.close()
+        except ValueError:
+            # キャンセル時にスレッド側がまだ実行中の場合は、そのスレッドの終了に任せる
+            pass
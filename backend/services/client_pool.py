@@ -0,0 +1,96 @@
+"""
+プロバイダークライアントのプール
+
+APIキーごとにクライアントを使い回し、TLS接続のキープアライブと
+クライアント生成コストの削減を行う。キーはハッシュ化して保持する。
+LRU・アイドル時間で外したクライアントは、他のスレッドがリクエスト（ストリーミングを
+含む）の途中で使っている可能性があるため閉じずに手放し、参照がなくなった時点で
+GC に回収させる。明示的に閉じるのは clear()（終了時）だけ。
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+
+def hash_api_key(api_key: str) -> str:
+    """APIキーをプールのキー用にハッシュ化"""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+
+
+def close_client(client: Any):
+    """クライアントが持つ接続を解放（close手段がなければ何もしない）"""
+    try:
+        if hasattr(client, "close"):
+            client.close()
+        elif hasattr(client, "transport") and hasattr(client.transport, "close"):
+            client.transport.close()
+    except Exception as e:
+        print("クライアント解放エラー:", e)
+
+
+class ClientPool:
+    """APIキーのハッシュをキーにした、上限付きLRUクライアントプール"""
+
+    def __init__(self, factory: Callable[[str], Any], max_size: int = 32,
+                 idle_ttl_seconds: float = 600):
+        self._factory = factory
+        self._max_size = max_size
+        self._idle_ttl = idle_ttl_seconds
+        self._clients: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str) -> Any:
+        """APIキーに対応するクライアントを取得（なければ生成）"""
+        key = hash_api_key(api_key)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry["last_used"] = now
+                self._clients.move_to_end(key)
+                client = entry["client"]
+            else:
+                client = None
+            self._evict_idle(now)
+
+        if client is None:
+            # 生成はロック外で行う（他のキーの利用を止めない）
+            new_client = self._factory(api_key)
+            with self._lock:
+                entry = self._clients.get(key)
+                if entry is not None:
+                    # 並行して他スレッドが生成済みならそちらを使う（新しいほうは GC に任せる）
+                    entry["last_used"] = now
+                    client = entry["client"]
+                else:
+                    self._clients[key] = {"client": new_client, "last_used": now}
+                    client = new_client
+                    while len(self._clients) > self._max_size:
+                        self._clients.popitem(last=False)
+
+        return client
+
+    def _evict_idle(self, now: float):
+        """一定時間使われていないクライアントをプールから外す（ロック保持中に呼ぶ）"""
+        for key in list(self._clients.keys()):
+            entry = self._clients[key]
+            if now - entry["last_used"] < self._idle_ttl:
+                break  # LRU順なので以降はすべて新しい
+            del self._clients[key]
+
+    def clear(self):
+        """プール内のクライアントをすべて閉じる（終了時用。使用中のリクエストがないこと）"""
+        with self._lock:
+            clients = [entry["client"] for entry in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            close_client(client)
+
+    def stats(self) -> Dict:
+        """プールの状態を取得"""
+        with self._lock:
+            return {"size": len(self._clients), "max_size": self._max_size,
+                    "idle_ttl_seconds": self._idle_ttl}
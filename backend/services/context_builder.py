@@ -0,0 +1,198 @@
+"""
+プロンプト用の会話コンテキスト構築
+
+グループごとの直近メッセージをメモリ上のウィンドウに保持し（add_message の
+イベントで追記）、モデルごとのトークン予算に収まるよう新しい順に詰める。
+"""
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from database import get_messages
+from services.event_bus import message_bus
+
+# モデルごとのコンテキスト長（トークン）
+MODEL_CONTEXT_TOKENS = {
+    "gemini-2.0-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+    "gemini-1.5-flash": 1_048_576,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+    "claude-3-sonnet-20240229": 200_000,
+    "claude-3-haiku-20240307": 200_000,
+}
+
+# モデルが表にない場合のプロバイダー別コンテキスト長
+PROVIDER_CONTEXT_TOKENS = {
+    "gemini": 1_000_000,
+    "chatGPT": 128_000,
+    "claude": 200_000,
+}
+
+# どちらにも該当しない場合のコンテキスト長
+DEFAULT_CONTEXT_TOKENS = 8_000
+
+# 応答用に空けておくトークン数
+OUTPUT_RESERVE_TOKENS = 4_000
+
+# 推定誤差を吸収するための余裕（予算に掛ける係数）
+ESTIMATE_SAFETY_RATIO = 0.9
+
+# グループごとにメモリ上に保持するメッセージ数
+WINDOW_MAX_MESSAGES = 500
+
+# メモリ上に保持するグループ数
+MAX_CACHED_GROUPS = 256
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数を概算する
+
+    ASCII は約4文字で1トークン、日本語などの非ASCII文字は1文字1トークンとして数える。
+    """
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+def get_token_budget(provider: str, model: str) -> int:
+    """モデルに渡せるプロンプトのトークン予算"""
+    limit = MODEL_CONTEXT_TOKENS.get(model) or PROVIDER_CONTEXT_TOKENS.get(provider) or DEFAULT_CONTEXT_TOKENS
+    return max(0, int((limit - OUTPUT_RESERVE_TOKENS) * ESTIMATE_SAFETY_RATIO))
+
+
+def format_line(message: Dict) -> str:
+    """トランスクリプトの1行"""
+    return f"{message['speaker_name']}: {message['content']}\n"
+
+
+class GroupWindow:
+    """1グループ分の直近メッセージ（ID昇順）と、前回構築した結果"""
+
+    def __init__(self, messages: List[Dict]):
+        self.ids: List[int] = []
+        self.lines: List[str] = []
+        self.tokens: List[int] = []
+        self.entries: List[Dict] = []
+        self.lock = threading.Lock()
+        self.last_build: Optional[Tuple[Tuple, Dict]] = None
+        for message in messages:
+            self.append(message)
+
+    def append(self, message: Dict):
+        """メッセージを追加（ロック保持中に呼ぶ）"""
+        message_id = message["id"]
+        if self.ids and message_id <= self.ids[-1]:
+            # 発行順の前後や重複に備える
+            index = bisect.bisect_left(self.ids, message_id)
+            if index < len(self.ids) and self.ids[index] == message_id:
+                return
+        else:
+            index = len(self.ids)
+
+        line = format_line(message)
+        self.ids.insert(index, message_id)
+        self.lines.insert(index, line)
+        self.tokens.insert(index, estimate_tokens(line))
+        self.entries.insert(index, {"player_id": message["player_id"],
+                                    "speaker_name": message["speaker_name"],
+                                    "content": message["content"]})
+
+        overflow = len(self.ids) - WINDOW_MAX_MESSAGES
+        if overflow > 0:
+            del self.ids[:overflow], self.lines[:overflow], self.tokens[:overflow], self.entries[:overflow]
+        self.last_build = None
+
+
+class ContextBuilder:
+    """グループごとのウィンドウを管理し、トークン予算内のトランスクリプトを作る"""
+
+    def __init__(self):
+        self._windows: "OrderedDict[int, GroupWindow]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"builds": 0, "reused": 0, "loads": 0}
+
+    def _get_window(self, group_id: int) -> GroupWindow:
+        with self._lock:
+            window = self._windows.get(group_id)
+            if window is not None:
+                self._windows.move_to_end(group_id)
+                return window
+
+        # 初回のみDBから読み込む
+        window = GroupWindow(get_messages(group_id, WINDOW_MAX_MESSAGES))
+        with self._lock:
+            existing = self._windows.get(group_id)
+            if existing is not None:
+                return existing
+            self._windows[group_id] = window
+            self.stats["loads"] += 1
+            while len(self._windows) > MAX_CACHED_GROUPS:
+                self._windows.popitem(last=False)
+
+        # 読み込みから登録までの間に追加された分を補う
+        with window.lock:
+            last_id = window.ids[-1] if window.ids else 0
+            for message in get_messages(group_id, WINDOW_MAX_MESSAGES, after_id=last_id):
+                window.append(message)
+        return window
+
+    def on_event(self, group_id: int, event: Dict):
+        """add_message のイベントでウィンドウに追記（読み込み済みのグループのみ）"""
+        if event.get("type") != "message":
+            return
+        with self._lock:
+            window = self._windows.get(group_id)
+        if window is not None:
+            with window.lock:
+                window.append(event["message"])
+
+    def invalidate(self, group_id: int = None):
+        """ウィンドウを破棄（メッセージの削除・編集時など）"""
+        with self._lock:
+            if group_id is None:
+                self._windows.clear()
+            else:
+                self._windows.pop(group_id, None)
+
+    def build_transcript(self, group_id: int, token_budget: int, max_messages: int = None) -> Dict:
+        """予算内に収まる直近の会話を時系列順の文字列で返す
+
+        戻り値: {"text", "entries", "message_count", "tokens"}
+        entries は役割付きメッセージを組み立てるための発言者ID・名前・本文の並び。
+        """
+        window = self._get_window(group_id)
+        key = (token_budget, max_messages)
+
+        with window.lock:
+            if window.last_build and window.last_build[0] == key:
+                self.stats["reused"] += 1
+                return window.last_build[1]
+
+            # 新しい順に予算いっぱいまで詰める
+            used = 0
+            start = len(window.lines)
+            limit = len(window.lines) if not max_messages else min(max_messages, len(window.lines))
+            while start > 0 and len(window.lines) - start < limit:
+                cost = window.tokens[start - 1]
+                if used + cost > token_budget:
+                    break
+                used += cost
+                start -= 1
+
+            result = {
+                "text": "".join(window.lines[start:]),
+                "entries": window.entries[start:],
+                "message_count": len(window.lines) - start,
+                "tokens": used,
+            }
+            window.last_build = (key, result)
+            self.stats["builds"] += 1
+            return result
+
+
+# アプリ全体で共有するインスタンス
+context_builder = ContextBuilder()
+message_bus.add_listener(context_builder.on_event)
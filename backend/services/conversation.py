@@ -0,0 +1,380 @@
+"""
+AIの発言（ターン）処理
+
+プレイヤー情報の取得・プロンプト構築・プロバイダー呼び出し・保存までを
+ルートから切り離してまとめる。ai-speak・ストリーミング版・ラウンド実行で共用する。
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+from database import get_connection_for_row, get_conversation_settings, get_players, add_messages
+from services.ai_gateway import ADAPTERS, generate_text, stream_text
+from services.async_gateway import agenerate_text, astream_text
+from services.rate_limiter import LimiterError
+from services.metrics import metrics, PROVIDER_ERRORS, PROVIDER_LATENCY, PROVIDER_TTFT
+from services.context_builder import context_builder, estimate_tokens, get_token_budget
+from services.prompt_cache import prefix_cache
+from services.message_writer import message_writer
+
+
+# 会話履歴の見出し
+CONVERSATION_HEADER = "これまでの会話:\n"
+
+# ラウンド実行のモード
+ROUND_MODES = ("sequential", "parallel")
+
+# parallel モードでプロバイダー呼び出しを並列実行するワーカー数
+ROUND_MAX_WORKERS = 8
+
+_round_executor = ThreadPoolExecutor(max_workers=ROUND_MAX_WORKERS, thread_name_prefix="round")
+
+
+class TurnError(Exception):
+    """AIターンを実行できない場合のエラー（HTTPステータス付き）"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def load_ai_player(player_id: int) -> Dict:
+    """発言させるAIプレイヤーを取得"""
+    try:
+        conn = get_connection_for_row(player_id)
+    except LookupError:
+        raise TurnError("プレイヤーが見つかりません", 404)
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, name, type, ai_provider, ai_model, persona
+            FROM players WHERE id = ? AND is_active = 1
+        ''', (player_id,))
+        player = cursor.fetchone()
+
+    if not player:
+        raise TurnError("プレイヤーが見つかりません", 404)
+
+    if player["type"] != "ai":
+        raise TurnError("このプレイヤーはAIではありません", 400)
+
+    if player["ai_provider"] not in ADAPTERS:
+        raise TurnError("未対応のAIプロバイダーです", 400)
+
+    return dict(player)
+
+
+def build_messages(player: Dict, entries: List[Dict], instruction: str) -> List[Dict]:
+    """会話履歴を役割付きメッセージに変換
+
+    自分の過去の発言は assistant、他の参加者の発言は「名前: 本文」の user とし、
+    同じ役割が続く場合は1つにまとめる。最後に指示を user として付ける。
+    """
+    messages = []
+
+    def push(role: str, text: str):
+        if messages and messages[-1]["role"] == role:
+            messages[-1]["content"] += text
+        else:
+            messages.append({"role": role, "content": text})
+
+    push("user", CONVERSATION_HEADER)
+    for entry in entries:
+        if entry["player_id"] == player["id"]:
+            push("assistant", entry["content"] + "\n")
+        else:
+            push("user", f"{entry['speaker_name']}: {entry['content']}\n")
+    push("user", instruction)
+    return messages
+
+
+def build_prompt(group_id: int, player: Dict, additional_prompt: str = "",
+                 settings: Optional[Dict] = None) -> Dict:
+    """ペルソナ・グループルール・会話履歴から役割付きプロンプトを作成
+
+    グループルールとペルソナはターン間で変わらない system 接頭部としてキャッシュする。
+    会話履歴はモデルのトークン予算から固定部分を引いた残りに、新しい順に詰める。
+    件数の上限は conversation_settings.context_length。
+    """
+    system = prefix_cache.get_prefix(group_id, player)
+    settings = settings or get_conversation_settings(group_id)
+
+    instruction = ""
+    if additional_prompt:
+        instruction += f"\n指示: {additional_prompt}"
+
+    instruction += f"\n\n{player['name']}として返答してください:"
+
+    fixed_tokens = estimate_tokens(system) + estimate_tokens(CONVERSATION_HEADER) + estimate_tokens(instruction)
+    budget = get_token_budget(player["ai_provider"], player["ai_model"]) - fixed_tokens
+    transcript = context_builder.build_transcript(group_id, max(0, budget), settings["context_length"])
+
+    return {"system": system, "messages": build_messages(player, transcript["entries"], instruction)}
+
+
+def prepare_turn(group_id: int, player_id: Optional[int], api_key: Optional[str],
+                 additional_prompt: str = "") -> Dict:
+    """AIターンの入力を検証し、プレイヤーとプロンプトを準備"""
+    if not player_id:
+        raise TurnError("プレイヤーIDは必須です", 400)
+
+    player = load_ai_player(player_id)
+
+    # APIキーを取得（実際の実装では暗号化されたキーを取得）
+    # ここでは簡単のため、フロントエンドから渡されると仮定
+    if not api_key:
+        raise TurnError("APIキーが必要です", 400)
+
+    settings = get_conversation_settings(group_id)
+
+    return {
+        "group_id": group_id,
+        "player": player,
+        "api_key": api_key,
+        "prompt": build_prompt(group_id, player, additional_prompt, settings),
+        # プロバイダー呼び出し（再試行を含む）の制限時間
+        "timeout": settings["turn_timeout_seconds"],
+    }
+
+
+def call_provider(turn: Dict) -> Dict:
+    """準備済みのターンでプロバイダーを呼び出す（保存はしない）"""
+    player = turn["player"]
+    start_time = time.time()
+
+    try:
+        ai_response = generate_text(player["ai_provider"], turn["api_key"], player["ai_model"], turn["prompt"],
+                                    turn.get("timeout"))
+    except LimiterError as e:
+        # 流量制御で呼び出せなかった場合は 429 / 503 をそのまま返す
+        raise TurnError(str(e), e.status_code)
+    except Exception as e:
+        print("AI API呼び出しエラー:", e)
+        raise TurnError("AI API呼び出しエラー", 500)
+
+    response_time_ms = int((time.time() - start_time) * 1000)
+
+    return {
+        "player_id": player["id"],
+        "content": ai_response,
+        "response_time_ms": response_time_ms,
+        "speaker_name": player["name"]
+    }
+
+
+def run_turn(turn: Dict) -> Dict:
+    """準備済みのターンを実行し、結果を保存して返す"""
+    result = call_provider(turn)
+
+    # メッセージをデータベースに保存
+    message_id = message_writer.add_message(turn["group_id"], result["player_id"], result["content"], result["response_time_ms"])
+
+    return {
+        "message_id": message_id,
+        "content": result["content"],
+        "response_time_ms": result["response_time_ms"],
+        "speaker_name": result["speaker_name"]
+    }
+
+
+def run_round(group_id: int, api_keys: Dict[str, str], mode: str = "sequential",
+              additional_prompt: str = "") -> List[Dict]:
+    """グループの全AIプレイヤーを display_order 順に発言させる
+
+    sequential: 1人ずつ発言し、後の話者は前の発言を踏まえる
+    parallel:   全員が同じ時点の会話を元に同時に発言し、結果をまとめて保存する
+    """
+    if mode not in ROUND_MODES:
+        raise TurnError("無効なモードです", 400)
+
+    ai_players = [p for p in get_players(group_id) if p["type"] == "ai"]
+    if not ai_players:
+        raise TurnError("AIプレイヤーがいません", 400)
+
+    results = []
+
+    if mode == "sequential":
+        for player in ai_players:
+            try:
+                turn = prepare_turn(group_id, player["id"], api_keys.get(player["ai_provider"]), additional_prompt)
+                results.append({"success": True, **run_turn(turn)})
+            except TurnError as e:
+                results.append({"success": False, "player_id": player["id"],
+                                "speaker_name": player["name"], "error": str(e)})
+        return results
+
+    # parallel: プロンプトは同じ時点の履歴から作成し、呼び出しだけを並列化する
+    turns = []
+    for player in ai_players:
+        try:
+            turns.append(prepare_turn(group_id, player["id"], api_keys.get(player["ai_provider"]), additional_prompt))
+        except TurnError as e:
+            turns.append(e)
+
+    futures = [None if isinstance(turn, TurnError) else _round_executor.submit(call_provider, turn)
+               for turn in turns]
+
+    completed = []
+    for player, turn, future in zip(ai_players, turns, futures):
+        try:
+            if future is None:
+                raise turn
+            completed.append(future.result())
+            results.append(None)  # 保存後にIDを埋める
+        except TurnError as e:
+            results.append({"success": False, "player_id": player["id"],
+                            "speaker_name": player["name"], "error": str(e)})
+
+    # 成功した発言を1トランザクションで保存
+    message_ids = add_messages(group_id, completed) if completed else []
+
+    saved = iter(zip(completed, message_ids))
+    for i, result in enumerate(results):
+        if result is None:
+            reply, message_id = next(saved)
+            results[i] = {
+                "success": True,
+                "message_id": message_id,
+                "content": reply["content"],
+                "response_time_ms": reply["response_time_ms"],
+                "speaker_name": reply["speaker_name"]
+            }
+    return results
+
+
+def stream_turn(turn: Dict) -> Iterator[Dict]:
+    """準備済みのターンをストリーミング実行する
+
+    トークンごとに {"event": "token"} を返し、完了時に一度だけ保存して
+    {"event": "done"} を返す。途中で呼び出し側が止めた場合は保存しない。
+    """
+    player = turn["player"]
+    start_time = time.time()
+    first_token_ms = None
+    chunks = []
+    labels = {"provider": player["ai_provider"], "model": player["ai_model"]}
+
+    yield {"event": "start", "data": {"speaker_name": player["name"], "player_id": player["id"]}}
+
+    try:
+        for text in stream_text(player["ai_provider"], turn["api_key"], player["ai_model"], turn["prompt"],
+                                turn.get("timeout")):
+            if first_token_ms is None:
+                first_token_ms = int((time.time() - start_time) * 1000)
+                metrics.observe(PROVIDER_TTFT, first_token_ms / 1000, **labels)
+            chunks.append(text)
+            yield {"event": "token", "data": {"text": text}}
+    except GeneratorExit:
+        print(f"ストリーミングがキャンセルされました: group={turn['group_id']} player={player['id']}")
+        raise
+    except LimiterError as e:
+        metrics.inc(PROVIDER_ERRORS, **labels)
+        yield {"event": "error", "data": {"error": str(e), "status": e.status_code}}
+        return
+    except Exception as e:
+        print("AI API呼び出しエラー:", e)
+        metrics.inc(PROVIDER_ERRORS, **labels)
+        yield {"event": "error", "data": {"error": "AI API呼び出しエラー"}}
+        return
+
+    ai_response = "".join(chunks)
+    response_time_ms = int((time.time() - start_time) * 1000)
+    metrics.observe(PROVIDER_LATENCY, response_time_ms / 1000, **labels)
+
+    # 完了したメッセージを一度だけ保存
+    message_id = message_writer.add_message(turn["group_id"], player["id"], ai_response, response_time_ms)
+
+    yield {"event": "done", "data": {
+        "message_id": message_id,
+        "content": ai_response,
+        "response_time_ms": response_time_ms,
+        "first_token_ms": first_token_ms,
+        "speaker_name": player["name"]
+    }}
+
+
+async def acall_provider(turn: Dict) -> Dict:
+    """call_provider の非同期版（ASGI モード用）"""
+    player = turn["player"]
+    start_time = time.time()
+
+    try:
+        ai_response = await agenerate_text(player["ai_provider"], turn["api_key"], player["ai_model"],
+                                           turn["prompt"], turn.get("timeout"))
+    except LimiterError as e:
+        raise TurnError(str(e), e.status_code)
+    except Exception as e:
+        print("AI API呼び出しエラー:", e)
+        raise TurnError("AI API呼び出しエラー", 500)
+
+    response_time_ms = int((time.time() - start_time) * 1000)
+
+    return {
+        "player_id": player["id"],
+        "content": ai_response,
+        "response_time_ms": response_time_ms,
+        "speaker_name": player["name"]
+    }
+
+
+async def arun_turn(turn: Dict) -> Dict:
+    """run_turn の非同期版（保存はスレッドで行う）"""
+    result = await acall_provider(turn)
+
+    message_id = await asyncio.to_thread(message_writer.add_message, turn["group_id"], result["player_id"],
+                                         result["content"], result["response_time_ms"])
+
+    return {
+        "message_id": message_id,
+        "content": result["content"],
+        "response_time_ms": result["response_time_ms"],
+        "speaker_name": result["speaker_name"]
+    }
+
+
+async def astream_turn(turn: Dict) -> AsyncIterator[Dict]:
+    """stream_turn の非同期版
+
+    呼び出し側がキャンセル（クライアント切断）した場合は保存しない。
+    """
+    player = turn["player"]
+    start_time = time.time()
+    first_token_ms = None
+    chunks = []
+    labels = {"provider": player["ai_provider"], "model": player["ai_model"]}
+
+    yield {"event": "start", "data": {"speaker_name": player["name"], "player_id": player["id"]}}
+
+    try:
+        async for text in astream_text(player["ai_provider"], turn["api_key"], player["ai_model"],
+                                       turn["prompt"], turn.get("timeout")):
+            if first_token_ms is None:
+                first_token_ms = int((time.time() - start_time) * 1000)
+                metrics.observe(PROVIDER_TTFT, first_token_ms / 1000, **labels)
+            chunks.append(text)
+            yield {"event": "token", "data": {"text": text}}
+    except LimiterError as e:
+        metrics.inc(PROVIDER_ERRORS, **labels)
+        yield {"event": "error", "data": {"error": str(e), "status": e.status_code}}
+        return
+    except Exception as e:
+        print("AI API呼び出しエラー:", e)
+        metrics.inc(PROVIDER_ERRORS, **labels)
+        yield {"event": "error", "data": {"error": "AI API呼び出しエラー"}}
+        return
+
+    ai_response = "".join(chunks)
+    response_time_ms = int((time.time() - start_time) * 1000)
+    metrics.observe(PROVIDER_LATENCY, response_time_ms / 1000, **labels)
+
+    message_id = await asyncio.to_thread(message_writer.add_message, turn["group_id"], player["id"],
+                                         ai_response, response_time_ms)
+
+    yield {"event": "done", "data": {
+        "message_id": message_id,
+        "content": ai_response,
+        "response_time_ms": response_time_ms,
+        "first_token_ms": first_token_ms,
+        "speaker_name": player["name"]
+    }}
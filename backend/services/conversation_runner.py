@@ -0,0 +1,217 @@
+"""
+バックグラウンド会話ランナー
+
+AI同士の会話をサーバー側でNターン実行する。ブラウザのタブが開いている
+必要はなく、conversation_settings の max_messages・turn_timeout_seconds に従う。
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from database import get_conversation_settings, get_players
+from services.conversation import TurnError, prepare_turn, call_provider
+from services.message_writer import message_writer
+
+# 同時に実行できる会話ジョブ数
+RUNNER_MAX_WORKERS = 4
+
+# 保持しておく終了済みジョブの件数
+MAX_FINISHED_JOBS = 200
+
+# 連続でこの回数失敗したらジョブを中断する
+MAX_CONSECUTIVE_ERRORS = 3
+
+# キャンセル・タイムアウトを確認する間隔（秒）
+POLL_INTERVAL_SECONDS = 0.2
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+FINISHED_STATES = (JOB_COMPLETED, JOB_CANCELLED, JOB_FAILED)
+
+
+class ConversationJob:
+    """1グループ分の会話ジョブ"""
+
+    def __init__(self, group_id: int, turns: int, api_keys: Dict[str, str],
+                 additional_prompt: str = ""):
+        self.id = uuid.uuid4().hex
+        self.group_id = group_id
+        self.turns_total = turns
+        self.turns_done = 0
+        self.api_keys = api_keys
+        self.additional_prompt = additional_prompt
+        self.status = JOB_QUEUED
+        self.error: Optional[str] = None
+        self.turn_errors: List[Dict] = []
+        self.last_message_id: Optional[int] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_event = threading.Event()
+
+    def to_dict(self) -> Dict:
+        """ステータス表示用の辞書"""
+        return {
+            "job_id": self.id,
+            "group_id": self.group_id,
+            "status": self.status,
+            "turns_total": self.turns_total,
+            "turns_done": self.turns_done,
+            "last_message_id": self.last_message_id,
+            "error": self.error,
+            "turn_errors": self.turn_errors[-10:],
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class ConversationRunner:
+    """会話ジョブを上限付きのワーカープールで実行する"""
+
+    def __init__(self, max_workers: int = RUNNER_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="conversation")
+        # タイムアウト付きでプロバイダーを呼ぶためのプール（ジョブ用と分けてデッドロックを防ぐ）
+        self._turn_executor = ThreadPoolExecutor(max_workers=max_workers * 2, thread_name_prefix="conversation-turn")
+        self._jobs: "OrderedDict[str, ConversationJob]" = OrderedDict()
+        self._active_by_group: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def start(self, group_id: int, turns: Optional[int], api_keys: Dict[str, str],
+              additional_prompt: str = "") -> ConversationJob:
+        """会話ジョブを登録して実行を開始"""
+        settings = get_conversation_settings(group_id)
+        max_turns = settings["max_messages"]
+        if turns is None:
+            turns = max_turns
+        if turns <= 0:
+            raise TurnError("ターン数は1以上で指定してください", 400)
+        turns = min(turns, max_turns)
+
+        if not [p for p in get_players(group_id) if p["type"] == "ai"]:
+            raise TurnError("AIプレイヤーがいません", 400)
+
+        job = ConversationJob(group_id, turns, api_keys, additional_prompt)
+        with self._lock:
+            if group_id in self._active_by_group:
+                raise TurnError("このグループでは既に会話を実行中です", 409)
+            self._active_by_group[group_id] = job.id
+            self._jobs[job.id] = job
+            self._trim_finished()
+
+        self._executor.submit(self._run, job)
+        return job
+
+    def stop(self, job_id: str) -> Optional[ConversationJob]:
+        """ジョブのキャンセルを要求"""
+        job = self.get(job_id)
+        if job is not None and job.status not in FINISHED_STATES:
+            job.cancel_event.set()
+        return job
+
+    def get(self, job_id: str) -> Optional[ConversationJob]:
+        """ジョブを取得"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_active_job(self, group_id: int) -> Optional[ConversationJob]:
+        """グループで実行中のジョブを取得"""
+        with self._lock:
+            job_id = self._active_by_group.get(group_id)
+            return self._jobs.get(job_id) if job_id else None
+
+    def stats(self) -> Dict:
+        """ランナー全体の状態を取得"""
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"active_groups": len(self._active_by_group), "jobs": counts}
+
+    def _trim_finished(self):
+        """古い終了済みジョブを削除（ロック保持中に呼ぶ）"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATES]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: ConversationJob):
+        """ジョブ本体（ワーカースレッドで実行）"""
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        consecutive_errors = 0
+
+        try:
+            while job.turns_done < job.turns_total:
+                if job.cancel_event.is_set():
+                    job.status = JOB_CANCELLED
+                    return
+
+                # 設定・プレイヤーは実行中の変更を反映するため毎ターン読み直す
+                settings = get_conversation_settings(job.group_id)
+                ai_players = [p for p in get_players(job.group_id) if p["type"] == "ai"]
+                if not ai_players:
+                    raise TurnError("AIプレイヤーがいません", 400)
+                player = ai_players[job.turns_done % len(ai_players)]
+
+                try:
+                    self._run_turn(job, player, settings["turn_timeout_seconds"])
+                    consecutive_errors = 0
+                except TurnError as e:
+                    consecutive_errors += 1
+                    job.turn_errors.append({"turn": job.turns_done + 1, "player_id": player["id"], "error": str(e)})
+                    if consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+                        raise TurnError(f"連続して{consecutive_errors}回失敗したため中断しました: {e}")
+
+                job.turns_done += 1
+
+            job.status = JOB_COMPLETED
+        except _Cancelled:
+            job.status = JOB_CANCELLED
+        except Exception as e:
+            print(f"会話ジョブエラー: job={job.id} group={job.group_id}", e)
+            job.status = JOB_FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._active_by_group.get(job.group_id) == job.id:
+                    del self._active_by_group[job.group_id]
+
+    def _run_turn(self, job: ConversationJob, player: Dict, timeout_seconds: float):
+        """1ターン実行（タイムアウト・キャンセルを監視）"""
+        turn = prepare_turn(job.group_id, player["id"], job.api_keys.get(player["ai_provider"]),
+                            job.additional_prompt)
+        future = self._turn_executor.submit(call_provider, turn)
+        deadline = time.time() + timeout_seconds
+
+        while True:
+            done, _ = wait([future], timeout=POLL_INTERVAL_SECONDS)
+            if done:
+                break
+            if job.cancel_event.is_set():
+                # 実行中の呼び出しは結果を破棄する
+                future.cancel()
+                raise _Cancelled()
+            if time.time() >= deadline:
+                future.cancel()
+                raise TurnError(f"{timeout_seconds}秒以内に応答がありませんでした", 504)
+
+        result = future.result()
+        job.last_message_id = message_writer.add_message(job.group_id, result["player_id"], result["content"],
+                                                         result["response_time_ms"])
+
+
+class _Cancelled(Exception):
+    """ターン実行中にキャンセルされたことを示す内部例外"""
+    pass
+
+
+# アプリ全体で共有するインスタンス
+conversation_runner = ConversationRunner()
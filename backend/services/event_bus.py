@@ -0,0 +1,136 @@
+"""
+グループ単位のイベント配信（プロセス内 pub/sub）
+
+add_message で追加されたメッセージを、そのグループを購読している
+クライアント（SSE接続）へファンアウトする。ASGI モードの SSE は
+subscribe_async() でイベントループ上のキューとして購読する。
+"""
+import asyncio
+import queue
+import threading
+from typing import Callable, Dict, List, Set
+
+
+# 購読が打ち切られたことを購読者に知らせるイベント
+OVERFLOW_EVENT = {"type": "overflow"}
+
+
+class AsyncSubscription:
+    """イベントループ上で読む購読キュー
+
+    publish は任意のスレッドから呼ばれるため、イベントは call_soon_threadsafe で
+    ループ側の asyncio.Queue へ渡す。溢れの判定は queue.Queue と同じく
+    put_nowait が queue.Full を送出して行う。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self._loop = loop
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._maxsize = maxsize
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def put_nowait(self, event: Dict):
+        with self._lock:
+            # 溢れの通知だけは上限を超えても必ず届ける
+            if self._pending >= self._maxsize and event is not OVERFLOW_EVENT:
+                raise queue.Full
+            self._pending += 1
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        except RuntimeError:
+            # イベントループが終了済み（シャットダウン中）
+            pass
+
+    def get_nowait(self):
+        # 別スレッドからは asyncio.Queue を操作できないため、溢れ時の破棄は行わない
+        # （購読者は OVERFLOW_EVENT まで読んで切断する）
+        raise queue.Empty
+
+    async def get(self, timeout: float) -> Dict:
+        """イベントを1件取得（timeout 秒以内になければ asyncio.TimeoutError）"""
+        event = await asyncio.wait_for(self._queue.get(), timeout)
+        with self._lock:
+            self._pending -= 1
+        return event
+
+
+class EventBus:
+    """グループIDごとの購読キューを管理する"""
+
+    def __init__(self, max_queue_size: int = 1000):
+        self._subscribers: Dict[int, Set[queue.Queue]] = {}
+        self._listeners: List[Callable[[int, Dict], None]] = []
+        self._lock = threading.Lock()
+        self._max_queue_size = max_queue_size
+
+    def add_listener(self, listener: Callable[[int, Dict], None]):
+        """全グループのイベントを同期的に受け取るリスナーを登録（サーバー内キャッシュ用）"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def subscribe(self, group_id: int) -> queue.Queue:
+        """グループを購読し、イベントを受け取るキューを返す"""
+        q = queue.Queue(maxsize=self._max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(group_id, set()).add(q)
+        return q
+
+    def subscribe_async(self, group_id: int) -> AsyncSubscription:
+        """subscribe の asyncio 版（実行中のイベントループで読む）"""
+        q = AsyncSubscription(asyncio.get_running_loop(), self._max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(group_id, set()).add(q)
+        return q
+
+    def unsubscribe(self, group_id: int, q: queue.Queue):
+        """購読を解除"""
+        with self._lock:
+            subscribers = self._subscribers.get(group_id)
+            if subscribers is None:
+                return
+            subscribers.discard(q)
+            if not subscribers:
+                del self._subscribers[group_id]
+
+    def publish(self, group_id: int, event: Dict):
+        """グループの購読者全員にイベントを送る"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(group_id, ()))
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            try:
+                listener(group_id, event)
+            except Exception as e:
+                print("イベントリスナーエラー:", e)
+
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # 読み出しが追いつかない購読者は切り捨てる（再接続時に差分を取得する）
+                self.unsubscribe(group_id, q)
+                self._drain(q)
+                q.put_nowait(OVERFLOW_EVENT)
+                print(f"購読キューが溢れたため切断しました: group={group_id}")
+
+    @staticmethod
+    def _drain(q: queue.Queue):
+        """キューに溜まったイベントを破棄"""
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+
+    def subscriber_count(self, group_id: int = None) -> int:
+        """購読者数を取得"""
+        with self._lock:
+            if group_id is not None:
+                return len(self._subscribers.get(group_id, ()))
+            return sum(len(s) for s in self._subscribers.values())
+
+
+# アプリ全体で共有するインスタンス
+message_bus = EventBus()
@@ -0,0 +1,103 @@
+"""
+Idempotency-Key による重複実行の防止
+
+同じキーのリクエストが再送された場合、実行中なら完了を待ち、
+完了済みなら保存した結果をそのまま返す（プロバイダーを二重に呼ばない）。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+# 完了した結果を保持する時間（秒）
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+
+# 保持するキーの上限
+IDEMPOTENCY_MAX_KEYS = 10_000
+
+# 実行中の同じキーを待つ最大時間（秒）
+IDEMPOTENCY_WAIT_SECONDS = 120
+
+
+class IdempotencyConflict(Exception):
+    """同じキーで異なる内容のリクエストが来た場合のエラー"""
+    pass
+
+
+class _Entry:
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.result: Optional[Tuple[Dict, int]] = None
+        self.finished_at: Optional[float] = None
+
+
+class IdempotencyStore:
+    """キーごとの実行結果（レスポンス本文とステータス）を保持する"""
+
+    def __init__(self, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS,
+                 max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self._ttl = ttl_seconds
+        self._max_keys = max_keys
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, key: str, fingerprint: str, fn: Callable[[], Tuple[Dict, int]]) -> Tuple[Dict, int, bool]:
+        """キーに対して fn を一度だけ実行する
+
+        戻り値は (レスポンス本文, ステータス, 再送に対する保存結果かどうか)。
+        失敗（ステータス 5xx）の結果は保存せず、次の再送で再実行できるようにする。
+        """
+        with self._lock:
+            self._evict(time.time())
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = _Entry(fingerprint)
+                self._entries[key] = entry
+                while len(self._entries) > self._max_keys:
+                    self._entries.popitem(last=False)
+
+        if entry.fingerprint != fingerprint:
+            raise IdempotencyConflict("同じIdempotency-Keyで異なるリクエストが送信されました")
+
+        if not owner:
+            # 先行リクエストの完了を待って同じ結果を返す
+            if not entry.done.wait(IDEMPOTENCY_WAIT_SECONDS):
+                return {"success": False, "error": "同じリクエストを処理中です"}, 409, True
+            return entry.result[0], entry.result[1], True
+
+        try:
+            body, status = fn()
+        except Exception as e:
+            body, status = {"success": False, "error": str(e)}, 500
+
+        entry.result = (body, status)
+        entry.finished_at = time.time()
+        entry.done.set()
+
+        if status >= 500:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+        return body, status, False
+
+    def _evict(self, now: float):
+        """期限切れの完了済みエントリを削除（ロック保持中に呼ぶ）"""
+        for key in list(self._entries.keys()):
+            entry = self._entries[key]
+            if entry.finished_at is None:
+                continue  # 実行中のものは残す
+            if now - entry.finished_at < self._ttl:
+                break
+            del self._entries[key]
+
+    def stats(self) -> Dict:
+        """保持しているキー数"""
+        with self._lock:
+            in_flight = sum(1 for e in self._entries.values() if not e.done.is_set())
+            return {"keys": len(self._entries), "in_flight": in_flight}
+
+
+# アプリ全体で共有するインスタンス
+idempotency_store = IdempotencyStore()
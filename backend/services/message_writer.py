@@ -0,0 +1,156 @@
+"""
+メッセージ書き込みの遅延バッチ（任意）
+
+add_message は1件ごとに INSERT とコミットを行うため、AIの発言と人間の投稿が
+同時に集中すると、コミットと書き込みロックの取り合いが処理時間の大半を占める。
+
+環境変数 A2A_WRITE_BEHIND_DELAY_MS に正の値を設定したときだけ有効になる。
+専用のスレッドが最大その時間（または A2A_WRITE_BEHIND_MAX_BATCH 件）ぶんの
+書き込みをまとめ、DBファイル（シャード時はシャード）ごとに1トランザクションで
+コミットする。呼び出し側は採番されたメッセージIDを Future で受け取る。
+終了時は待ち行列に残った書き込みをすべてコミットしてから止まる。
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from database import add_message, add_messages_bulk, shard_index
+
+# まとめて書き込むまでの最大の待ち時間（ミリ秒）。0 なら無効
+WRITE_BEHIND_DELAY_MS = float(os.environ.get("A2A_WRITE_BEHIND_DELAY_MS", "0"))
+
+# 1トランザクションにまとめる最大件数
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get("A2A_WRITE_BEHIND_MAX_BATCH", "256"))
+
+
+class MessageWriter:
+    """メッセージの INSERT をまとめてコミットするスレッド"""
+
+    def __init__(self, delay_ms: float = WRITE_BEHIND_DELAY_MS, max_batch: int = WRITE_BEHIND_MAX_BATCH):
+        self.delay_ms = delay_ms
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[Tuple[Dict, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {"messages": 0, "batches": 0, "largest_batch": 0, "row_retries": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.delay_ms > 0
+
+    def submit(self, group_id: int, player_id: int, content: str,
+               response_time_ms: int = None, tokens_used: int = None) -> Future:
+        """メッセージの追加を依頼し、メッセージIDを返す Future を取得
+
+        スレッドが動いていなければ（無効時・停止後）その場で add_message を呼ぶ。
+        """
+        row = {"group_id": group_id, "player_id": player_id, "content": content,
+               "response_time_ms": response_time_ms, "tokens_used": tokens_used}
+        future = Future()
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put((row, future))
+                return future
+
+        try:
+            future.set_result(add_message(**row))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def add_message(self, group_id: int, player_id: int, content: str,
+                    response_time_ms: int = None, tokens_used: int = None) -> int:
+        """database.add_message と同じ（有効時はバッチのコミットを待ってIDを返す）"""
+        return self.submit(group_id, player_id, content, response_time_ms, tokens_used).result()
+
+    def _next_batch(self) -> Tuple[List[Tuple[Dict, Future]], bool]:
+        """1バッチ分を待ち行列から取り出す（戻り値の2つ目は停止の合図を受け取ったか）"""
+        item = self._queue.get()
+        if item is None:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.delay_ms / 1000
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                # 待ち時間を過ぎても、すでに届いているものは最大件数まで載せる
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _write(self, batch: List[Tuple[Dict, Future]]):
+        """DBファイルごとに1トランザクションで書き込み、Future に結果を渡す"""
+        buckets: Dict[int, List[Tuple[Dict, Future]]] = {}
+        for row, future in batch:
+            buckets.setdefault(shard_index(row["group_id"]), []).append((row, future))
+
+        for items in buckets.values():
+            try:
+                message_ids = add_messages_bulk([row for row, _ in items])
+            except sqlite3.IntegrityError:
+                # 存在しないプレイヤーなどの1件で他の行まで失敗させないよう、1件ずつ書き直す
+                with self._lock:
+                    self._stats["row_retries"] += len(items)
+                for row, future in items:
+                    try:
+                        future.set_result(add_message(**row))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), message_id in zip(items, message_ids):
+                future.set_result(message_id)
+
+        with self._lock:
+            self._stats["messages"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def start(self):
+        """スレッドを開始（無効時・起動済みなら何もしない）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="message-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """待ち行列の書き込みをすべてコミットしてからスレッドを止める"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            # 以降の submit はその場で書き込むため、停止の合図が最後の要素になる
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"enabled": self.enabled, "running": self._thread is not None,
+                    "delay_ms": self.delay_ms, "max_batch": self.max_batch,
+                    "queued": self._queue.qsize(), **self._stats}
+
+
+# アプリ全体で共有するインスタンス
+message_writer = MessageWriter()
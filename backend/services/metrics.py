@@ -0,0 +1,185 @@
+"""
+Prometheus 形式のメトリクス
+
+ヒストグラムとカウンターはスレッドごとの領域（シャード）に記録し、記録時に
+ロックを取らない。GET /metrics の出力時にだけ全シャードを合算する。
+スレッドが終了するとそのシャードは共通の領域に合算して破棄するため、リクエストごとに
+スレッドを作るサーバーでもシャードは生きているスレッドの数までしか増えない。
+"""
+import bisect
+import functools
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Tuple
+
+# プロバイダー呼び出し・HTTPハンドラー用のバケット（秒）
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# SQLite クエリ用のバケット（秒）
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# メトリクス名
+PROVIDER_LATENCY = "a2a_provider_latency_seconds"
+PROVIDER_TTFT = "a2a_provider_time_to_first_token_seconds"
+PROVIDER_ERRORS = "a2a_provider_errors_total"
+PROVIDER_IN_FLIGHT = "a2a_provider_in_flight"
+HTTP_LATENCY = "a2a_http_request_duration_seconds"
+HTTP_REQUESTS = "a2a_http_requests_total"
+DB_QUERY_LATENCY = "a2a_db_query_duration_seconds"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Shard:
+    """1スレッド分の記録領域（書き込むのは所有スレッドのみ）"""
+
+    def __init__(self):
+        # (名前, ラベル) → [バケットごとの件数..., +Inf の件数, 合計]
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+
+    def merge(self, other: "_Shard"):
+        """other の記録をこのシャードに加算"""
+        for key, series in other.histograms.copy().items():
+            total = self.histograms.get(key)
+            if total is None:
+                self.histograms[key] = list(series)
+            else:
+                for i, value in enumerate(series):
+                    total[i] += value
+        for key, value in other.counters.copy().items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class _ShardHolder:
+    """スレッドローカルに置くシャードの入れ物（スレッド終了時に破棄されたことを検知する）"""
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard: _Shard):
+        self.shard = shard
+
+
+class MetricsRegistry:
+    """メトリクスの定義と記録・出力"""
+
+    def __init__(self):
+        self._meta: Dict[str, Tuple[str, str, tuple]] = {}
+        self._gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+        self._shards: List[_Shard] = []
+        # 終了したスレッドのシャードを合算した領域（ロック内でのみ書き込む）
+        self._retired = _Shard()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help_text, buckets)
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ("counter", help_text, ())
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], Dict[Labels, float]]):
+        """出力時に collect() で値を取得するゲージ"""
+        self._meta[name] = ("gauge", help_text, ())
+        self._gauges[name] = collect
+
+    def _shard(self) -> _Shard:
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            # ロックを取るのはスレッドごとの初回だけ
+            shard = _Shard()
+            holder = self._local.holder = _ShardHolder(shard)
+            with self._lock:
+                self._shards.append(shard)
+            # スレッドが終了してスレッドローカルが破棄されたら、記録を合算して外す
+            weakref.finalize(holder, self._retire, shard)
+        return holder.shard
+
+    def _retire(self, shard: _Shard):
+        with self._lock:
+            self._retired.merge(shard)
+            self._shards.remove(shard)
+
+    def observe(self, name: str, value: float, **labels):
+        """ヒストグラムに値を記録"""
+        buckets = self._meta[name][2]
+        key = (name, tuple(labels.items()))
+        histograms = self._shard().histograms
+        series = histograms.get(key)
+        if series is None:
+            series = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        series[bisect.bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """カウンターを加算"""
+        key = (name, tuple(labels.items()))
+        counters = self._shard().counters
+        counters[key] = counters.get(key, 0) + value
+
+    def timed(self, name: str, **labels):
+        """関数の実行時間をヒストグラムに記録するデコレーター"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def _collect(self):
+        """全シャードを合算"""
+        total = _Shard()
+        # 合算中にシャードが _retired へ移ると二重に数えるため、ロック内で合算する
+        with self._lock:
+            total.merge(self._retired)
+            for shard in self._shards:
+                total.merge(shard)
+        return total.histograms, total.counters
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式で出力"""
+        histograms, counters = self._collect()
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (series_name, labels), series in sorted(histograms.items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), series[:-1]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {series[-1]}")
+                    lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+            elif kind == "counter":
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                for labels, value in sorted(self._gauges[name]().items()):
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    """ラベルを {key="value",...} の形にする"""
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+# アプリ全体で共有するインスタンス
+metrics = MetricsRegistry()
+metrics.histogram(PROVIDER_LATENCY, "AIプロバイダー呼び出しの所要時間（再試行を含む）")
+metrics.histogram(PROVIDER_TTFT, "ストリーミングで最初のトークンが届くまでの時間")
+metrics.counter(PROVIDER_ERRORS, "AIプロバイダー呼び出しの失敗回数")
+metrics.histogram(HTTP_LATENCY, "HTTPハンドラーの処理時間（ルート別）")
+metrics.counter(HTTP_REQUESTS, "HTTPリクエスト数（ルート・ステータス別）")
+metrics.histogram(DB_QUERY_LATENCY, "database.py の関数ごとの実行時間", DB_BUCKETS)
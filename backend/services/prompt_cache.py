@@ -0,0 +1,110 @@
+"""
+プロンプト接頭部（system）のキャッシュ
+
+グループルールとペルソナから作る system 文字列をプレイヤー・グループ単位で保持し、
+ターンをまたいでバイト単位で同一の接頭部を送る。プロバイダー側の
+プロンプトキャッシュが効くようにするのが目的。
+update_group_rules / update_player とグループ・プレイヤーの削除で無効化する。
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from database import get_connection
+
+# 保持する接頭部の上限（最近使っていないものから破棄）
+PREFIX_CACHE_MAX_ENTRIES = 4096
+
+
+def build_prefix(group_rules: str, persona: str) -> str:
+    """グループルールとペルソナから system 文字列を作る"""
+    parts = []
+
+    # グループルールを最優先で追加
+    if group_rules:
+        parts.append(f"【重要】このグループの絶対ルール:\n{group_rules}")
+
+    if persona:
+        parts.append(f"あなたの役割: {persona}")
+
+    return "\n\n".join(parts)
+
+
+class PrefixCache:
+    """(group_id, player_id) ごとの system 文字列キャッシュ"""
+
+    def __init__(self, max_entries: int = PREFIX_CACHE_MAX_ENTRIES):
+        self._prefixes: "OrderedDict[Tuple[int, int], str]" = OrderedDict()
+        self._max_entries = max_entries
+        # 無効化の世代（読み込み中に無効化された接頭部を保存しないために使う）
+        self._group_generations: Dict[int, int] = {}
+        self._player_generations: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "bytes_reused": 0}
+
+    def _generation(self, group_id: int, player_id: int) -> Tuple[int, int]:
+        return self._group_generations.get(group_id, 0), self._player_generations.get(player_id, 0)
+
+    def get_prefix(self, group_id: int, player: Dict) -> str:
+        """プレイヤーの system 文字列を取得（なければ作成）"""
+        key = (group_id, player["id"])
+        with self._lock:
+            prefix = self._prefixes.get(key)
+            if prefix is not None:
+                self._prefixes.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["bytes_reused"] += len(prefix.encode("utf-8"))
+                return prefix
+            self._stats["misses"] += 1
+            generation = self._generation(*key)
+
+        # ルールもペルソナも世代を取った後に読み直す（呼び出し側が先に読み込んだ player の
+        # ペルソナは、その後の update_player より古い可能性がある）
+        with get_connection(group_id) as conn:
+            row = conn.execute('''
+                SELECT cg.rules, p.id as player_id, p.persona
+                FROM chat_groups cg
+                LEFT JOIN players p ON p.id = ? AND p.group_id = cg.id
+                WHERE cg.id = ?
+            ''', (player["id"], group_id)).fetchone()
+        group_rules = row["rules"] if row and row["rules"] else ""
+        persona = row["persona"] if row and row["player_id"] is not None else player["persona"]
+
+        prefix = build_prefix(group_rules, persona)
+        with self._lock:
+            # 読み込み中にルール・ペルソナが変更された場合は古い内容なので保存しない
+            if self._generation(*key) == generation:
+                self._prefixes[key] = prefix
+                self._prefixes.move_to_end(key)
+                while len(self._prefixes) > self._max_entries:
+                    self._prefixes.popitem(last=False)
+        return prefix
+
+    def invalidate_group(self, group_id: int):
+        """グループのルール変更・削除時に、そのグループの接頭部を破棄"""
+        with self._lock:
+            self._group_generations[group_id] = self._group_generations.get(group_id, 0) + 1
+            for key in [k for k in self._prefixes if k[0] == group_id]:
+                del self._prefixes[key]
+
+    def invalidate_player(self, player_id: int):
+        """プレイヤーの変更・削除時に、そのプレイヤーの接頭部を破棄"""
+        with self._lock:
+            self._player_generations[player_id] = self._player_generations.get(player_id, 0) + 1
+            for key in [k for k in self._prefixes if k[1] == player_id]:
+                del self._prefixes[key]
+
+    def stats(self) -> Dict:
+        """ヒット率と、キャッシュ済み接頭部として再送したバイト数"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._prefixes)
+            stats["max_entries"] = self._max_entries
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["bytes_reused_per_turn"] = round(stats["bytes_reused"] / lookups, 1) if lookups else 0.0
+        return stats
+
+
+# アプリ全体で共有するインスタンス
+prefix_cache = PrefixCache()
@@ -0,0 +1,428 @@
+"""
+プロバイダー呼び出しの流量制御
+
+プロバイダー単位・APIキー単位のトークンバケット、同時呼び出し数の上限、
+Retry-After を尊重する指数バックオフ付きの再試行、障害時に即座に失敗させる
+サーキットブレーカーをまとめる。429 を受けたキーはバケットごと待たせるため、
+スロットリング中も失敗させずに流量を落として処理を続けられる。
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+from services.client_pool import hash_api_key
+from services.metrics import metrics, PROVIDER_IN_FLIGHT
+
+T = TypeVar("T")
+
+# プロバイダーごとの制限（rate は1秒あたりの呼び出し数、burst はバケット容量）
+PROVIDER_LIMITS = {
+    "gemini": {"rate": 10.0, "burst": 20, "key_rate": 5.0, "key_burst": 10, "max_concurrent": 16},
+    "chatGPT": {"rate": 10.0, "burst": 20, "key_rate": 5.0, "key_burst": 10, "max_concurrent": 16},
+    "claude": {"rate": 5.0, "burst": 10, "key_rate": 2.0, "key_burst": 5, "max_concurrent": 8},
+}
+
+# 表にないプロバイダーの制限
+DEFAULT_LIMITS = {"rate": 10.0, "burst": 20, "key_rate": 5.0, "key_burst": 10, "max_concurrent": 16}
+
+# 呼び出し元がタイムアウトを指定しない場合の時間（秒）
+DEFAULT_TIMEOUT_SECONDS = 60
+
+# 最大試行回数（初回を含む）
+MAX_ATTEMPTS = 4
+
+# 指数バックオフの初期値と上限（秒）
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20
+
+# この回数連続で失敗したら回路を開く
+BREAKER_FAILURE_THRESHOLD = 5
+
+# 回路を開いてから試験的な呼び出しを許すまでの時間（秒）
+BREAKER_RESET_SECONDS = 30
+
+# 非同期版で同時実行枠の空きを確認する間隔（秒）
+SLOT_POLL_SECONDS = 0.05
+
+# キーごとのバケットを保持する上限
+MAX_KEY_BUCKETS = 1024
+
+# サーキットブレーカーの状態
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class LimiterError(Exception):
+    """流量制御により呼び出せなかった場合のエラー（HTTPステータス付き）"""
+
+    def __init__(self, message: str, status_code: int = 429, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """一定の速度で補充されるトークンバケット"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """トークンを1つ取る。取れなければ待つべき秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, deadline: float):
+        """トークンが取れるまで待つ（期限までに取れなければ LimiterError）"""
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise LimiterError("呼び出し頻度の上限に達しました", 429, retry_after=wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, deadline: float):
+        """acquire の非同期版（待つ間イベントループを止めない）"""
+        while True:
+            wait = self._reserve()
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise LimiterError("呼び出し頻度の上限に達しました", 429, retry_after=wait)
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """429 を受けた場合など、指定時間トークンを出さない"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+    def available(self) -> float:
+        """現在のトークン数（表示用）"""
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return round(min(self.burst, self._tokens + elapsed * self.rate), 2)
+
+
+class CircuitBreaker:
+    """連続した障害で回路を開き、一定時間すべての呼び出しを即座に失敗させる"""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """呼び出してよいか確認（開いていれば LimiterError）"""
+        with self._lock:
+            if self.state == CIRCUIT_OPEN:
+                remaining = self._opened_at + self.reset_seconds - time.monotonic()
+                if remaining > 0:
+                    raise LimiterError("プロバイダーが応答しないため一時的に呼び出しを停止しています",
+                                       503, retry_after=remaining)
+                self.state = CIRCUIT_HALF_OPEN
+                self._probing = False
+            if self.state == CIRCUIT_HALF_OPEN:
+                # 試験的な呼び出しは1本だけ通す
+                if self._probing:
+                    raise LimiterError("プロバイダーの復旧を確認中です", 503, retry_after=1)
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+
+    def release_probe(self):
+        """障害とも成功とも言えない結果（4xx など）で試験枠を返す"""
+        with self._lock:
+            self._probing = False
+
+
+def backoff_seconds(attempt: int) -> float:
+    """attempt 回目の失敗後に待つ時間（フルジッター付き指数バックオフ）"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+
+# 例外を (再試行してよいか, 障害として数えるか, Retry-After 秒) に分類する関数
+Classifier = Callable[[Exception], Tuple[bool, bool, Optional[float]]]
+
+
+class ProviderLimiter:
+    """1プロバイダー分の流量制御"""
+
+    def __init__(self, name: str, rate: float, burst: int, key_rate: float, key_burst: int,
+                 max_concurrent: int):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.max_concurrent = max_concurrent
+        self.breaker = CircuitBreaker()
+        self._key_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {"calls": 0, "retries": 0, "throttled": 0, "rejected": 0, "failures": 0}
+
+    def _key_bucket(self, api_key: str) -> TokenBucket:
+        key = hash_api_key(api_key)
+        with self._lock:
+            bucket = self._key_buckets.get(key)
+            if bucket is None:
+                bucket = self._key_buckets[key] = TokenBucket(self.key_rate, self.key_burst)
+                while len(self._key_buckets) > MAX_KEY_BUCKETS:
+                    self._key_buckets.popitem(last=False)
+            else:
+                self._key_buckets.move_to_end(key)
+            return bucket
+
+    def _count(self, name: str, delta: int = 1):
+        with self._lock:
+            self.counters[name] += delta
+
+    def _acquire(self, key_bucket: TokenBucket, deadline: float):
+        """回路の状態を確認し、バケットと同時実行枠を確保"""
+        self.breaker.before_call()
+        try:
+            key_bucket.acquire(deadline)
+            self.bucket.acquire(deadline)
+            if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                raise LimiterError("同時呼び出し数の上限に達しました", 503, retry_after=1)
+        except LimiterError:
+            self._count("rejected")
+            self.breaker.release_probe()
+            raise
+        with self._lock:
+            self.in_flight += 1
+
+    async def _acquire_async(self, key_bucket: TokenBucket, deadline: float):
+        """_acquire の非同期版（同時実行枠はスレッドからの呼び出しと共有）"""
+        self.breaker.before_call()
+        try:
+            await key_bucket.acquire_async(deadline)
+            await self.bucket.acquire_async(deadline)
+            while not self._slots.acquire(blocking=False):
+                if time.monotonic() >= deadline:
+                    raise LimiterError("同時呼び出し数の上限に達しました", 503, retry_after=1)
+                await asyncio.sleep(SLOT_POLL_SECONDS)
+        except LimiterError:
+            self._count("rejected")
+            self.breaker.release_probe()
+            raise
+        with self._lock:
+            self.in_flight += 1
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def _handle_failure(self, error: Exception, classify: Classifier, key_bucket: TokenBucket,
+                        attempt: int, deadline: float, can_retry: bool = True) -> float:
+        """失敗を記録し、再試行までに待つ秒数を返す（再試行しない場合は例外を送出）"""
+        retryable, is_outage, retry_after = classify(error)
+        if is_outage:
+            self._count("failures")
+            self.breaker.record_failure()
+        else:
+            self.breaker.release_probe()
+
+        if retry_after is not None:
+            # 同じキーの他の呼び出しもまとめて待たせる
+            self._count("throttled")
+            key_bucket.pause(retry_after)
+
+        if not (retryable and can_retry) or attempt + 1 >= MAX_ATTEMPTS or self.breaker.state == CIRCUIT_OPEN:
+            raise error
+        delay = retry_after if retry_after is not None else backoff_seconds(attempt)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        self._count("retries")
+        return delay
+
+    def call(self, api_key: str, fn: Callable[[float], T], classify: Classifier,
+             timeout: Optional[float] = None) -> T:
+        """fn(残り秒数) を制限付きで呼び出す（失敗時は再試行）"""
+        deadline = time.monotonic() + (timeout or DEFAULT_TIMEOUT_SECONDS)
+        key_bucket = self._key_bucket(api_key)
+        self._count("calls")
+
+        attempt = 0
+        while True:
+            self._acquire(key_bucket, deadline)
+            try:
+                result = fn(max(0.1, deadline - time.monotonic()))
+            except Exception as e:
+                self._release()
+                time.sleep(self._handle_failure(e, classify, key_bucket, attempt, deadline))
+                attempt += 1
+                continue
+            self._release()
+            self.breaker.record_success()
+            return result
+
+    def stream(self, api_key: str, fn: Callable[[float], Iterator[str]], classify: Classifier,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        """ストリーミング版の call（最初の断片を返す前の失敗のみ再試行）"""
+        deadline = time.monotonic() + (timeout or DEFAULT_TIMEOUT_SECONDS)
+        key_bucket = self._key_bucket(api_key)
+        self._count("calls")
+
+        attempt = 0
+        while True:
+            self._acquire(key_bucket, deadline)
+            started = False
+            try:
+                for chunk in fn(max(0.1, deadline - time.monotonic())):
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                self._release()
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                self._release()
+                # 断片を返した後は途中から再試行できない
+                time.sleep(self._handle_failure(e, classify, key_bucket, attempt, deadline,
+                                                can_retry=not started))
+                attempt += 1
+                continue
+            self._release()
+            self.breaker.record_success()
+            return
+
+    async def acall(self, api_key: str, fn: Callable[[float], Awaitable[T]], classify: Classifier,
+                    timeout: Optional[float] = None) -> T:
+        """call の非同期版"""
+        deadline = time.monotonic() + (timeout or DEFAULT_TIMEOUT_SECONDS)
+        key_bucket = self._key_bucket(api_key)
+        self._count("calls")
+
+        attempt = 0
+        while True:
+            await self._acquire_async(key_bucket, deadline)
+            try:
+                result = await fn(max(0.1, deadline - time.monotonic()))
+            except Exception as e:
+                self._release()
+                await asyncio.sleep(self._handle_failure(e, classify, key_bucket, attempt, deadline))
+                attempt += 1
+                continue
+            except BaseException:
+                # キャンセルされた場合も枠を返す
+                self._release()
+                self.breaker.release_probe()
+                raise
+            self._release()
+            self.breaker.record_success()
+            return result
+
+    async def astream(self, api_key: str, fn: Callable[[float], AsyncIterator[str]], classify: Classifier,
+                      timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """stream の非同期版"""
+        deadline = time.monotonic() + (timeout or DEFAULT_TIMEOUT_SECONDS)
+        key_bucket = self._key_bucket(api_key)
+        self._count("calls")
+
+        attempt = 0
+        while True:
+            await self._acquire_async(key_bucket, deadline)
+            started = False
+            try:
+                async for chunk in fn(max(0.1, deadline - time.monotonic())):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                self._release()
+                await asyncio.sleep(self._handle_failure(e, classify, key_bucket, attempt, deadline,
+                                                         can_retry=not started))
+                attempt += 1
+                continue
+            except BaseException:
+                self._release()
+                self.breaker.release_probe()
+                raise
+            self._release()
+            self.breaker.record_success()
+            return
+
+    def stats(self) -> Dict:
+        """流量制御の状態を取得"""
+        with self._lock:
+            counters = dict(self.counters)
+            in_flight = self.in_flight
+            keys = len(self._key_buckets)
+        return {
+            "tokens": self.bucket.available(),
+            "rate": self.bucket.rate,
+            "burst": self.bucket.burst,
+            "keys": keys,
+            "in_flight": in_flight,
+            "max_concurrent": self.max_concurrent,
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            **counters,
+        }
+
+
+class RateLimiterRegistry:
+    """プロバイダー名 → ProviderLimiter（初回利用時に作成）"""
+
+    def __init__(self):
+        self._limiters: Dict[str, ProviderLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str) -> ProviderLimiter:
+        limiter = self._limiters.get(provider)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(provider)
+                if limiter is None:
+                    limits = PROVIDER_LIMITS.get(provider, DEFAULT_LIMITS)
+                    limiter = self._limiters[provider] = ProviderLimiter(provider, **limits)
+        return limiter
+
+    def stats(self) -> Dict:
+        """全プロバイダーの状態を取得"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {name: limiter.stats() for name, limiter in limiters.items()}
+
+
+# アプリ全体で共有するインスタンス
+rate_limiters = RateLimiterRegistry()
+metrics.gauge(PROVIDER_IN_FLIGHT, "実行中のAIプロバイダー呼び出し数",
+              lambda: {(("provider", name),): stats["in_flight"] for name, stats in rate_limiters.stats().items()})
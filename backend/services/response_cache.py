@@ -0,0 +1,75 @@
+"""
+プロバイダー応答のメモキャッシュ（任意）
+
+(provider, model, プロンプトのハッシュ) をキーに生成結果を保持し、
+同じ入力の再実行をネットワークに出さずに返す。再現実行やテスト向けで、
+環境変数 AI_RESPONSE_CACHE_TTL_SECONDS に正の値を設定したときだけ有効になる。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# 有効期限（秒）。0 なら無効
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("AI_RESPONSE_CACHE_TTL_SECONDS", "0"))
+
+# 保持する件数の上限
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("AI_RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+
+
+def prompt_hash(provider: str, model: str, prompt) -> str:
+    """キャッシュキー用のハッシュ"""
+    payload = json.dumps([provider, model, prompt], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """件数上限・TTL付きのLRUキャッシュ"""
+
+    def __init__(self, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュ済みの応答を取得（期限切れは削除）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] >= self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key: str, value: str):
+        """応答を保存"""
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"enabled": self.enabled, "entries": len(self._entries), **self._stats}
+
+
+# アプリ全体で共有するインスタンス
+response_cache = ResponseCache()
@@ -0,0 +1,84 @@
+"""
+保存期間（リテンション）のバックグラウンド処理
+
+一定間隔で次の処理を行い、messages テーブルとそのインデックスを小さく保つ。
+  1. hot_message_limit を超えた古いメッセージを圧縮してアーカイブへ移す
+     （既定の 0 では行わない。アーカイブしたメッセージは全文検索の対象外になる）
+  2. 論理削除済みのグループ・プレイヤーを物理削除する
+  3. 空いたページを incremental vacuum でファイルから返す
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+from database import (enforce_retention, purge_deleted_groups, purge_deleted_players,
+                      incremental_vacuum)
+
+# 実行間隔（秒）
+RETENTION_INTERVAL_SECONDS = 300
+
+# 1回の実行でファイルから返す最大ページ数
+VACUUM_PAGES_PER_RUN = 4096
+
+
+class RetentionWorker:
+    """リテンション処理を定期実行するスレッド"""
+
+    def __init__(self, interval: float = RETENTION_INTERVAL_SECONDS):
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.last_run: Optional[Dict] = None
+        self.last_error: Optional[str] = None
+
+    def run_once(self) -> Dict:
+        """1回分の処理を実行して結果を返す"""
+        started = time.time()
+        result = {
+            "archived": enforce_retention(),
+            "purged_groups": purge_deleted_groups(),
+            "purged_players": purge_deleted_players(),
+            "vacuumed_pages": incremental_vacuum(VACUUM_PAGES_PER_RUN),
+        }
+        result["duration_ms"] = round((time.time() - started) * 1000, 1)
+        result["finished_at"] = time.time()
+        with self._lock:
+            self.runs += 1
+            self.last_run = result
+        return result
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"❌ リテンション処理エラー: {e}")
+
+    def start(self):
+        """スレッドを開始（起動済みなら何もしない）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """スレッドを止める（実行中の処理は最後まで行う）"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"running": self._thread is not None, "interval_seconds": self.interval,
+                    "runs": self.runs, "last_run": self.last_run, "last_error": self.last_error}
+
+
+# アプリ全体で共有するインスタンス
+retention_worker = RetentionWorker()
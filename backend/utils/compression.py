@@ -0,0 +1,54 @@
+"""
+レスポンスの圧縮（gzip / brotli）
+
+Accept-Encoding に応じて、一定サイズ以上の JSON・テキスト応答を圧縮する。
+brotli パッケージがなければ gzip のみ。ストリーミング応答（SSE・NDJSON）は圧縮しない。
+"""
+import gzip
+from typing import Optional
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli は任意（なければ gzip のみ）
+    brotli = None
+
+# これより小さい応答は圧縮しない（バイト）
+COMPRESSION_MIN_BYTES = 1024
+
+# 圧縮する Content-Type
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/plain")
+
+# 圧縮レベル（応答ごとに圧縮するため、速度を優先した値にする）
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def choose_encoding(accept_encodings) -> Optional[str]:
+    """クライアントが受け付ける中から使う圧縮方式を選ぶ（同じ優先度なら brotli）"""
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = max(candidates, key=lambda encoding: accept_encodings[encoding])
+    return best if accept_encodings[best] > 0 else None
+
+
+def compress_response(response):
+    """after_request で応答本文を圧縮する"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,58 @@
+"""
+起動時間の計測（python app.py --profile-startup）
+
+別プロセスで `python -X importtime` を使って app の読み込みと startup() を実行し、
+合計時間と、読み込みに時間のかかったモジュールを表示する。
+"""
+import os
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+# 表示するモジュール数
+TOP_MODULES = 15
+
+# 計測するコード（backend ディレクトリで実行）
+PROFILE_CODE = "import app; app.startup()"
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """-X importtime の出力から (モジュール名, 自身の時間μs, 累積時間μs) の一覧を取得"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # 見出し行
+        # 名前の前のインデント（1段2文字）が入れ子の深さを表す
+        modules.append((fields[2].rstrip()[1:], int(fields[0]), int(fields[1])))
+    return modules
+
+
+def main() -> int:
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROFILE_CODE],
+                            cwd=BACKEND_DIR, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        return result.returncode
+
+    modules = parse_importtime(result.stderr)
+    # 最上位（インデントなし）のモジュールの累積時間の合計 = インポート全体の時間
+    total_us = sum(cumulative for name, _, cumulative in modules if not name.startswith(" "))
+
+    print(f"⏱️ 起動時間（プロセス起動を含む）: {elapsed * 1000:.0f}ms")
+    print(f"📦 インポート合計: {total_us / 1000:.0f}ms（{len(modules)}モジュール）")
+    print(f"🐢 累積時間の長いモジュール（上位{TOP_MODULES}件）:")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda m: m[2], reverse=True)[:TOP_MODULES]:
+        print(f"  {cumulative_us / 1000:8.1f}ms  (自身 {self_us / 1000:6.1f}ms)  {name.strip()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
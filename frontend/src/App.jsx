@@ -38,6 +38,8 @@ function App() {
   const [showApiSettings, setShowApiSettings] = useState(false);
   const [showRulesModal, setShowRulesModal] = useState(false);
   const [editingPlayer, setEditingPlayer] = useState(null);
+  // イベント購読の開始位置（スナップショットの最新メッセージID。取得するまでは null）
+  const [eventCursor, setEventCursor] = useState(null);
 
   // 自動スクロール用のref
   const messagesEndRef = useRef(null);
@@ -174,25 +176,24 @@ function App() {
     }
   };
 
-  const fetchMessages = async (groupId) => {
+  // グループ情報・ルール・プレイヤー・最新メッセージを1回のリクエストで取得
+  const fetchGroupSnapshot = async (groupId) => {
     try {
       const response = await axios.get(
-        `${API_BASE}/a2a/groups/${groupId}/messages`
-      );
-      setMessages(response.data.messages);
-    } catch (error) {
-      console.error("メッセージ取得エラー:", error);
-    }
-  };
-
-  const fetchGroupRules = async (groupId) => {
-    try {
-      const response = await axios.get(
-        `${API_BASE}/a2a/groups/${groupId}/info`
+        `${API_BASE}/a2a/groups/${groupId}/snapshot`
       );
+      setPlayers(response.data.players);
+      // 取得中にイベント購読で届いたメッセージを消さないよう、ID単位で取り込む
+      mergeMessages(response.data.messages);
       setGroupRules(response.data.group.rules || "");
+      // スナップショット以降のメッセージから購読を始める
+      const afterId = response.data.messages.reduce(
+        (max, m) => Math.max(max, m.id),
+        0
+      );
+      setEventCursor({ groupId, afterId });
     } catch (error) {
-      console.error("グループルール取得エラー:", error);
+      console.error("グループ取得エラー:", error);
     }
   };
 
@@ -201,12 +202,48 @@ function App() {
     fetchGroups();
   }, []);
 
+  // メッセージを時系列を保ったまま取り込む（重複は除外）
+  const mergeMessages = (incoming) => {
+    setMessages((prev) => {
+      const known = new Set(prev.map((m) => m.id));
+      const added = incoming.filter((m) => !known.has(m.id));
+      if (added.length === 0) return prev;
+      return [...prev, ...added].sort((a, b) => {
+        // ストリーミング中の仮メッセージは常に末尾
+        if (typeof a.id !== "number") return 1;
+        if (typeof b.id !== "number") return -1;
+        return a.id - b.id;
+      });
+    });
+  };
+
+  // 新着メッセージを1件取り込む
+  const mergeMessage = (message) => mergeMessages([message]);
+
+  // 選択中グループの新着メッセージを購読（他のブラウザからの発言も反映）
+  // スナップショットの取得と購読開始の間に追加された分は after_id から再送される
+  const eventGroupId =
+    selectedGroup && eventCursor?.groupId === selectedGroup.id
+      ? selectedGroup.id
+      : null;
+  useEffect(() => {
+    if (eventGroupId === null) return;
+    const source = new EventSource(
+      `${API_BASE}/a2a/groups/${eventGroupId}/events?after_id=${eventCursor.afterId}`
+    );
+    source.addEventListener("message", (event) => {
+      mergeMessage(JSON.parse(event.data));
+    });
+    return () => source.close();
+  }, [eventGroupId]);
+
   // グループ選択時の処理
   const handleGroupSelect = (group) => {
     setSelectedGroup(group);
-    fetchPlayers(group.id);
-    fetchMessages(group.id);
-    fetchGroupRules(group.id);
+    // 前のグループのメッセージと購読を外してから、スナップショットと新着を取り込む
+    setMessages([]);
+    setEventCursor(null);
+    fetchGroupSnapshot(group.id);
   };
 
   // グループ作成
@@ -334,7 +371,6 @@ function App() {
       });
 
       setUserInput("");
-      fetchMessages(selectedGroup.id);
 
       // 送信後は強制的に最下部へスクロール
       setTimeout(() => scrollToBottom(true), 100);
@@ -495,12 +531,69 @@ function App() {
 
     setIsLoading(true);
     try {
-      await axios.post(`${API_BASE}/a2a/groups/${selectedGroup.id}/ai-speak`, {
-        player_id: player.id,
-        api_key: apiKeys[player.ai_provider],
-      });
+      // ストリーミングで受信し、届いたトークンから順に表示する
+      const response = await fetch(
+        `${API_BASE}/a2a/groups/${selectedGroup.id}/ai-speak/stream`,
+        {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({
+            player_id: player.id,
+            api_key: apiKeys[player.ai_provider],
+          }),
+        }
+      );
+      if (!response.ok || !response.body) {
+        throw new Error(`HTTP ${response.status}`);
+      }
+
+      const streamingMessage = {
+        id: `streaming-${player.id}`,
+        content: "",
+        timestamp: new Date().toISOString(),
+        speaker_name: player.name,
+        speaker_type: "ai",
+        ai_provider: player.ai_provider,
+      };
+      setMessages((prev) => [...prev, streamingMessage]);
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let streamError = null;
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSEはイベントごとに空行で区切られる
+        const events = buffer.split("\n\n");
+        buffer = events.pop();
+        for (const raw of events) {
+          const eventName = raw.match(/^event: (.*)$/m)?.[1];
+          const dataLine = raw.match(/^data: (.*)$/m)?.[1];
+          if (!dataLine) continue;
+          const data = JSON.parse(dataLine);
+
+          if (eventName === "token") {
+            streamingMessage.content += data.text;
+            setMessages((prev) =>
+              prev.map((m) =>
+                m.id === streamingMessage.id
+                  ? { ...m, content: streamingMessage.content }
+                  : m
+              )
+            );
+          } else if (eventName === "error") {
+            streamError = data.error;
+          }
+        }
+      }
 
-      fetchMessages(selectedGroup.id);
+      // 確定したメッセージはイベント購読で届くので仮メッセージを外す
+      setMessages((prev) => prev.filter((m) => m.id !== streamingMessage.id));
+      if (streamError) throw new Error(streamError);
     } catch (error) {
       console.error("AI発言エラー:", error);
       alert("AI発言でエラーが発生しました");